@@ -0,0 +1,56 @@
+"""
+Benchmark for response compression levels
+
+Compresses a full Supplier listing and a single Supplier, encoded the way
+the list and get endpoints encode them, at several gzip levels (and brotli
+qualities when brotli is installed), printing the compressed size and the
+throughput of each. COMPRESS_LEVEL and COMPRESS_BROTLI_QUALITY default to
+the fastest settings that keep most of the size reduction.
+
+Run with:
+  python -m benchmarks.compression_bench [rows]
+"""
+import sys
+import random
+import timeit
+from service.compression import BrotliCompressor, ZlibCompressor, brotli
+from service.serializers import SUPPLIER_FIELDS, dumps, serialize_rows
+from tests.factories import SupplierFactory
+
+
+def body(count, products=50):
+    """ Returns the JSON listing of count suppliers offering some products each """
+    rows = []
+    for supplier in (SupplierFactory() for _ in range(count)):
+        supplier.product_list = sorted(random.sample(range(1, 100000), random.randint(1, products)))
+        rows.append(tuple(getattr(supplier, field) for field in SUPPLIER_FIELDS))
+    return dumps(serialize_rows(rows))
+
+
+def measure(data, make, repeat=3):
+    """ Returns the compressed size and MB/s of a compressor factory """
+    def run():
+        compressor = make()
+        return compressor.compress(data) + compressor.finish()
+    size = len(run())
+    best = min(timeit.repeat(run, number=1, repeat=repeat))
+    return size, len(data) / best / 1e6
+
+
+def main(count=10000):
+    """ Runs the benchmark over a listing of count suppliers """
+    settings = [("gzip {}".format(level), lambda level=level: ZlibCompressor("gzip", level))
+                for level in (1, 3, 6, 9)]
+    if brotli is not None:
+        settings += [("br {}".format(quality), lambda quality=quality: BrotliCompressor(quality))
+                     for quality in (1, 4, 6, 11)]
+    for name, data in (("listing of {}".format(count), body(count)), ("single supplier", body(1))):
+        print("{}: {} bytes".format(name, len(data)))
+        for label, make in settings:
+            size, speed = measure(data, make)
+            print("  {:8} {:10} bytes  {:5.1f}x  {:8.1f} MB/s".format(
+                label, size, len(data) / size, speed))
+
+
+if __name__ == "__main__":
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 10000)
@@ -0,0 +1,97 @@
+"""
+Benchmark for the logging overhead of a request
+
+Times the log calls a supplier create makes (route and model INFO lines
+and the DEBUG payload) on the request thread:
+
+  - synchronously through a text formatter, as before the log pipeline
+  - through the LogPipeline, formatted as JSON on the listener thread
+  - through the LogPipeline with the model logger sampled at 10%
+
+Each is run against a local file and against a sink whose flushes take
+50us, like a pipe to a log collector that is falling behind. With a fast
+sink the listener competes with the request thread for the GIL and the
+gain is small; the pipeline pays off once writes block.
+
+Run with:
+  python -m benchmarks.logging_bench [requests]
+"""
+import sys
+import logging
+import time
+import tempfile
+import timeit
+from service.logs import JSONFormatter, LogPipeline
+from tests.factories import SupplierFactory
+
+TEXT_FORMAT = "[%(asctime)s] [%(levelname)s] [%(module)s] %(message)s"
+
+
+class SlowStream:
+    """ A stream whose flushes block for delay seconds """
+
+    def __init__(self, stream, delay=0.00005):
+        self.stream = stream
+        self.delay = delay
+
+    def write(self, text):
+        return self.stream.write(text)
+
+    def flush(self):
+        self.stream.flush()
+        time.sleep(self.delay)
+
+
+def log_request(route, model, payload):
+    """ The log calls of one supplier create """
+    route.info("Request to Create a Supplier")
+    route.debug("Payload = %s", payload)
+    model.info("Creating %s", payload["name"])
+    route.info("Supplier with new id [%s] created!", 42)
+
+
+def loggers(handler, level):
+    """ Returns a route and a model logger outside the logging hierarchy """
+    route = logging.Logger("flask.app", level)
+    model = logging.Logger("flask.app.models", level)
+    for logger in (route, model):
+        logger.addHandler(handler)
+    return route, model
+
+
+def measure(route, model, payload, count, repeat):
+    """ Returns the microseconds spent logging per request """
+    best = min(timeit.repeat(lambda: log_request(route, model, payload), number=count, repeat=repeat))
+    return best / count * 1e6
+
+
+def run(stream, payload, count, repeat, level):
+    """ Returns the synchronous, queued and sampled costs for one sink """
+    handler = logging.StreamHandler(stream)
+    handler.setFormatter(logging.Formatter(TEXT_FORMAT))
+    results = [measure(*loggers(handler, level), payload, count, repeat)]
+    handler.setFormatter(JSONFormatter())
+    for rates in (None, {"flask.app.models": 0.1}):
+        pipeline = LogPipeline([handler], maxsize=count * repeat * 4, rates=rates)
+        pipeline.start()
+        results.append(measure(*loggers(pipeline.handler, level), payload, count, repeat))
+        pipeline.stop()
+    return results
+
+
+def main(count=20000, repeat=5, level=logging.DEBUG):
+    """ Runs the benchmark over count requests """
+    payload = SupplierFactory().serialize()
+    print("requests: {}, level {}".format(count, logging.getLevelName(level)))
+    with tempfile.TemporaryFile("w") as output:
+        for name, stream in (("file", output), ("slow sink", SlowStream(output))):
+            sync, queued, sampled = run(stream, payload, count, repeat, level)
+            print(name)
+            print("  synchronous text:      {:8.2f} us/request".format(sync))
+            print("  queued JSON:           {:8.2f} us/request".format(queued))
+            print("  queued JSON, sampled:  {:8.2f} us/request".format(sampled))
+            print("  speedup:               {:8.1f}x".format(sync / queued))
+
+
+if __name__ == "__main__":
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 20000)
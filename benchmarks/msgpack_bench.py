@@ -0,0 +1,51 @@
+"""
+Benchmark for the JSON and MessagePack encodings of a listing
+
+Encodes and decodes a Supplier listing whose suppliers offer many
+products, with the standard JSON library (what most clients decode with),
+orjson (what the service encodes JSON with) and MessagePack, printing the
+body size and the time of each step.
+
+Run with:
+  python -m benchmarks.msgpack_bench [rows] [products]
+"""
+import sys
+import json
+import random
+import timeit
+import orjson
+from service.serializers import SUPPLIER_FIELDS, packb, serialize_rows, unpackb
+from tests.factories import SupplierFactory
+
+
+def listing(count, products):
+    """ Returns the serialized listing of count suppliers """
+    rows = []
+    for supplier in (SupplierFactory() for _ in range(count)):
+        supplier.product_list = sorted(random.sample(range(1, 1000000), products))
+        rows.append(tuple(getattr(supplier, field) for field in SUPPLIER_FIELDS))
+    return serialize_rows(rows)
+
+
+def best(function, repeat=5):
+    """ Returns the best time of function in milliseconds """
+    return min(timeit.repeat(function, number=1, repeat=repeat)) * 1000
+
+
+def main(count=10000, products=200):
+    """ Runs the benchmark over count suppliers of products products each """
+    data = listing(count, products)
+    encodings = (
+        ("json", lambda: json.dumps(data, separators=(",", ":")).encode("utf-8"), json.loads),
+        ("orjson", lambda: orjson.dumps(data), orjson.loads),
+        ("msgpack", lambda: packb(data), unpackb),
+    )
+    print("rows: {}, products per row: {}".format(count, products))
+    for name, encode, decode in encodings:
+        body = encode()
+        print("  {:8} {:10} bytes  encode {:8.2f} ms  decode {:8.2f} ms".format(
+            name, len(body), best(encode), best(lambda body=body: decode(body))))
+
+
+if __name__ == "__main__":
+    main(*(int(arg) for arg in sys.argv[1:3]))
@@ -0,0 +1,69 @@
+"""
+Benchmark for the supplier product storage layouts
+
+Creates one supplier per catalogue size in array storage and again in table
+storage, then times adding one product (update), loading the supplier
+(read) and finding suppliers of a product (find_by_product).
+
+Run with:
+  python -m benchmarks.product_layout_bench [sizes...]
+"""
+import sys
+import time
+from service.models import Supplier, SupplierProduct, db
+
+SIZES = (10, 1000, 10000, 100000)
+
+
+def timed(action, repeat=5):
+    """ Returns the best duration of action() in milliseconds """
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        action()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best * 1000
+
+
+def measure(storage, size):
+    """ Returns the update, read and lookup timings of one catalogue size """
+    Supplier.product_storage = storage
+    supplier = Supplier(name="Benchmark Supplier", phone="620-179-7652", address="1 Main St",
+                        available=True, product_list=list(range(size)), rating=3.0)
+    supplier.create()
+    supplier_id = supplier.id
+    extra = [size]
+
+    def update():
+        target = Supplier.find(supplier_id)
+        target.product_list = target.product_list + extra
+        target.update()
+        extra[0] += 1
+
+    def read():
+        db.session.expunge_all()
+        return Supplier.find(supplier_id).product_list
+
+    try:
+        return (timed(update), timed(read), timed(lambda: Supplier.find_by_product(size // 2)))
+    finally:
+        db.session.expunge_all()
+        Supplier.find(supplier_id).delete()
+
+
+def main(sizes=SIZES):
+    """ Runs the benchmark over each catalogue size """
+    print("{:>8} {:>6} {:>10} {:>10} {:>10}".format("products", "layout", "update ms", "read ms", "lookup ms"))
+    try:
+        for size in sizes:
+            for storage in ("array", "table"):
+                print("{:>8} {:>6} {:>10.2f} {:>10.2f} {:>10.2f}".format(
+                    size, storage, *measure(storage, size)))
+    finally:
+        Supplier.product_storage = "array"
+    print("supplier_products rows left: {}".format(SupplierProduct.query.count()))
+
+
+if __name__ == "__main__":
+    main([int(size) for size in sys.argv[1:]] or SIZES)
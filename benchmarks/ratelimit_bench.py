@@ -0,0 +1,71 @@
+"""
+Benchmark for the rate limiter overhead of a request
+
+Times RateLimiter.check() for one client in one process, then for many
+clients from several processes at once sharing the same bucket file, as
+the workers of a host do. The last is the wall time of all the checks
+divided by their number, so it only drops below the single process cost
+with more than one CPU.
+
+Run with:
+  python -m benchmarks.ratelimit_bench [checks]
+"""
+import os
+import sys
+import time
+import tempfile
+import timeit
+import multiprocessing
+from service.ratelimit import RateLimiter, parse_quotas
+
+QUOTAS = "reads=1000000:1000000,writes=1000000:1000000,bulk=1000000:1000000"
+
+
+def limiter_for(path):
+    """ Returns a limiter with quotas no check runs out of """
+    limiter = RateLimiter()
+    limiter.configure(parse_quotas(QUOTAS), {"k3y": {"name": "bench"}}, path)
+    return limiter
+
+
+def measure(path, count, clients=1):
+    """ Returns the microseconds per check over count checks """
+    limiter = limiter_for(path)
+    addresses = ["10.0.{}.{}".format(i // 256, i % 256) for i in range(clients)]
+    start = time.perf_counter()
+    for i in range(count):
+        limiter.check(None, addresses[i % clients], "reads")
+    return (time.perf_counter() - start) / count * 1e6
+
+
+def worker(path, count):
+    """ Checks from a worker process """
+    measure(path, count, clients=500)
+
+
+def main(count=200000, processes=4):
+    """ Runs the benchmark over count checks """
+    path = tempfile.mktemp(prefix="ratelimit-bench-")
+    try:
+        limiter = limiter_for(path)
+        best = min(timeit.repeat(lambda: limiter.check("k3y", "10.0.0.1", "reads"),
+                                 number=count, repeat=5))
+        print("checks: {}".format(count))
+        print("  one key, one process:        {:6.2f} us/check".format(best / count * 1e6))
+        print("  500 addresses, one process:  {:6.2f} us/check".format(measure(path, count, 500)))
+        context = multiprocessing.get_context("fork")
+        workers = [context.Process(target=worker, args=(path, count)) for _ in range(processes)]
+        start = time.perf_counter()
+        for process in workers:
+            process.start()
+        for process in workers:
+            process.join()
+        elapsed = time.perf_counter() - start
+        print("  500 addresses, {} processes: {:6.2f} us/check overall, {} cpus".format(
+            processes, elapsed / (count * processes) * 1e6, os.cpu_count()))
+    finally:
+        os.unlink(path)
+
+
+if __name__ == "__main__":
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 200000)
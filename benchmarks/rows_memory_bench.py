@@ -0,0 +1,54 @@
+"""
+Benchmark for the Supplier read paths
+
+Loads the same suppliers through ORM instances (Supplier.all()) and through
+read-only row tuples (Supplier.find_rows()) and reports the memory held per
+row and the time taken by each.
+
+Run with:
+  python -m benchmarks.rows_memory_bench [rows]
+"""
+import sys
+import time
+import tracemalloc
+from service.models import Supplier, db
+from tests.factories import SupplierFactory
+
+
+def measure(load):
+    """ Returns the result of load() with the memory it holds and its duration """
+    db.session.expunge_all()
+    tracemalloc.start()
+    start = time.perf_counter()
+    result = load()
+    elapsed = time.perf_counter() - start
+    size, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return result, size, elapsed
+
+
+def main(count=10000):
+    """ Runs the benchmark over count suppliers """
+    suppliers = [SupplierFactory().serialize() for _ in range(count)]
+    for supplier in suppliers:
+        del supplier["id"]
+        supplier["address"] = supplier["address"][:63]
+    db.session.bulk_insert_mappings(Supplier, suppliers, return_defaults=True)
+    db.session.commit()
+    ids = [supplier["id"] for supplier in suppliers]
+    try:
+        instances, orm_size, orm_time = measure(Supplier.all)
+        rows, row_size, row_time = measure(Supplier.find_rows)
+        print("rows: {}".format(len(rows)))
+        print("ORM instances: {:8.0f} bytes/row {:8.2f} ms".format(
+            orm_size / len(instances), orm_time * 1000))
+        print("row tuples:    {:8.0f} bytes/row {:8.2f} ms".format(
+            row_size / len(rows), row_time * 1000))
+    finally:
+        db.session.expunge_all()
+        Supplier.query.filter(Supplier.id.in_(ids)).delete(synchronize_session=False)
+        db.session.commit()
+
+
+if __name__ == "__main__":
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 10000)
@@ -0,0 +1,40 @@
+"""
+Benchmark for Supplier list serialization
+
+Compares the original response path (Supplier.serialize() followed by
+flask-restx marshalling and the standard JSON encoder) with the
+row serializer and the fast encoder.
+
+Run with:
+  python -m benchmarks.serialize_bench [rows]
+"""
+import sys
+import json
+import timeit
+from flask_restx import marshal
+from service.routes import supplier_model
+from service.serializers import SUPPLIER_FIELDS, serialize_rows, dumps
+from tests.factories import SupplierFactory
+
+
+def main(count=10000, repeat=5):
+    """ Runs the benchmark over count suppliers """
+    suppliers = [SupplierFactory() for _ in range(count)]
+    rows = [tuple(getattr(s, field) for field in SUPPLIER_FIELDS) for s in suppliers]
+
+    def marshalled():
+        return json.dumps(marshal([s.serialize() for s in suppliers], supplier_model))
+
+    def serialized():
+        return dumps(serialize_rows(rows))
+
+    old = min(timeit.repeat(marshalled, number=1, repeat=repeat))
+    new = min(timeit.repeat(serialized, number=1, repeat=repeat))
+    print("rows: {}".format(count))
+    print("serialize + marshal + json: {:8.2f} ms".format(old * 1000))
+    print("row serializer + dumps:     {:8.2f} ms".format(new * 1000))
+    print("speedup:                    {:8.1f}x".format(old / new))
+
+
+if __name__ == "__main__":
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 10000)
@@ -12,9 +12,99 @@ if 'VCAP_SERVICES' in os.environ:
     vcap = json.loads(os.environ['VCAP_SERVICES'])
     DATABASE_URI = vcap['user-provided'][0]['credentials']['DATABASE_URI']
 
+# Optional comma separated read replica URIs that GET requests are sent to,
+# and the seconds between health checks of each replica
+DATABASE_REPLICA_URIS = [uri for uri in os.getenv("DATABASE_REPLICA_URIS", "").split(",") if uri]
+REPLICA_HEALTH_INTERVAL = int(os.getenv("REPLICA_HEALTH_INTERVAL", "5"))
+# Seconds after a write during which the same client session reads from the
+# primary so it sees its own writes
+READ_YOUR_WRITES_SECONDS = int(os.getenv("READ_YOUR_WRITES_SECONDS", "5"))
+
+# Optional comma separated shard URIs that supplier rows are spread over by
+# a hash of their id, the other tables stay in DATABASE_URI. Read replicas
+# are not used when sharding. The number of shards is fixed once data exists.
+DATABASE_SHARD_URIS = [uri for uri in os.getenv("DATABASE_SHARD_URIS", "").split(",") if uri]
+
 # Configure SQLAlchemy
 SQLALCHEMY_DATABASE_URI = DATABASE_URI
 SQLALCHEMY_TRACK_MODIFICATIONS = False
 API_KEY=os.getenv("API_KEY", "API_KEY")
+# More API keys as a JSON object of key to client settings: a name, the
+# scopes the key grants ("writes" and "admin", none by default) and the
+# quotas of the client by route class, e.g.
+# {"k3y": {"name": "acme", "scopes": ["writes"], "reads": "200:400", "bulk": [1, 2]}}
+API_KEYS = json.loads(os.getenv("API_KEYS", "{}"))
+# Token bucket quotas of reads, writes and bulk requests for clients without
+# quotas of their own, as rate per second:burst, e.g.
+# "reads=50:100,writes=5:10,bulk=0.2:2"; empty leaves them unlimited.
+# RATE_LIMIT_FILE is where the workers of a host share the buckets, by
+# default /dev/shm/supplier-ratelimit, holding RATE_LIMIT_SLOTS buckets.
+RATE_LIMITS = os.getenv("RATE_LIMITS", "")
+RATE_LIMIT_FILE = os.getenv("RATE_LIMIT_FILE", "")
+RATE_LIMIT_SLOTS = int(os.getenv("RATE_LIMIT_SLOTS", "4096"))
+# Number of proxies in front of the service that append the client address
+# to X-Forwarded-For, one for the platform router; 0 uses the peer address,
+# as when clients connect directly and could forge the header
+TRUSTED_PROXIES = int(os.getenv("TRUSTED_PROXIES", "1"))
+# Seconds to cache supplier statistics for, 0 disables the cache
+STATS_CACHE_TTL = int(os.getenv("STATS_CACHE_TTL", "0"))
+# Seconds to cache supplier rows by id and the most rows cached, a TTL of 0
+# disables the cache; other workers see writes once the TTL has passed
+SUPPLIER_CACHE_TTL = int(os.getenv("SUPPLIER_CACHE_TTL", "0"))
+SUPPLIER_CACHE_SIZE = int(os.getenv("SUPPLIER_CACHE_SIZE", "10000"))
+# Most bytes of encoded list responses cached per worker, 0 disables the
+# cache. Entries are dropped by any write made on this host, tracked by a
+# counter in DATA_GENERATION_FILE (default /dev/shm/supplier-generation);
+# LIST_CACHE_TTL bounds how long writes made on other hosts go unseen.
+LIST_CACHE_MAX_BYTES = int(os.getenv("LIST_CACHE_MAX_BYTES", "0"))
+LIST_CACHE_TTL = int(os.getenv("LIST_CACHE_TTL", "60"))
+DATA_GENERATION_FILE = os.getenv("DATA_GENERATION_FILE", "")
+# Size of the supplier name autocomplete index, and seconds before it is
+# rebuilt in the background to pick up writes made by other workers (0 never
+# rebuilds)
+AUTOCOMPLETE_MAX_ENTRIES = int(os.getenv("AUTOCOMPLETE_MAX_ENTRIES", "100000"))
+AUTOCOMPLETE_REFRESH = int(os.getenv("AUTOCOMPLETE_REFRESH", "300"))
+# Where supplier product lists live: "array" (product_list column), "dual"
+# (both, while migrating) or "table" (the supplier_products table)
+PRODUCT_STORAGE = os.getenv("PRODUCT_STORAGE", "array")
+# Seconds a Server-Sent Events change stream stays open before the client
+# has to reconnect, at most 20 to end before the gunicorn worker timeout
+CHANGE_STREAM_SECONDS = int(os.getenv("CHANGE_STREAM_SECONDS", "20"))
+# Log lines are JSON objects unless LOG_FORMAT is "text". LOG_SAMPLE_RATES
+# keeps a fraction of the records below WARNING of a logger and its
+# children, e.g. "flask.app.models=0.1,flask.app=0.5". LOG_QUEUE_SIZE is
+# the most records waiting for the log writer thread before new ones are
+# dropped.
+LOG_FORMAT = os.getenv("LOG_FORMAT", "json")
+LOG_SAMPLE_RATES = os.getenv("LOG_SAMPLE_RATES", "")
+LOG_QUEUE_SIZE = int(os.getenv("LOG_QUEUE_SIZE", "10000"))
+# Request tracing: spans are written as OTLP JSON lines to TRACE_EXPORT, a
+# file path or an OTLP/HTTP collector URL such as
+# http://localhost:4318/v1/traces, at most TRACE_EXPORT_INTERVAL seconds
+# after they end. TRACE_SAMPLE_RATE is the fraction of requests traced when
+# the caller sent no traceparent header. An empty TRACE_EXPORT turns it off.
+TRACE_EXPORT = os.getenv("TRACE_EXPORT", "")
+TRACE_SAMPLE_RATE = float(os.getenv("TRACE_SAMPLE_RATE", "0.01"))
+TRACE_EXPORT_INTERVAL = float(os.getenv("TRACE_EXPORT_INTERVAL", "5"))
+# Admission control per worker: at most ADMISSION_MAX_IN_FLIGHT requests
+# at once (0 for no limit, it only matters with gunicorn --threads) and at
+# most ADMISSION_LIMITS of each route class, e.g. "reads=6,writes=4,bulk=1".
+# A request waits up to ADMISSION_QUEUE_TIMEOUT seconds for a slot, and one
+# whose X-Request-Start header is over ADMISSION_MAX_QUEUE_AGE seconds old
+# (0 turns the check off) is rejected at once. Rejected requests get a 503
+# with a Retry-After of ADMISSION_RETRY_AFTER seconds.
+ADMISSION_MAX_IN_FLIGHT = int(os.getenv("ADMISSION_MAX_IN_FLIGHT", "0"))
+ADMISSION_LIMITS = os.getenv("ADMISSION_LIMITS", "")
+ADMISSION_QUEUE_TIMEOUT = float(os.getenv("ADMISSION_QUEUE_TIMEOUT", "1"))
+ADMISSION_MAX_QUEUE_AGE = float(os.getenv("ADMISSION_MAX_QUEUE_AGE", "0"))
+ADMISSION_RETRY_AFTER = int(os.getenv("ADMISSION_RETRY_AFTER", "1"))
+# API responses of at least COMPRESS_MIN_SIZE bytes are compressed with br
+# (when brotli is installed), gzip or deflate as the client accepts, a
+# negative size turns compression off. Streamed responses are always
+# compressed. The levels favour throughput over size: COMPRESS_LEVEL for
+# gzip and deflate (1-9), COMPRESS_BROTLI_QUALITY for br (0-11).
+COMPRESS_MIN_SIZE = int(os.getenv("COMPRESS_MIN_SIZE", "2048"))
+COMPRESS_LEVEL = int(os.getenv("COMPRESS_LEVEL", "1"))
+COMPRESS_BROTLI_QUALITY = int(os.getenv("COMPRESS_BROTLI_QUALITY", "1"))
 # Secret for session management
 SECRET_KEY = os.getenv("SECRET_KEY", "s3cr3t-key-shhhh")
@@ -3,4 +3,6 @@ import os
 PORT = os.getenv("VCAP_APP_PORT", "5000")
 bind = "0.0.0.0:" + PORT
 workers = 1
+# seconds before a busy worker is killed, change feed requests end before it
+timeout = 30
 log_level = "info"
@@ -8,6 +8,7 @@ import os
 import sys
 import logging
 from flask import Flask
+from werkzeug.middleware.proxy_fix import ProxyFix
 
 # Create Flask application
 app = Flask(__name__)  # pylint: disable=invalid-name
@@ -15,21 +16,37 @@ app.config.from_object("config")
 
 app.url_map.strict_slashes = False
 
+# take the client address from the X-Forwarded-For of the trusted proxies
+if app.config["TRUSTED_PROXIES"]:
+    app.wsgi_app = ProxyFix(app.wsgi_app, x_for=app.config["TRUSTED_PROXIES"])
+
 # Import the rutes After the Flask app is created
-from service import routes, models
+from service import routes, models, commands, logs, tracing, profiler, ratelimit, compression, \
+    admission
+
+commands.init_app(app)
+# registered first so it runs after the other response hooks
+compression.init_app(app)
+tracing.init_app(app)
+profiler.init_app(app)
+admission.init_app(app)
 
 # Set up logging for production
 if __name__ != "__main__":
     gunicorn_logger = logging.getLogger("gunicorn.error")
-    app.logger.handlers = gunicorn_logger.handlers
     app.logger.setLevel(gunicorn_logger.level)
     app.logger.propagate = False
-    # Make all log formats consistent
-    formatter = logging.Formatter(
-        "[%(asctime)s] [%(levelname)s] [%(module)s] %(message)s", "%Y-%m-%d %H:%M:%S %z"
-    )
-    for handler in app.logger.handlers:
+    # Make all log formats consistent, JSON lines unless LOG_FORMAT is text
+    if app.config["LOG_FORMAT"] == "text":
+        formatter = logging.Formatter(
+            "[%(asctime)s] [%(levelname)s] [%(module)s] %(message)s", "%Y-%m-%d %H:%M:%S %z"
+        )
+    else:
+        formatter = logs.JSONFormatter()
+    for handler in gunicorn_logger.handlers:
         handler.setFormatter(formatter)
+    # the records are written by a listener thread, off the request path
+    logs.init_app(app, gunicorn_logger.handlers)
     app.logger.info("Logging handler established")
 
 app.logger.info(70 * "*")
@@ -38,6 +55,8 @@ app.logger.info(70 * "*")
 
 try:
     routes.init_db()  # make our sqlalchemy tables
+    routes.load_name_index()
+    models.db.session.remove()  # do not hold the startup connection
 except Exception as error:
     app.logger.critical("%s: Cannot continue", error)
     # gunicorn requires exit code 4 to stop spawning workers when they die
@@ -48,3 +67,6 @@ app.logger.info("Service inititalized!")
 if not app.config['API_KEY']:
     app.config['API_KEY'] = routes.generate_apikey()
     app.logger.info('Missing API Key! Autogenerated: {}'.format(app.config['API_KEY']))
+
+# after the API key is known, so its client gets the default quotas
+ratelimit.init_app(app)
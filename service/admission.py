@@ -0,0 +1,184 @@
+"""
+Admission control for the Supplier service
+
+When the database slows down, requests pile up in the workers and in the
+socket backlog until clients time out, and the work done for them is
+wasted. The AdmissionController turns requests away with a fast 503
+instead:
+
+- a request that waited longer than max_queue_age seconds between the
+  router (its X-Request-Start header) and the worker is rejected at once,
+  its client has likely given up. This is what protects sync workers,
+  whose requests queue in the backlog
+- at most max_in_flight requests of a worker run at once, and at most a
+  limit of each route class. A request waits up to queue_timeout seconds
+  for a slot; bulk requests yield to waiting reads and writes
+
+Health checks and responses served from a cache do not take a slot.
+"""
+import time
+import threading
+from contextlib import contextmanager
+
+# Lower runs first when requests wait for a slot
+PRIORITIES = {"reads": 0, "writes": 0, "bulk": 1}
+
+
+class Overloaded(Exception):
+    """ Used when a request is turned away to keep the worker responsive """
+
+    def __init__(self, message, retry_after=1):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+def parse_limits(text):
+    """ Returns the in-flight limits by route class of "reads=6,writes=4,bulk=1" """
+    limits = {}
+    for item in filter(None, (part.strip() for part in text.split(","))):
+        route_class, _, value = item.partition("=")
+        route_class = route_class.strip()
+        if route_class not in PRIORITIES:
+            raise ValueError("Unknown route class {!r}, expected one of {}".format(
+                route_class, ", ".join(PRIORITIES)))
+        try:
+            limits[route_class] = int(value)
+        except ValueError:
+            raise ValueError("Invalid in-flight limit {!r}".format(item))
+        if limits[route_class] < 1:
+            raise ValueError("Invalid in-flight limit {!r}, it must be at least 1".format(item))
+    return limits
+
+
+def request_start(value):
+    """Returns the epoch seconds of an X-Request-Start header, None when it is not valid
+
+    Routers send seconds, milliseconds or microseconds, optionally after t=
+    """
+    if not value:
+        return None
+    try:
+        start = float(value.strip()[2:] if value.strip().startswith("t=") else value)
+    except ValueError:
+        return None
+    while start > 1e11:
+        start /= 1000
+    return start
+
+
+class AdmissionController:
+    """ Limits the requests a worker runs at once and sheds the ones that waited too long """
+
+    def __init__(self):
+        self.max_in_flight = 0
+        self.limits = {}
+        self.queue_timeout = 1.0
+        self.max_queue_age = 0
+        self.retry_after = 1
+        self.in_flight = 0
+        self.active = dict.fromkeys(PRIORITIES, 0)
+        self.waiting = dict.fromkeys(set(PRIORITIES.values()), 0)
+        self.shed = 0
+        self._ready = threading.Condition()
+
+    def configure(self, max_in_flight=0, limits=None, queue_timeout=1.0, max_queue_age=0, retry_after=1):
+        """Replaces the limits
+
+        Args:
+            max_in_flight (int): requests of the worker running at once, 0
+                for no limit
+            limits (dict): requests of a route class running at once
+            queue_timeout (float): the most seconds a request waits for a slot
+            max_queue_age (float): the most seconds a request may have waited
+                since X-Request-Start, 0 for no limit
+            retry_after (int): seconds rejected clients are told to wait
+        """
+        with self._ready:
+            self.max_in_flight = max_in_flight
+            self.limits = dict(limits or {})
+            self.queue_timeout = queue_timeout
+            self.max_queue_age = max_queue_age
+            self.retry_after = retry_after
+            self._ready.notify_all()
+
+    @property
+    def enabled(self):
+        """ True when requests may be turned away """
+        return bool(self.max_in_flight or self.limits or self.max_queue_age)
+
+    def admit(self, route_class, started=None):
+        """Takes a slot for a request of a route class
+
+        Args:
+            started (float): epoch seconds the router received the request
+
+        Raises:
+            Overloaded: when the request waited too long or no slot freed up
+                in time
+        """
+        if self.max_queue_age and started is not None:
+            age = time.time() - started
+            if age > self.max_queue_age:
+                self._reject("Request waited {:.1f}s in the queue".format(age))
+        priority = PRIORITIES.get(route_class, 0)
+        with self._ready:
+            if not self._can_enter(route_class, priority):
+                deadline = time.monotonic() + self.queue_timeout
+                self.waiting[priority] += 1
+                try:
+                    while not self._can_enter(route_class, priority):
+                        remaining = deadline - time.monotonic()
+                        if remaining <= 0:
+                            self._reject("Too many {} requests in progress".format(route_class))
+                        self._ready.wait(remaining)
+                finally:
+                    self.waiting[priority] -= 1
+                    # a bulk request may have been held back by this one
+                    self._ready.notify_all()
+            self.in_flight += 1
+            self.active[route_class] = self.active.get(route_class, 0) + 1
+
+    def release(self, route_class):
+        """ Frees the slot of a finished request """
+        with self._ready:
+            self.in_flight -= 1
+            self.active[route_class] -= 1
+            self._ready.notify_all()
+
+    @contextmanager
+    def slot(self, route_class, started=None):
+        """ Runs a block in a slot of a route class, see admit() """
+        if not self.enabled:
+            yield
+            return
+        self.admit(route_class, started)
+        try:
+            yield
+        finally:
+            self.release(route_class)
+
+    def _can_enter(self, route_class, priority):
+        if self.max_in_flight and self.in_flight >= self.max_in_flight:
+            return False
+        limit = self.limits.get(route_class)
+        if limit is not None and self.active.get(route_class, 0) >= limit:
+            return False
+        return not any(count for level, count in self.waiting.items() if level < priority)
+
+    def _reject(self, message):
+        with self._ready:
+            self.shed += 1
+        raise Overloaded(message, self.retry_after)
+
+
+# The admission controller of the worker
+admission = AdmissionController()
+
+
+def init_app(app):
+    """ Configures the admission controller from the app config """
+    admission.configure(app.config.get("ADMISSION_MAX_IN_FLIGHT", 0),
+                        parse_limits(app.config.get("ADMISSION_LIMITS", "")),
+                        app.config.get("ADMISSION_QUEUE_TIMEOUT", 1.0),
+                        app.config.get("ADMISSION_MAX_QUEUE_AGE", 0),
+                        app.config.get("ADMISSION_RETRY_AFTER", 1))
@@ -0,0 +1,188 @@
+"""
+Supplier name autocomplete
+
+PrefixIndex keeps the normalized names of suppliers in a sorted list so the
+names starting with a prefix are a contiguous range found by bisection.
+The best rated matches of wide ranges, which short prefixes produce, are
+cached until a write touches a name under that prefix. A stale index keeps
+answering while it is rebuilt, the writes made meanwhile are replayed onto
+the new contents.
+"""
+import re
+import time
+import heapq
+import bisect
+import threading
+import unicodedata
+from collections import OrderedDict
+
+
+def normalize(text):
+    """ Folds case, accents, punctuation and runs of whitespace out of a name """
+    text = unicodedata.normalize("NFKD", text or "")
+    text = "".join(char for char in text if not unicodedata.combining(char))
+    text = re.sub(r"[^\w\s]", "", text.lower())
+    return " ".join(text.split())
+
+
+class PrefixIndex:
+    """
+    An in-memory prefix index of supplier names
+
+    Args:
+        max_entries (int): the most suppliers kept, the best rated ones win
+        scan_limit (int): ranges wider than this have their results cached
+        cache_size (int): the most prefixes with cached results
+        refresh (int): seconds after which the index asks to be rebuilt,
+            0 to never expire
+    """
+
+    def __init__(self, max_entries=100000, scan_limit=2000, cache_size=1024, refresh=0):
+        self.max_entries = max_entries
+        self.scan_limit = scan_limit
+        self.cache_size = cache_size
+        self.refresh = refresh
+        self.built_at = None
+        self._keys = []       # sorted (normalized name, id)
+        self._entries = {}    # id -> (normalized name, name, rating)
+        self._ratings = []    # heap of (rating, id), entries since replaced are skipped
+        self._pending = None  # writes made during a rebuild
+        self._top = OrderedDict()
+        self._lock = threading.RLock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    @property
+    def stale(self):
+        """ True when the index was never built or is older than refresh seconds """
+        if self.built_at is None:
+            return True
+        return bool(self.refresh) and time.monotonic() - self.built_at > self.refresh
+
+    def begin_refresh(self):
+        """Marks the start of a rebuild, False when one is already running
+
+        Writes from now until build() or end_refresh() are replayed onto the
+        rebuilt contents, since the rows it is given may predate them.
+        """
+        with self._lock:
+            if self._pending is not None:
+                return False
+            self._pending = []
+            return True
+
+    def end_refresh(self):
+        """ Marks the end of a rebuild that did not call build() """
+        with self._lock:
+            self._pending = None
+
+    def build(self, rows):
+        """Replaces the index contents
+
+        Args:
+            rows: (id, name, rating) tuples, best rated first
+        """
+        entries = {}
+        for supplier_id, name, rating in rows:
+            if len(entries) >= self.max_entries:
+                break
+            entries[supplier_id] = (normalize(name), name, rating)
+        keys = sorted((entry[0], supplier_id) for supplier_id, entry in entries.items())
+        ratings = [(self._rating(entry), supplier_id) for supplier_id, entry in entries.items()]
+        heapq.heapify(ratings)
+        with self._lock:
+            self._entries = entries
+            self._keys = keys
+            self._ratings = ratings
+            self._top.clear()
+            pending, self._pending = self._pending or [], None
+            for action, record in pending:
+                self.on_write(action, record)
+            self.built_at = time.monotonic()
+            # warm the widest ranges so the first keystroke is answered from cache
+            for first in sorted({key[0][:1] for key in keys}):
+                self.search(first)
+
+    def add(self, supplier_id, name, rating):
+        """ Adds or replaces a supplier """
+        with self._lock:
+            self.remove(supplier_id)
+            if len(self._entries) >= self.max_entries:
+                lowest = self._lowest()
+                if lowest is None or lowest[0] >= (rating or 0.0):
+                    return
+                self.remove(lowest[1])
+            normalized = normalize(name)
+            self._entries[supplier_id] = (normalized, name, rating)
+            bisect.insort(self._keys, (normalized, supplier_id))
+            heapq.heappush(self._ratings, (rating or 0.0, supplier_id))
+            if len(self._ratings) > 2 * len(self._entries) + 64:
+                # drop the entries of replaced and removed suppliers
+                self._ratings = [(self._rating(entry), key) for key, entry in self._entries.items()]
+                heapq.heapify(self._ratings)
+            self._invalidate(normalized)
+
+    def remove(self, supplier_id):
+        """ Removes a supplier if it is indexed """
+        with self._lock:
+            entry = self._entries.pop(supplier_id, None)
+            if entry is None:
+                return
+            position = bisect.bisect_left(self._keys, (entry[0], supplier_id))
+            del self._keys[position]
+            self._invalidate(entry[0])
+
+    def search(self, prefix, limit=10):
+        """Returns the best rated suppliers whose name starts with prefix
+
+        Returns:
+            list of (id, name, rating) tuples, best rated first
+        """
+        prefix = normalize(prefix)
+        with self._lock:
+            cached = self._top.get(prefix)
+            if cached is not None and len(cached) >= limit:
+                self._top.move_to_end(prefix)
+                return cached[:limit]
+            low = bisect.bisect_left(self._keys, (prefix,))
+            high = bisect.bisect_left(self._keys, (prefix + "\uffff",), low)
+            wide = high - low > self.scan_limit
+            count = max(limit, 10) if wide else limit
+            ids = (supplier_id for _, supplier_id in self._keys[low:high])
+            best = heapq.nlargest(count, ids, key=lambda key: self._rating(self._entries[key]))
+            results = [(key, self._entries[key][1], self._entries[key][2]) for key in best]
+            if wide:
+                self._top[prefix] = results
+                while len(self._top) > self.cache_size:
+                    self._top.popitem(last=False)
+            return results[:limit]
+
+    def on_write(self, action, record):
+        """ Keeps the index current, registered as a Supplier write listener """
+        with self._lock:
+            if self._pending is not None:
+                self._pending.append((action, record))
+            if action == "delete":
+                self.remove(record["id"])
+            else:
+                self.add(record["id"], record["name"], record["rating"])
+
+    def _lowest(self):
+        """ Returns the (rating, id) of the lowest rated supplier, None when empty """
+        while self._ratings:
+            rating, supplier_id = self._ratings[0]
+            entry = self._entries.get(supplier_id)
+            if entry is not None and self._rating(entry) == rating:
+                return rating, supplier_id
+            heapq.heappop(self._ratings)
+        return None
+
+    def _invalidate(self, normalized):
+        """ Drops the cached results of every prefix of a name """
+        for end in range(len(normalized) + 1):
+            self._top.pop(normalized[:end], None)
+
+    @staticmethod
+    def _rating(entry):
+        return entry[2] if entry[2] is not None else 0.0
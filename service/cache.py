@@ -0,0 +1,200 @@
+"""
+In-process caches for the Supplier service
+
+TTLCache keeps a bounded number of entries that expire a fixed number of
+seconds after they were stored. It is safe to share between the threads of
+a worker.
+
+ResponseCache keeps encoded responses up to a total size, each tagged with
+the data generation it was computed at. The generation is a SharedCounter,
+a number in a memory mapped file that every process of a host writing
+Suppliers bumps after it commits, so an entry from before the latest write
+of any worker is never served.
+"""
+import os
+import mmap
+import time
+import fcntl
+import struct
+import tempfile
+import threading
+from collections import OrderedDict
+
+# Layout of a SharedCounter file
+COUNTER = struct.Struct("<Q")
+
+
+class TTLCache:
+    """ A size limited cache whose entries expire after ttl seconds """
+
+    def __init__(self, ttl, maxsize=256):
+        self.ttl = ttl
+        self.maxsize = maxsize
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        """ Returns the value stored under key if it has not expired """
+        with self._lock:
+            item = self._data.get(key)
+            if item is None:
+                return default
+            expires, value = item
+            if expires < time.monotonic():
+                del self._data[key]
+                return default
+            self._data.move_to_end(key)
+            return value
+
+    def set(self, key, value):
+        """ Stores value under key, evicting the least recently used entry if full """
+        if self.ttl <= 0:
+            return
+        with self._lock:
+            self._data[key] = (time.monotonic() + self.ttl, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def delete(self, key):
+        """ Removes the entry stored under key, if any """
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        """ Removes every entry """
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self):
+        return len(self._data)
+
+
+class SharedCounter:
+    """
+    A counter shared by the processes that map the same file
+
+    Reads are a plain load from the mapping, increments take a lock of the
+    file. The file is opened on first use.
+
+    Args:
+        path (string): the counter file, created if missing
+    """
+
+    def __init__(self, path=None):
+        self.path = path
+        self._map = None
+        self._fd = None
+        self._lock = threading.Lock()
+
+    def configure(self, path=None):
+        """ Switches to another counter file """
+        with self._lock:
+            if self._map is not None:
+                self._map.close()
+                os.close(self._fd)
+            self.path, self._map, self._fd = path, None, None
+
+    def _open(self):
+        with self._lock:
+            if self._map is None:
+                if self.path is None:
+                    directory = "/dev/shm" if os.path.isdir("/dev/shm") else tempfile.gettempdir()
+                    self.path = os.path.join(directory, "supplier-generation")
+                self._fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o600)
+                if os.fstat(self._fd).st_size < COUNTER.size:
+                    os.ftruncate(self._fd, COUNTER.size)
+                self._map = mmap.mmap(self._fd, COUNTER.size)
+        return self._map
+
+    @property
+    def value(self):
+        """ The current count """
+        return COUNTER.unpack_from(self._map or self._open())[0]
+
+    def bump(self):
+        """ Adds one to the count and returns it """
+        counter = self._map or self._open()
+        with self._lock:
+            fcntl.lockf(self._fd, fcntl.LOCK_EX, COUNTER.size)
+            try:
+                value = COUNTER.unpack_from(counter)[0] + 1
+                COUNTER.pack_into(counter, 0, value)
+            finally:
+                fcntl.lockf(self._fd, fcntl.LOCK_UN, COUNTER.size)
+        return value
+
+
+# Generation of the Supplier data, bumped after every committed write
+data_generation = SharedCounter()
+
+
+class ResponseCache:
+    """
+    A cache of encoded responses valid for one data generation
+
+    Args:
+        generation (SharedCounter): the data generation entries must match
+        max_bytes (int): the most body bytes kept, 0 disables the cache
+        ttl (float): seconds an entry is kept at most, 0 keeps it until the
+            generation changes
+        max_entry_bytes (int): the largest body kept, by default an eighth
+            of max_bytes
+    """
+
+    def __init__(self, generation, max_bytes, ttl=0, max_entry_bytes=None):
+        self.generation = generation
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.max_entry_bytes = max_entry_bytes if max_entry_bytes is not None else max_bytes // 8
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    @property
+    def enabled(self):
+        """ True when responses are cached """
+        return self.max_bytes > 0
+
+    def get(self, key):
+        """ Returns the (body, mimetype, headers) stored under key if it is current """
+        generation = self.generation.value
+        with self._lock:
+            item = self._data.get(key)
+            if item is not None:
+                stored, expires, response = item
+                if stored == generation and (expires is None or expires > time.monotonic()):
+                    self._data.move_to_end(key)
+                    self.hits += 1
+                    return response
+                self._remove(key)
+            self.misses += 1
+            return None
+
+    def set(self, key, generation, body, mimetype, headers=None):
+        """ Stores a response computed at a generation, evicting the least recently used """
+        if not self.enabled or len(body) > self.max_entry_bytes or generation != self.generation.value:
+            return
+        expires = time.monotonic() + self.ttl if self.ttl > 0 else None
+        with self._lock:
+            self._remove(key)
+            self._data[key] = (generation, expires, (body, mimetype, dict(headers or {})))
+            self.size += len(body)
+            while self.size > self.max_bytes:
+                self._remove(next(iter(self._data)))
+
+    def clear(self):
+        """ Removes every entry """
+        with self._lock:
+            self._data.clear()
+            self.size = 0
+
+    def _remove(self, key):
+        item = self._data.pop(key, None)
+        if item is not None:
+            self.size -= len(item[2][0])
+
+    def __len__(self):
+        return len(self._data)
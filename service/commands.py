@@ -0,0 +1,92 @@
+"""
+Management commands for the Supplier service
+
+Commands are registered on the Flask CLI and can be run with:
+  flask rollups reconcile
+  flask rollups reconcile --dry-run
+  flask rollups reconcile --since 2026-01-31T02:00:00
+  flask phones backfill --batch-size 1000
+  flask products migrate --batch-size 1000
+  flask changes prune --days 30
+"""
+from datetime import timezone
+import click
+from flask.cli import AppGroup
+from service.models import Supplier, ProductRollup, SupplierChange, SupplierProduct
+
+rollups_cli = AppGroup("rollups", help="Maintain the per product supplier rollups")
+phones_cli = AppGroup("phones", help="Maintain the normalized supplier phones")
+products_cli = AppGroup("products", help="Maintain the supplier_products table")
+changes_cli = AppGroup("changes", help="Maintain the supplier change log")
+
+
+@rollups_cli.command("reconcile")
+@click.option("--dry-run", is_flag=True, help="Only report drift, do not repair it")
+@click.option("--since", type=click.DateTime(), default=None,
+              help="Only check the products of suppliers written since this UTC time")
+def reconcile_rollups(dry_run, since):
+    """Reports rollup and change log drift from the supplier table and repairs it
+
+    With --since only the products touched by suppliers written since then
+    are checked, and only those that drifted are rebuilt. The change log is
+    checked for the writes since then, or since its oldest change, and
+    the missing changes are appended.
+    """
+    product_ids = None
+    if since is not None:
+        since = since.replace(tzinfo=timezone.utc)
+        product_ids = ProductRollup.touched(since)
+        click.echo("{} products touched since {}".format(len(product_ids), since.isoformat()))
+    drifted = ProductRollup.drift(product_ids=product_ids)
+    for product_id, stored, expected in drifted:
+        click.echo("product {}: stored {} expected {}".format(product_id, stored, expected))
+    click.echo("{} product rollups drifted".format(len(drifted)))
+    missing = SupplierChange.unlogged(since)
+    for action, supplier_id, _ in missing:
+        click.echo("supplier {}: {} missing from the change log".format(supplier_id, action))
+    click.echo("{} supplier changes missing".format(len(missing)))
+    if dry_run:
+        if drifted or missing:
+            raise SystemExit(1)
+        return
+    if product_ids is None:
+        ProductRollup.rebuild()
+        click.echo("Product rollups rebuilt")
+    elif drifted:
+        ProductRollup.rebuild([product_id for product_id, _, _ in drifted])
+        click.echo("{} product rollups rebuilt".format(len(drifted)))
+    if missing:
+        SupplierChange.repair(missing)
+        click.echo("{} supplier changes appended".format(len(missing)))
+
+
+@phones_cli.command("backfill")
+@click.option("--batch-size", default=1000, show_default=True, help="Rows updated per transaction")
+def backfill_phones(batch_size):
+    """ Normalizes the phones of suppliers saved before normalization existed """
+    updated = Supplier.backfill_phones(batch_size)
+    click.echo("{} supplier phones normalized".format(updated))
+
+
+@products_cli.command("migrate")
+@click.option("--batch-size", default=1000, show_default=True, help="Suppliers copied per transaction")
+def migrate_products(batch_size):
+    """ Copies the product_list arrays into the supplier_products table """
+    copied = SupplierProduct.migrate(batch_size)
+    click.echo("Products of {} suppliers copied".format(copied))
+
+
+@changes_cli.command("prune")
+@click.option("--days", default=30, show_default=True, help="Age in days of the oldest change kept")
+def prune_changes(days):
+    """ Deletes old entries of the supplier change log """
+    deleted = SupplierChange.prune(days)
+    click.echo("{} supplier changes deleted".format(deleted))
+
+
+def init_app(app):
+    """ Registers the commands on the Flask CLI """
+    app.cli.add_command(rollups_cli)
+    app.cli.add_command(phones_cli)
+    app.cli.add_command(products_cli)
+    app.cli.add_command(changes_cli)
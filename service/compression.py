@@ -0,0 +1,156 @@
+"""
+Response compression for the API routes
+
+Responses are compressed with the encoding the client prefers among br
+(when the brotli package is installed), gzip and deflate, as negotiated by
+its Accept-Encoding header. Bodies under a size threshold are sent as they
+are, since compressing a single Supplier costs more CPU than the bytes it
+saves. Streamed responses are compressed chunk by chunk, each chunk
+flushed so that streamed events are not held back by the compressor.
+
+Levels default to the fast end, which keeps most of the size reduction of
+JSON listings for a fraction of the CPU, see benchmarks/compression_bench.py.
+"""
+import zlib
+from flask import request
+from service.tracing import tracer
+
+try:
+    import brotli
+except ImportError:  # pragma: no cover
+    brotli = None
+
+# Encodings in the order they are chosen when the client likes them equally
+ENCODINGS = ("br", "gzip", "deflate") if brotli is not None else ("gzip", "deflate")
+
+# Media types worth compressing, by prefix
+COMPRESSIBLE_TYPES = ("application/json", "application/msgpack", "text/")
+
+
+class ZlibCompressor:
+    """ gzip or deflate (zlib format) compression of a body """
+
+    def __init__(self, encoding, level):
+        self._compressor = zlib.compressobj(level, zlib.DEFLATED, 31 if encoding == "gzip" else 15)
+
+    def compress(self, data):
+        """ Returns the compressed data ready so far """
+        return self._compressor.compress(data)
+
+    def flush(self):
+        """ Returns the rest of the data given so far, leaving the stream open """
+        return self._compressor.flush(zlib.Z_SYNC_FLUSH)
+
+    def finish(self):
+        """ Returns the end of the stream """
+        return self._compressor.flush(zlib.Z_FINISH)
+
+
+class BrotliCompressor:
+    """ Brotli compression of a body """
+
+    def __init__(self, quality):
+        self._compressor = brotli.Compressor(quality=quality)
+
+    def compress(self, data):
+        """ Returns the compressed data ready so far """
+        return self._compressor.process(data)
+
+    def flush(self):
+        """ Returns the rest of the data given so far, leaving the stream open """
+        return self._compressor.flush()
+
+    def finish(self):
+        """ Returns the end of the stream """
+        return self._compressor.finish()
+
+
+class Compression:
+    """
+    Compresses the responses of an app
+
+    Args:
+        min_size (int): the smallest body compressed, in bytes
+        level (int): the gzip and deflate level, 1 (fastest) to 9
+        brotli_quality (int): the brotli quality, 0 (fastest) to 11
+        prefix (string): the path prefix of the compressed routes
+    """
+
+    def __init__(self, min_size=2048, level=1, brotli_quality=1, prefix="/api"):
+        self.min_size = min_size
+        self.level = level
+        self.brotli_quality = brotli_quality
+        self.prefix = prefix
+
+    def choose(self, accept_encodings):
+        """ Returns the encoding to use for an Accept-Encoding header, None for none """
+        best, best_quality = None, 0
+        for encoding in ENCODINGS:
+            quality = accept_encodings.quality(encoding)
+            if quality > best_quality:
+                best, best_quality = encoding, quality
+        return best
+
+    def compressor(self, encoding):
+        """ Returns a new compressor for an encoding """
+        if encoding == "br":
+            return BrotliCompressor(self.brotli_quality)
+        return ZlibCompressor(encoding, self.level)
+
+    def compressible(self, response):
+        """ Returns True when the response may be sent compressed """
+        return (request.path.startswith(self.prefix)
+                and request.method != "HEAD"
+                and response.status_code >= 200
+                and response.status_code not in (204, 206, 304)
+                and not response.direct_passthrough
+                and "Content-Encoding" not in response.headers
+                and (response.mimetype or "").startswith(COMPRESSIBLE_TYPES))
+
+    def compress_response(self, response):
+        """ Compresses a response for the current request when it is worth it """
+        if not self.compressible(response):
+            return response
+        response.vary.add("Accept-Encoding")
+        encoding = self.choose(request.accept_encodings)
+        if encoding is None:
+            return response
+        if response.is_streamed:
+            response.response = compress_stream(response.response, self.compressor(encoding),
+                                                response.charset)
+            response.headers.pop("Content-Length", None)
+        else:
+            body = response.get_data()
+            if len(body) < self.min_size:
+                return response
+            with tracer.span("compress", encoding=encoding, size=len(body)):
+                compressor = self.compressor(encoding)
+                response.set_data(compressor.compress(body) + compressor.finish())
+        response.headers["Content-Encoding"] = encoding
+        return response
+
+
+def compress_stream(chunks, compressor, charset="utf-8"):
+    """ Compresses the chunks of a streamed body, flushing after each one """
+    try:
+        for chunk in chunks:
+            if isinstance(chunk, str):
+                chunk = chunk.encode(charset)
+            data = compressor.compress(chunk) + compressor.flush()
+            if data:
+                yield data
+        yield compressor.finish()
+    finally:
+        close = getattr(chunks, "close", None)
+        if close is not None:
+            close()
+
+
+def init_app(app):
+    """ Compresses the API responses of app as configured """
+    compression = Compression(app.config.get("COMPRESS_MIN_SIZE", 2048),
+                              app.config.get("COMPRESS_LEVEL", 1),
+                              app.config.get("COMPRESS_BROTLI_QUALITY", 1))
+    if compression.min_size >= 0:
+        app.after_request(compression.compress_response)
+    return compression
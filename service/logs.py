@@ -0,0 +1,210 @@
+"""
+Log pipeline of the Supplier service
+
+Records are put on a queue by the threads that log them and written out
+by a listener thread, so a request never waits on log I/O. Formatting is
+deferred to the listener as well: the message arguments of a record, such
+as a request payload, are only turned into text when the record is
+written, and not at all when it is sampled out or below the log level.
+
+SamplingFilter keeps a fraction of the records below WARNING of chosen
+loggers, and every record logged while serving a request carries the id
+of that request, which is also returned in the X-Request-Id header.
+"""
+import re
+import uuid
+import queue
+import atexit
+import random
+import logging
+from contextvars import ContextVar
+from datetime import datetime, timezone
+from logging.handlers import QueueHandler, QueueListener
+from flask import request
+from service.serializers import dumps
+
+# Id of the request being served by the current thread
+request_id = ContextVar("request_id", default=None)
+
+# Request ids accepted from the X-Request-Id header, others are replaced
+REQUEST_ID_PATTERN = re.compile(r"^[\w.:-]{1,128}$")
+
+# Attributes every record has, the others were passed with extra= and are
+# written as fields of their own
+RECORD_ATTRIBUTES = frozenset(vars(logging.LogRecord("", 0, "", 0, "", (), None))) \
+    | {"message", "asctime", "request_id"}
+
+
+class JSONFormatter(logging.Formatter):
+    """ Formats records as one JSON object per line """
+
+    def format(self, record):
+        entry = {
+            "time": datetime.fromtimestamp(record.created, timezone.utc).isoformat(),
+            "level": record.levelname,
+            "logger": record.name,
+            "module": record.module,
+            "message": record.getMessage(),
+        }
+        if getattr(record, "request_id", None) is not None:
+            entry["request_id"] = record.request_id
+        for key, value in vars(record).items():
+            if key not in RECORD_ATTRIBUTES:
+                entry[key] = value
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            entry["exception"] = record.exc_text
+        return dumps(entry, default=str).decode("utf-8")
+
+
+def parse_rates(text):
+    """Parses sampling rates written as logger=rate pairs separated by commas
+
+    Returns:
+        dict of logger name to the fraction of its records kept
+    """
+    rates = {}
+    for item in filter(None, (part.strip() for part in text.split(","))):
+        name, _, rate = item.partition("=")
+        try:
+            rates[name.strip()] = min(max(float(rate), 0.0), 1.0)
+        except ValueError:
+            raise ValueError("Invalid log sampling rate: {}".format(item))
+    return rates
+
+
+class SamplingFilter(logging.Filter):
+    """
+    Keeps a fraction of the records below WARNING of each logger
+
+    Args:
+        rates (dict): logger name to the fraction of records kept, which
+            applies to its child loggers too unless they have a rate of
+            their own. Loggers without a rate keep every record.
+    """
+
+    def __init__(self, rates):
+        super().__init__()
+        self.rates = dict(rates)
+        self._resolved = {}
+
+    def rate(self, name):
+        """ Returns the fraction of records of a logger that are kept """
+        rate = self._resolved.get(name)
+        if rate is None:
+            parent = name
+            while parent not in self.rates and "." in parent:
+                parent = parent.rpartition(".")[0]
+            rate = self._resolved[name] = self.rates.get(parent, 1.0)
+        return rate
+
+    def filter(self, record):
+        if record.levelno >= logging.WARNING:
+            return True
+        rate = self.rate(record.name)
+        return rate >= 1.0 or random.random() < rate
+
+
+class RequestIdFilter(logging.Filter):
+    """ Tags records with the id of the request being served """
+
+    def filter(self, record):
+        record.request_id = request_id.get()
+        return True
+
+
+class AsyncHandler(QueueHandler):
+    """
+    A QueueHandler that leaves formatting to the listener
+
+    Records are dropped and counted rather than blocking the caller when
+    the queue is full.
+    """
+
+    def __init__(self, records):
+        super().__init__(records)
+        self.dropped = 0
+
+    def prepare(self, record):
+        if record.exc_info:
+            # tracebacks hold the frames of this thread, render them here
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+class LogPipeline:
+    """
+    An AsyncHandler and the listener thread that drains its queue
+
+    Args:
+        handlers (list): the handlers that write the records
+        maxsize (int): the most records waiting to be written
+        rates (dict): sampling rates by logger name
+    """
+
+    def __init__(self, handlers, maxsize=10000, rates=None):
+        self.handler = AsyncHandler(queue.Queue(maxsize))
+        self.handler.addFilter(RequestIdFilter())
+        if rates:
+            self.handler.addFilter(SamplingFilter(rates))
+        self.listener = QueueListener(self.handler.queue, *handlers, respect_handler_level=True)
+        self.running = False
+
+    def start(self):
+        """ Starts the listener thread """
+        if not self.running:
+            self.listener.start()
+            self.running = True
+
+    def stop(self):
+        """ Writes the records still queued and stops the listener thread """
+        if self.running:
+            self.listener.stop()
+            self.running = False
+
+
+######################################################################
+#  R E Q U E S T   I D S
+######################################################################
+def start_request():
+    """ Sets the id of the request, taken from X-Request-Id when it is valid """
+    incoming = request.headers.get("X-Request-Id", "")
+    request_id.set(incoming if REQUEST_ID_PATTERN.match(incoming) else uuid.uuid4().hex)
+
+
+def tag_response(response):
+    """ Returns the request id to the client """
+    current = request_id.get()
+    if current is not None:
+        response.headers["X-Request-Id"] = current
+    return response
+
+
+def end_request(_error=None):
+    """ Clears the request id from the thread once the request is done """
+    request_id.set(None)
+
+
+def init_app(app, handlers):
+    """Routes the log records of app through a LogPipeline to handlers
+
+    Returns:
+        the started LogPipeline
+    """
+    pipeline = LogPipeline(handlers, app.config.get("LOG_QUEUE_SIZE", 10000),
+                           parse_rates(app.config.get("LOG_SAMPLE_RATES", "")))
+    app.logger.handlers = [pipeline.handler]
+    pipeline.start()
+    atexit.register(pipeline.stop)
+    app.before_request(start_request)
+    app.after_request(tag_response)
+    app.teardown_request(end_request)
+    return pipeline
@@ -12,27 +12,146 @@ Attributes:
 id (int): ID of the supplier
 name (string): Name of the supplier
 phone (string): Phone number of the supplier
+phone_normalized (string): Canonical form of the phone number used for lookups
 address (string): Address of the supplier
 availble (boolean): True for active supplier, False for inactive
 product_list (list of ints): List of product_id the supplier offers
 rating (float): Rating given to the supplier overall performance
+created_at (datetime): When the supplier was created
+updated_at (datetime): When the supplier row was last written
 """
 import os
+import re
+import time
+import heapq
 import logging
-from flask_sqlalchemy import SQLAlchemy
-from sqlalchemy.dialects.postgresql import ARRAY
+import itertools
+import select as select_module
+from sqlalchemy import DDL, FetchedValue, and_, any_, bindparam, event, func, literal_column, \
+    nullslast, or_, select, tuple_
+from sqlalchemy.exc import SQLAlchemyError
+from sqlalchemy.dialects.postgresql import ARRAY, JSONB, aggregate_order_by, insert
+from sqlalchemy.orm import validates
+from sqlalchemy.orm.attributes import set_committed_value
 from retry import retry
 from requests import HTTPError
+from service.replicas import RoutingSQLAlchemy, router
+from service.sharding import ID_SEQUENCE, allocate_id, router as shards, use_sessions
+from service.cache import data_generation
+from service.serializers import SUPPLIER_FIELDS, isoformat, serialize_rows
 
 # global variables for retry (must be int)
 RETRY_COUNT = int(os.environ.get("RETRY_COUNT", 10))
 RETRY_DELAY = int(os.environ.get("RETRY_DELAY", 1))
 RETRY_BACKOFF = int(os.environ.get("RETRY_BACKOFF", 2))
 
-logger = logging.getLogger("flask.app")
+logger = logging.getLogger("flask.app.models")
+
+# Upper bound of the supplier rating scale
+MAX_RATING = 5
+
+# Country calling code assumed for phone numbers written without one
+DEFAULT_COUNTRY_CODE = os.environ.get("DEFAULT_COUNTRY_CODE", "1")
+
+# Where supplier products are kept: array (the product_list column), dual
+# (both, read from the array) while migrating, or table (supplier_products)
+PRODUCT_STORAGE_MODES = ("array", "dual", "table")
+
+# Postgres channel notified when supplier changes are committed
+CHANGE_CHANNEL = "supplier_changes"
+
+# Statements that make every update of a supplier row set its updated_at,
+# including updates made outside the service
+TOUCH_TRIGGER = [
+    "CREATE OR REPLACE FUNCTION supplier_touch() RETURNS trigger AS $$ "
+    "BEGIN NEW.updated_at := now(); RETURN NEW; END $$ LANGUAGE plpgsql",
+    "DO $$ BEGIN "
+    "IF NOT EXISTS (SELECT 1 FROM pg_trigger "
+    "WHERE tgname = 'supplier_touch' AND tgrelid = 'supplier'::regclass) THEN "
+    "CREATE TRIGGER supplier_touch BEFORE UPDATE ON supplier "
+    "FOR EACH ROW EXECUTE PROCEDURE supplier_touch(); "
+    "END IF; END $$",
+]
+
+# Idempotent statements that bring tables created by older releases up to date
+SCHEMA_UPGRADES = [
+    "ALTER TABLE supplier ADD COLUMN IF NOT EXISTS phone_normalized VARCHAR(64)",
+    "DO $$ BEGIN "
+    "IF (SELECT character_maximum_length FROM information_schema.columns "
+    "WHERE table_name = 'supplier' AND column_name = 'phone_normalized') < 64 THEN "
+    "ALTER TABLE supplier ALTER COLUMN phone_normalized TYPE VARCHAR(64); "
+    "END IF; END $$",
+    "CREATE INDEX IF NOT EXISTS ix_supplier_phone_normalized ON supplier (phone_normalized)",
+    r"CREATE INDEX IF NOT EXISTS ix_supplier_name_folded "
+    r"ON supplier (lower(regexp_replace(btrim(name), '\s+', ' ', 'g')))",
+    r"CREATE INDEX IF NOT EXISTS ix_supplier_address_folded "
+    r"ON supplier (lower(regexp_replace(btrim(address), '\s+', ' ', 'g')))",
+    "ALTER TABLE supplier ADD COLUMN IF NOT EXISTS created_at "
+    "TIMESTAMP WITH TIME ZONE NOT NULL DEFAULT now()",
+    "ALTER TABLE supplier ADD COLUMN IF NOT EXISTS updated_at "
+    "TIMESTAMP WITH TIME ZONE NOT NULL DEFAULT now()",
+    "CREATE INDEX IF NOT EXISTS ix_supplier_created_at ON supplier (created_at)",
+    "CREATE INDEX IF NOT EXISTS ix_supplier_updated_at_id ON supplier (updated_at, id)",
+    "CREATE INDEX IF NOT EXISTS ix_supplier_rating_desc_id "
+    "ON supplier (rating DESC NULLS LAST, id DESC)",
+    "CREATE INDEX IF NOT EXISTS ix_supplier_available_rating_desc_id "
+    "ON supplier (available, rating DESC NULLS LAST, id DESC)",
+    "DROP INDEX IF EXISTS ix_supplier_rating_id",
+    "DROP INDEX IF EXISTS ix_supplier_available_rating_id",
+] + TOUCH_TRIGGER
 
 # Create the SQLAlchemy object to be initialized later in init_db()
-db = SQLAlchemy()
+db = RoutingSQLAlchemy()
+
+
+def id_array(ids):
+    """ Returns ids as a single integer array parameter """
+    return bindparam("ids", list(ids), type_=ARRAY(db.Integer), unique=True)
+
+
+def project(rows, query_fields, fields):
+    """ Returns the rows of query_fields columns cut down to fields, in that order """
+    if tuple(query_fields) == tuple(fields):
+        return [tuple(row) for row in rows]
+    indexes = [query_fields.index(field) for field in fields]
+    return [tuple(row[i] for i in indexes) for row in rows]
+
+
+def normalize_phone(phone):
+    """Returns the canonical form of a phone number
+
+    The canonical form is + followed by the country code and number digits,
+    with any extension appended after an x, e.g. +16201797652x914. Numbers
+    without a country code get DEFAULT_COUNTRY_CODE. Returns None when the
+    text holds no digits.
+    """
+    if not phone:
+        return None
+    match = re.match(r"^(.*?)(?:\s*(?:x|ext\.?|#)\s*(\d+))?\s*$", phone, re.IGNORECASE)
+    number, extension = match.group(1), match.group(2) or ""
+    digits = re.sub(r"\D", "", number)
+    if not digits:
+        return None
+    if not number.lstrip().startswith("+"):
+        if digits.startswith("00"):
+            digits = digits[2:]
+        elif len(digits) == 10:
+            digits = DEFAULT_COUNTRY_CODE + digits
+    return "+" + digits + ("x" + extension if extension else "")
+
+
+def fold(text):
+    """ Returns text lower cased with whitespace trimmed and runs collapsed, in SQL """
+    collapsed = func.regexp_replace(
+        func.btrim(text), literal_column(r"'\s+'"), literal_column("' '"), literal_column("'g'")
+    )
+    return func.lower(collapsed)
+
+
+def search_document(name, address):
+    """ Returns the full text search vector of a supplier name and address """
+    text = name.op("||")(literal_column("' '")).op("||")(address)
+    return func.to_tsvector(literal_column("'simple'"), text)
 
 class DataValidationError(Exception):
     """ Used for an data validation errors when deserializing """
@@ -45,6 +164,10 @@ class Supplier(db.Model):
     """
 
     app = None
+    trigram_search = False
+    product_storage = "array"
+    # Callbacks run after a write is committed, with the action and the record
+    write_listeners = []
 
     ##################################################
     # Table Schema
@@ -54,10 +177,34 @@ class Supplier(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     name = db.Column(db.String(63), nullable=False)
     phone = db.Column(db.String(63), nullable=False)
+    # + and the digits and extension of a phone, at most 64 characters
+    phone_normalized = db.Column(db.String(64), index=True)
     address = db.Column(db.String(63), nullable=False)
     available = db.Column(db.Boolean(), nullable=False, default=True)
     product_list = db.Column(ARRAY(db.Integer), nullable=True)
     rating = db.Column(db.Float)
+    created_at = db.Column(db.DateTime(timezone=True), nullable=False,
+                           server_default=func.now(), index=True)
+    # set by the supplier_touch trigger on every update
+    updated_at = db.Column(db.DateTime(timezone=True), nullable=False,
+                           server_default=func.now(), server_onupdate=FetchedValue())
+
+    # read the timestamps back from the INSERT and UPDATE statements
+    __mapper_args__ = {"eager_defaults": True}
+
+    # Indexes serving the sorted and top-k listings, with id as tie breaker.
+    # The rating ones are in the order of the best rated first listings,
+    # which put unrated suppliers last
+    __table_args__ = (
+        db.Index("ix_supplier_rating_desc_id", nullslast(rating.desc()), id.desc()),
+        db.Index("ix_supplier_name_id", name, id),
+        db.Index("ix_supplier_available_rating_desc_id", available, nullslast(rating.desc()), id.desc()),
+        db.Index("ix_supplier_product_list", product_list, postgresql_using="gin"),
+        db.Index("ix_supplier_search", search_document(name, address), postgresql_using="gin"),
+        db.Index("ix_supplier_name_folded", fold(name)),
+        db.Index("ix_supplier_address_folded", fold(address)),
+        db.Index("ix_supplier_updated_at_id", updated_at, id),
+    )
 
     def __repr__(self):
         return "<Supplier %r id=[%s]>" % (self.name, self.id)
@@ -74,9 +221,19 @@ class Supplier(db.Model):
         Creates a Supplier to the database
         """
         logger.info("Creating %s", self.name)
-        self.id = None  # id must be none to generate next primary key
+        # id must be none to generate next primary key, shards share one sequence
+        self.id = allocate_id(db.session) if shards.enabled else None
+        products = self._store_products()
         db.session.add(self)
+        db.session.flush()
+        self._restore_products(products)
+        SupplierProduct.track(self.id, None, products)
+        ProductRollup.track(None, self._stored_state())
+        record = self.serialize()
+        SupplierChange.append("create", self.id, record)
         db.session.commit()
+        data_generation.bump()
+        self._notify("create", record)
 
     @retry(
         HTTPError,
@@ -85,14 +242,40 @@ class Supplier(db.Model):
         tries=RETRY_COUNT,
         logger=logger,
     )
-    def update(self):
+    def update(self, action="update"):
         """
         Updates a Supplier to the database
+
+        Args:
+            action (string): the change recorded for the write, update or penalize
         """
         logger.info("Saving %s", self.name)
         if not self.id:
             raise DataValidationError("Update called with empty supplier id")
+        # the rollup deltas are taken between the stored rows before and
+        # after the write, the first read locks the row so concurrent
+        # writes of this supplier apply in turn
+        previous = self._stored_state()
+        if previous is None:
+            db.session.rollback()
+            raise DataValidationError("Supplier {} no longer exists".format(self.id))
+        products = self._store_products()
+        SupplierProduct.track(self.id, previous[0], products)
+        # flush first so the record carries the updated_at the trigger set
+        db.session.flush()
+        self._restore_products(products)
+        ProductRollup.track(previous, self._stored_state())
+        record = self.serialize()
+        SupplierChange.append(action, self.id, record)
         db.session.commit()
+        data_generation.bump()
+        self._notify(action, record)
+
+    def penalize(self):
+        """ Lowers the rating of a supplier by one, down to 0 """
+        logger.info("Penalizing %s", self.name)
+        self.rating = max((self.rating or 0) - 1, 0)
+        self.update(action="penalize")
 
     @retry(
         HTTPError,
@@ -104,8 +287,73 @@ class Supplier(db.Model):
     def delete(self):
         """ Removes a supplier from the data store """
         logger.info("Deleting %s", self.name)
+        ProductRollup.track(self._stored_state(), None)
+        record = self.serialize()
+        SupplierChange.append("delete", self.id, None)
         db.session.delete(self)
         db.session.commit()
+        data_generation.bump()
+        self._notify("delete", record)
+
+    @classmethod
+    def add_write_listener(cls, listener):
+        """Registers a callback for committed writes
+
+        Args:
+            listener (callable): called as listener(action, record) with
+                action one of create, update, penalize or delete and record
+                the serialized supplier
+        """
+        cls.write_listeners.append(listener)
+
+    def _notify(self, action, record):
+        """ Runs the write listeners, a failing listener does not fail the write """
+        for listener in self.write_listeners:
+            try:
+                listener(action, record)
+            except Exception:  # pylint: disable=broad-except
+                logger.exception("Write listener %r failed", listener)
+
+    def _store_products(self):
+        """Returns the product list being saved
+
+        In table storage the product_list column is left empty, the list is
+        only written to supplier_products.
+        """
+        products = self.product_list
+        if self.product_storage == "table" and products is not None:
+            self.product_list = None
+        return products
+
+    def _restore_products(self, products):
+        """ Puts back the product list table storage kept out of the flushed row """
+        if self.product_storage == "table":
+            set_committed_value(self, "product_list", products)
+
+    def _stored_state(self):
+        """Returns the stored (product_list, available, rating) counted in the rollups
+
+        The row stays locked until the transaction ends, so a concurrent
+        write of the same supplier waits and then reads this one's values.
+        Returns None when the supplier has been deleted.
+        """
+        table = self.__table__
+        product_list = table.c.product_list
+        if self.product_storage == "table":
+            product_list = SupplierProduct.aggregate(table.c.id)
+        stmt = select([product_list, table.c.available, table.c.rating]) \
+            .where(table.c.id == self.id).with_for_update(of=table)
+        if shards.enabled:
+            row = db.session.execute(stmt, shard_id=shards.shard_of(self.id)).first()
+        else:
+            row = db.session.execute(stmt).first()
+        return tuple(row) if row is not None else None
+
+    @validates("phone")
+    def validate_phone(self, _key, phone):
+        """ Keeps phone_normalized in step with every assignment of phone """
+        self.phone_normalized = normalize_phone(phone)
+        return phone
 
     def serialize(self):
         """ Serializes a supplier into a dictionary """
@@ -116,7 +364,9 @@ class Supplier(db.Model):
             "address": self.address,
             "available": self.available,
             "product_list": self.product_list,
-            "rating": self.rating}
+            "rating": self.rating,
+            "created_at": isoformat(self.created_at),
+            "updated_at": isoformat(self.updated_at)}
 
     def deserialize(self, data):
         """
@@ -147,11 +397,99 @@ class Supplier(db.Model):
         """ Initializes the database session """
         logger.info("Initializing database")
         cls.app = app
+        cls.product_storage = app.config.get("PRODUCT_STORAGE", "array")
+        if cls.product_storage not in PRODUCT_STORAGE_MODES:
+            raise DataValidationError("Invalid PRODUCT_STORAGE: " + cls.product_storage)
         print("inside init_db", app.config["SQLALCHEMY_DATABASE_URI"])
         # This is where we initialize SQLAlchemy from the Flask app
         db.init_app(app)
         app.app_context().push()
+        shard_uris = app.config.get("DATABASE_SHARD_URIS", [])
+        if shard_uris and cls.product_storage != "array":
+            raise DataValidationError("Sharding needs PRODUCT_STORAGE=array")
+        shards.configure(shard_uris, tables=[cls.__table__.name])
+        use_sessions(db)
         db.create_all()  # make our sqlalchemy tables
+        if shards.enabled:
+            db.session.execute("CREATE SEQUENCE IF NOT EXISTS {}".format(ID_SEQUENCE))
+            db.session.commit()
+            for engine in shards.engines.values():
+                db.metadata.create_all(bind=engine, tables=[cls.__table__])
+        router.configure(app.config.get("DATABASE_REPLICA_URIS", []),
+                         app.config.get("REPLICA_HEALTH_INTERVAL", 5))
+        cls.upgrade_schema()
+        cls.init_search()
+
+    @classmethod
+    def engines(cls):
+        """ Returns the engines that hold the supplier table """
+        return list(shards.engines.values()) if shards.enabled else [db.engine]
+
+    @classmethod
+    def upgrade_schema(cls):
+        """ Adds the columns and indexes missing from tables of older releases """
+        for engine in cls.engines():
+            with engine.begin() as connection:
+                for statement in SCHEMA_UPGRADES:
+                    connection.execute(statement)
+
+    @classmethod
+    def backfill_phones(cls, batch_size=1000):
+        """Normalizes the phone of suppliers saved before phone_normalized existed
+
+        Rows are updated in batches of batch_size, each in its own transaction,
+        so the table is never locked for long. Each shard is done in turn.
+
+        Returns:
+            the number of suppliers updated
+        """
+        table = cls.__table__
+        updated = 0
+        for bind in cls.engines():
+            last_id = 0
+            while True:
+                rows = db.session.execute(
+                    select([table.c.id, table.c.phone])
+                    .where(and_(table.c.id > last_id, table.c.phone_normalized.is_(None)))
+                    .order_by(table.c.id)
+                    .limit(batch_size),
+                    bind=bind,
+                ).fetchall()
+                if not rows:
+                    break
+                db.session.execute(
+                    table.update().where(table.c.id == bindparam("row_id")),
+                    [{"row_id": row.id, "phone_normalized": normalize_phone(row.phone)}
+                     for row in rows],
+                    bind=bind,
+                )
+                db.session.commit()
+                data_generation.bump()
+                updated += len(rows)
+                last_id = rows[-1].id
+                logger.info("Normalized %d phones, up to id %s", updated, last_id)
+        return updated
+
+    @classmethod
+    def init_search(cls):
+        """Enables trigram search on name and address
+
+        Needs the pg_trgm extension. Without it, search only uses the full
+        text index.
+        """
+        try:
+            for engine in cls.engines():
+                with engine.begin() as connection:
+                    connection.execute("CREATE EXTENSION IF NOT EXISTS pg_trgm")
+                    for column in ("name", "address"):
+                        connection.execute(
+                            "CREATE INDEX IF NOT EXISTS ix_supplier_{0}_trgm "
+                            "ON {1} USING gin ({0} gin_trgm_ops)".format(column, cls.__table__.name)
+                        )
+            cls.trigram_search = True
+        except SQLAlchemyError as error:
+            logger.warning("Trigram search disabled: %s", error.orig)
+            cls.trigram_search = False
 
     @classmethod
     @retry(
@@ -200,14 +538,15 @@ class Supplier(db.Model):
         tries=RETRY_COUNT,
         logger=logger,
     )
-    def find_by_name(cls, name):
+    def find_by_name(cls, name, insensitive=False):
         """Returns all suppliers with the given name
 
         Args:
             name (string): the name of the supplier you want to match
+            insensitive (bool): True to ignore case and extra whitespace
         """
         logger.info("Processing name query for %s ...", name)
-        return cls.query.filter(cls.name == name)
+        return cls.query.filter(cls.text_match(cls.name, name, insensitive))
 
     @classmethod
     @retry(
@@ -218,11 +557,11 @@ class Supplier(db.Model):
         logger=logger,
     )
     def find_by_phone(cls, phone):
-        """Returns all suppliers with the given phone number
+        """Returns all suppliers with the given phone number, in any format
 
         """
         logger.info("Processing phone query for %s ...", phone)
-        return cls.query.filter(cls.phone == phone)
+        return cls.query.filter(cls.phone_match(phone))
 
     @classmethod
     @retry(
@@ -232,12 +571,15 @@ class Supplier(db.Model):
         tries=RETRY_COUNT,
         logger=logger,
     )
-    def find_by_address(cls, address):
+    def find_by_address(cls, address, insensitive=False):
         """Returns all suppliers with the given address
 
+        Args:
+            address (string): the address of the supplier you want to match
+            insensitive (bool): True to ignore case and extra whitespace
         """
         logger.info("Processing address query for %s ...", address)
-        return cls.query.filter(cls.address == address)
+        return cls.query.filter(cls.text_match(cls.address, address, insensitive))
 
     @classmethod
     @retry(
@@ -263,7 +605,7 @@ class Supplier(db.Model):
     def find_by_product(cls, product_id):
         """ Return all suppliers with given produce id """
         logger.info("Processing product_id query for %d ...", product_id)
-        return cls.query.filter(cls.product_list.contains([product_id])).all()
+        return cls.query.filter(cls.product_match(product_id)).all()
 
     @classmethod
     @retry(
@@ -277,4 +619,843 @@ class Supplier(db.Model):
         """Return all suppliers with rating grater than given rating """
         logger.info("Processing greater rating query for %d ...", rating)
         return cls.query.filter(cls.rating >= rating)
-    
\ No newline at end of file
+
+    ##################################################
+    # Read-only row queries
+    ##################################################
+
+    @classmethod
+    def columns(cls, fields=SUPPLIER_FIELDS):
+        """Returns the table columns for the given field names
+
+        In table storage product_list is aggregated from supplier_products.
+        """
+        columns = [cls.__table__.c[field] for field in fields]
+        if cls.product_storage == "table" and "product_list" in fields:
+            columns[fields.index("product_list")] = SupplierProduct.aggregate(cls.id)
+        return columns
+
+    @classmethod
+    def criteria(cls, name=None, phone=None, address=None, available=None,
+                 rating=None, product_id=None, q=None, match="exact", updated_since=None):
+        """Returns the filter clauses for the given query arguments
+
+        Arguments left as None are not filtered on. match is exact or
+        insensitive, the latter ignoring case and extra whitespace in name
+        and address. updated_since keeps the suppliers written at or after
+        that datetime.
+        """
+        insensitive = match == "insensitive"
+        clauses = []
+        if name is not None:
+            clauses.append(cls.text_match(cls.name, name, insensitive))
+        if phone is not None:
+            clauses.append(cls.phone_match(phone))
+        if address is not None:
+            clauses.append(cls.text_match(cls.address, address, insensitive))
+        if available is not None:
+            clauses.append(cls.available == available)
+        if rating is not None:
+            clauses.append(cls.rating >= rating)
+        if product_id is not None:
+            clauses.append(cls.product_match(product_id))
+        if q is not None:
+            clauses.append(cls.search_match(q))
+        if updated_since is not None:
+            clauses.append(cls.updated_at >= updated_since)
+        return clauses
+
+    @staticmethod
+    def text_match(column, value, insensitive=False):
+        """Returns the clause comparing a text column with value
+
+        The insensitive comparison folds both sides the same way as the
+        expression indexes on name and address so it stays an index lookup.
+        """
+        if insensitive:
+            return fold(column) == fold(value)
+        return column == value
+
+    @classmethod
+    def product_match(cls, product_id):
+        """ Returns the clause matching suppliers that offer a product """
+        if cls.product_storage == "table":
+            return cls.id.in_(
+                select([SupplierProduct.supplier_id]).where(SupplierProduct.product_id == product_id)
+            )
+        return cls.product_list.contains([product_id])
+
+    @classmethod
+    def product_offers(cls, where=None):
+        """ Returns a select of (supplier_id, product_id) pairs of the matching suppliers """
+        if cls.product_storage == "table":
+            stmt = select([SupplierProduct.supplier_id, SupplierProduct.product_id])
+            if where is not None:
+                stmt = stmt.where(SupplierProduct.supplier_id.in_(select([cls.id]).where(where)))
+            return stmt
+        stmt = select([cls.id.label("supplier_id"), func.unnest(cls.product_list).label("product_id")])
+        return stmt.where(where) if where is not None else stmt
+
+    @classmethod
+    def phone_match(cls, phone):
+        """ Returns the clause matching suppliers through the normalized phone index """
+        normalized = normalize_phone(phone)
+        if normalized is None:
+            return cls.phone == phone
+        return cls.phone_normalized == normalized
+
+    @classmethod
+    def search_query(cls, q):
+        """ Returns the full text query matching every word of q as a prefix """
+        terms = " & ".join("{}:*".format(word) for word in re.findall(r"\w+", q.lower()))
+        return func.to_tsquery(literal_column("'simple'"), terms)
+
+    @classmethod
+    def search_match(cls, q):
+        """Returns the clause matching suppliers whose name or address resemble q
+
+        Matches words by prefix through the full text index, and misspellings
+        through the trigram indexes when pg_trgm is installed.
+        """
+        clauses = [search_document(cls.name, cls.address).op("@@")(cls.search_query(q))]
+        if cls.trigram_search:
+            clauses += [cls.name.op("%")(q), cls.address.op("%")(q)]
+        return or_(*clauses)
+
+    @classmethod
+    def search_rank(cls, q):
+        """ Returns the relevance of a supplier to the search text, higher first """
+        rank = func.ts_rank(search_document(cls.name, cls.address), cls.search_query(q))
+        if cls.trigram_search:
+            rank = rank + func.greatest(func.similarity(cls.name, q), func.similarity(cls.address, q))
+        return rank
+
+    @classmethod
+    @retry(
+        HTTPError,
+        delay=RETRY_DELAY,
+        backoff=RETRY_BACKOFF,
+        tries=RETRY_COUNT,
+        logger=logger,
+    )
+    def find_rows(cls, fields=SUPPLIER_FIELDS, **options):
+        """Returns the matching suppliers as read-only tuples
+
+        The columns are selected directly so no ORM instances are built and
+        nothing is added to the session identity map.
+
+        Args:
+            fields (tuple): the columns to select, in order
+            options: sort and paging options and query arguments accepted
+                by select_rows()
+        """
+        logger.info("Processing row query for %s ...", options)
+        if shards.enabled:
+            return cls.gather_rows(tuple(fields), **options)
+        stmt = cls.select_rows(fields, **options)
+        return [tuple(row) for row in db.session.execute(stmt)]
+
+    @classmethod
+    def gather_rows(cls, fields=SUPPLIER_FIELDS, sort=None, descending=False,
+                    limit=None, offset=None, **filters):
+        """Runs find_rows() on every shard in parallel and merges the results
+
+        Each shard returns its first offset + limit rows in the requested
+        order, which are merged and paged here. Listings that are neither
+        sorted nor searched are ordered by id so their pages are stable.
+        """
+        offset = offset or 0
+        stop = None if limit is None else offset + limit
+        if sort is None and filters.get("q") is None:
+            sort = "id"
+        keys = (sort, "id") if sort else ("id",)
+        query_fields = tuple(dict.fromkeys(fields + keys))
+        stmt = cls.select_rows(query_fields, sort, descending, stop, **filters)
+        ident = query_fields.index("id")
+        if sort is None:
+            # search results, by relevance and then id
+            stmt = stmt.column(cls.search_rank(filters["q"]).label("rank"))
+            key, descending = (lambda row: (-row[-1], row[ident])), False
+        else:
+            position = query_fields.index(sort)
+            # NULL ratings sort last in both orders, as in select_rows()
+            nulls = (lambda value: value is not None) if descending else (lambda value: value is None)
+            key = lambda row: (nulls(row[position]), row[position], row[ident])
+        merged = heapq.merge(*shards.gather(stmt), key=key, reverse=descending)
+        rows = (row[:len(query_fields)] for row in itertools.islice(merged, offset, stop))
+        return project(rows, query_fields, fields)
+
+    @classmethod
+    def select_rows(cls, fields=SUPPLIER_FIELDS, sort=None, descending=False,
+                    limit=None, offset=None, **filters):
+        """Builds the select statement behind find_rows()
+
+        Args:
+            fields (tuple): the columns to select, in order
+            sort (string): the column to order by, one of id, name, rating
+                or updated_at, unrated suppliers come last in both orders,
+                search results are ordered by relevance when it is None,
+                and pages of other listings by id as in gather_rows()
+            descending (bool): True to sort from the highest value down
+            limit (int): the maximum number of rows to return
+            offset (int): the number of rows to skip
+            filters: query arguments accepted by criteria()
+        """
+        stmt = select(cls.columns(fields)).where(and_(*cls.criteria(**filters)))
+        if sort is None and filters.get("q") is None and (limit is not None or offset):
+            sort = "id"
+        if sort is None and filters.get("q") is not None:
+            stmt = stmt.order_by(cls.search_rank(filters["q"]).desc(), cls.__table__.c.id)
+        if sort is not None:
+            keys = [cls.__table__.c[sort]]
+            if sort == "name" and shards.enabled:
+                # byte order, which the merge of the shard results compares in
+                keys = [keys[0].collate("C")]
+            if sort != "id":
+                keys.append(cls.__table__.c.id)
+            keys = [key.desc() if descending else key for key in keys]
+            if sort == "rating" and descending:
+                keys[0] = nullslast(keys[0])
+            stmt = stmt.order_by(*keys)
+        if limit is not None:
+            stmt = stmt.limit(limit)
+        if offset:
+            stmt = stmt.offset(offset)
+        return stmt
+
+    @classmethod
+    @retry(
+        HTTPError,
+        delay=RETRY_DELAY,
+        backoff=RETRY_BACKOFF,
+        tries=RETRY_COUNT,
+        logger=logger,
+    )
+    def find_rows_by_ids(cls, supplier_ids, fields=SUPPLIER_FIELDS):
+        """Finds many suppliers by ID with one query and returns them as tuples
+
+        The rows come back in ID order, IDs that do not exist are left out.
+        """
+        logger.info("Processing row lookup for %d ids ...", len(supplier_ids))
+        if not shards.enabled:
+            stmt = select(cls.columns(fields)).where(cls.id == any_(id_array(supplier_ids))) \
+                .order_by(cls.id)
+            return [tuple(row) for row in db.session.execute(stmt)]
+        query_fields = tuple(dict.fromkeys(("id",) + tuple(fields)))
+        statements = {
+            shard_id: select(cls.columns(query_fields)).where(cls.id == any_(id_array(ids)))
+            for shard_id, ids in shards.group(supplier_ids).items()
+        }
+        rows = sorted(itertools.chain.from_iterable(shards.gather(statements)))
+        return project(rows, query_fields, fields)
+
+    @classmethod
+    @retry(
+        HTTPError,
+        delay=RETRY_DELAY,
+        backoff=RETRY_BACKOFF,
+        tries=RETRY_COUNT,
+        logger=logger,
+    )
+    def find_offers(cls, product_ids, limit=None, offset=None):
+        """Returns the (product_id, supplier_id) pairs of many products
+
+        A single query finds the suppliers offering any of the products: an
+        overlap search on the product_list index whose arrays are unnested
+        and narrowed to the requested products, or an index range scan of
+        supplier_products in table storage. A product listed twice by a
+        supplier gives one pair. Pairs are ordered by product and then
+        supplier so pages are stable.
+
+        Args:
+            product_ids (list): the products to look up
+            limit (int): the maximum number of pairs to return
+            offset (int): the number of pairs to skip
+        """
+        logger.info("Processing offers query for %d products ...", len(product_ids))
+        products = id_array(product_ids)
+        if cls.product_storage == "table":
+            product_id, supplier_id = SupplierProduct.product_id, SupplierProduct.supplier_id
+            stmt = select([product_id, supplier_id]).where(product_id == any_(products))
+        else:
+            offers = cls.product_offers(cls.product_list.overlap(products)).alias("offers")
+            product_id, supplier_id = offers.c.product_id, offers.c.supplier_id
+            stmt = select([product_id, supplier_id]).where(product_id == any_(products)).distinct()
+        stmt = stmt.order_by(product_id, supplier_id)
+        if shards.enabled:
+            stop = None if limit is None else (offset or 0) + limit
+            merged = heapq.merge(*shards.gather(stmt.limit(stop)))
+            return list(itertools.islice(merged, offset or 0, stop))
+        stmt = stmt.limit(limit)
+        if offset:
+            stmt = stmt.offset(offset)
+        return [tuple(row) for row in db.session.execute(stmt)]
+
+    @classmethod
+    def changed_since(cls, since):
+        """Returns the ids of the suppliers written at or after a datetime
+
+        Existing suppliers are found through the updated_at index and deleted
+        ones through the change log.
+        """
+        stmt = select([cls.id]).where(cls.updated_at >= since)
+        if shards.enabled:
+            rows = itertools.chain.from_iterable(shards.gather(stmt))
+        else:
+            rows = db.session.execute(stmt)
+        supplier_ids = {row[0] for row in rows}
+        logged = select([SupplierChange.supplier_id]).where(SupplierChange.changed_at >= since)
+        supplier_ids.update(row[0] for row in db.session.execute(logged.distinct()))
+        return supplier_ids
+
+    @classmethod
+    @retry(
+        HTTPError,
+        delay=RETRY_DELAY,
+        backoff=RETRY_BACKOFF,
+        tries=RETRY_COUNT,
+        logger=logger,
+    )
+    def stats(cls, buckets=5, **filters):
+        """Returns aggregate statistics of the matching suppliers
+
+        Counts by availability and the rating histogram come from a single
+        GROUP BY pass, and the per product counts from one pass over the
+        unnested product lists, counting a supplier once per product.
+
+        Args:
+            buckets (int): the number of rating histogram buckets over 0 to 5
+            filters: query arguments accepted by criteria()
+        """
+        logger.info("Processing stats query for %s ...", filters)
+        where = and_(*cls.criteria(**filters))
+        bucket = func.width_bucket(cls.rating, 0, MAX_RATING, buckets).label("bucket")
+        groups_stmt = select([cls.available, bucket, func.count(), func.sum(cls.rating),
+                              func.count(cls.rating)]) \
+            .where(where) \
+            .group_by(cls.available, bucket)
+        products = cls.product_offers(where).alias()
+        products_stmt = select([products.c.product_id, func.count(products.c.supplier_id.distinct())]) \
+            .group_by(products.c.product_id) \
+            .order_by(products.c.product_id)
+        if shards.enabled:
+            # the groups of every shard are added up below like those of one
+            groups = list(itertools.chain.from_iterable(shards.gather(groups_stmt)))
+            counts = {}
+            for product_id, count in itertools.chain.from_iterable(shards.gather(products_stmt)):
+                counts[product_id] = counts.get(product_id, 0) + count
+            product_counts = sorted(counts.items())
+        else:
+            groups = db.session.execute(groups_stmt).fetchall()
+            product_counts = db.session.execute(products_stmt).fetchall()
+
+        histogram = [0] * buckets
+        available = {True: 0, False: 0}
+        rating_sum, rated = 0.0, 0
+        for is_available, number, count, total, count_rated in groups:
+            available[is_available] += count
+            if number is not None:
+                # a rating of exactly MAX_RATING falls into the overflow bucket
+                histogram[min(max(number, 1), buckets) - 1] += count
+                rating_sum += total
+                rated += count_rated
+        width = MAX_RATING / buckets
+        return {
+            "count": available[True] + available[False],
+            "available_count": available[True],
+            "unavailable_count": available[False],
+            "average_rating": rating_sum / rated if rated else None,
+            "rating_histogram": [
+                {"min": i * width, "max": (i + 1) * width, "count": count}
+                for i, count in enumerate(histogram)
+            ],
+            "products": [
+                {"product_id": product_id, "supplier_count": count}
+                for product_id, count in product_counts
+            ],
+        }
+
+
+class ProductRollup(db.Model):
+    """
+    Per product supplier summary
+
+    Every Supplier write adjusts the rows of the products it offers in the
+    same transaction, so reading the summary of a product is a primary key
+    lookup. rebuild() recomputes the table from the suppliers.
+    """
+
+    __tablename__ = "product_rollup"
+
+    product_id = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    supplier_count = db.Column(db.Integer, nullable=False, default=0)
+    available_count = db.Column(db.Integer, nullable=False, default=0)
+    rating_sum = db.Column(db.Float, nullable=False, default=0)
+
+    def __repr__(self):
+        return "<ProductRollup product_id=[%s] suppliers=%s>" % (self.product_id, self.supplier_count)
+
+    def serialize(self):
+        """ Serializes a product rollup into a dictionary """
+        return {
+            "product_id": self.product_id,
+            "supplier_count": self.supplier_count,
+            "available_count": self.available_count,
+            "rating_sum": self.rating_sum,
+            "average_rating": self.rating_sum / self.supplier_count if self.supplier_count else None,
+        }
+
+    @classmethod
+    def track(cls, old, new):
+        """Applies the change of one supplier to the rollups
+
+        Args:
+            old (tuple): the (product_list, available, rating) before the
+                change, or None for a new supplier
+            new (tuple): the values after the change, or None for a
+                deleted supplier
+        """
+        deltas = {}
+        for state, sign in ((old, -1), (new, 1)):
+            if state is None:
+                continue
+            product_list, available, rating = state
+            for product_id in set(product_list or ()):
+                delta = deltas.setdefault(product_id, [0, 0, 0.0])
+                delta[0] += sign
+                delta[1] += sign if available else 0
+                delta[2] += sign * (rating or 0.0)
+        rows = [
+            {"product_id": product_id, "supplier_count": delta[0],
+             "available_count": delta[1], "rating_sum": delta[2]}
+            for product_id, delta in sorted(deltas.items())  # fixed lock order
+            if any(delta)
+        ]
+        if not rows:
+            return
+        table = cls.__table__
+        stmt = insert(table).values(rows)
+        stmt = stmt.on_conflict_do_update(
+            index_elements=[table.c.product_id],
+            set_={
+                "supplier_count": table.c.supplier_count + stmt.excluded.supplier_count,
+                "available_count": table.c.available_count + stmt.excluded.available_count,
+                "rating_sum": table.c.rating_sum + stmt.excluded.rating_sum,
+            },
+        )
+        db.session.execute(stmt)
+
+    @classmethod
+    def find(cls, product_id):
+        """ Finds the rollup of a product by it's ID """
+        logger.info("Processing rollup lookup for product %s ...", product_id)
+        return cls.query.get(product_id)
+
+    @classmethod
+    def all(cls):
+        """ Returns the rollups of every product """
+        logger.info("Processing all product rollups")
+        return cls.query.filter(cls.supplier_count > 0).order_by(cls.product_id).all()
+
+    @classmethod
+    def computed(cls, product_ids=None):
+        """Returns a select of the rollups computed from the supplier table
+
+        Args:
+            product_ids (iterable): the products to compute, None for all
+        """
+        where = None
+        if product_ids is not None and Supplier.product_storage != "table":
+            where = Supplier.product_list.overlap(id_array(product_ids))
+        products = Supplier.product_offers(where).alias("products")
+        offers = select([
+            Supplier.id, Supplier.available, Supplier.rating, products.c.product_id,
+        ]).select_from(
+            Supplier.__table__.join(products, products.c.supplier_id == Supplier.id)
+        ).distinct()
+        if product_ids is not None:
+            offers = offers.where(products.c.product_id == any_(id_array(product_ids)))
+        offers = offers.alias("offers")
+        return select([
+            offers.c.product_id,
+            func.count().label("supplier_count"),
+            func.count().filter(offers.c.available).label("available_count"),
+            func.coalesce(func.sum(offers.c.rating), 0.0).label("rating_sum"),
+        ]).group_by(offers.c.product_id)
+
+    @classmethod
+    def expected(cls, product_ids=None):
+        """ Returns the computed rollups as product_id: (supplier_count, available_count, rating_sum) """
+        stmt = cls.computed(product_ids)
+        if not shards.enabled:
+            return {row[0]: tuple(row[1:]) for row in db.session.execute(stmt)}
+        expected = {}
+        for product_id, suppliers, available, rating_sum in \
+                itertools.chain.from_iterable(shards.gather(stmt)):
+            have = expected.get(product_id, (0, 0, 0.0))
+            expected[product_id] = (have[0] + suppliers, have[1] + available, have[2] + rating_sum)
+        return expected
+
+    @classmethod
+    def touched(cls, since):
+        """Returns the products whose rollups writes since a datetime can have changed
+
+        Those are the products offered by the suppliers written since then,
+        now, in the changes logged since then, or in the last change logged
+        before it, which holds the products a later write may have removed.
+        """
+        supplier_ids = Supplier.changed_since(since)
+        if not supplier_ids:
+            return set()
+        offers = Supplier.product_offers(Supplier.id == any_(id_array(supplier_ids)))
+        if shards.enabled:
+            rows = itertools.chain.from_iterable(shards.gather(offers))
+        else:
+            rows = db.session.execute(offers)
+        product_ids = {row[1] for row in rows}
+        change = SupplierChange.__table__
+        logged = and_(change.c.supplier_id == any_(id_array(supplier_ids)), change.c.record.isnot(None))
+        recent = select([change.c.record]).where(and_(logged, change.c.changed_at >= since))
+        before = select([change.c.record]) \
+            .where(and_(logged, change.c.changed_at < since)) \
+            .distinct(change.c.supplier_id) \
+            .order_by(change.c.supplier_id, change.c.id.desc())
+        for stmt in (recent, before):
+            for (record,) in db.session.execute(stmt):
+                product_ids.update(record.get("product_list") or ())
+        return product_ids
+
+    @classmethod
+    def drift(cls, tolerance=1e-6, product_ids=None):
+        """Compares the rollups with the supplier table
+
+        Args:
+            tolerance (float): the largest rating_sum difference ignored
+            product_ids (iterable): the products to compare, None for all
+
+        Returns:
+            list of (product_id, stored, expected) for every product whose
+            stored counts differ, where stored and expected are
+            (supplier_count, available_count, rating_sum) tuples
+        """
+        if product_ids is not None:
+            product_ids = sorted(product_ids)
+            if not product_ids:
+                return []
+        expected = cls.expected(product_ids)
+        query = cls.query
+        if product_ids is not None:
+            query = query.filter(cls.product_id == any_(id_array(product_ids)))
+        stored = {
+            row.product_id: (row.supplier_count, row.available_count, row.rating_sum)
+            for row in query.all()
+        }
+        empty = (0, 0, 0.0)
+        drifted = []
+        for product_id in sorted(set(expected) | set(stored)):
+            have = stored.get(product_id, empty)
+            want = expected.get(product_id, empty)
+            if have[:2] != want[:2] or abs(have[2] - want[2]) > tolerance:
+                drifted.append((product_id, have, want))
+        return drifted
+
+    @classmethod
+    def rebuild(cls, product_ids=None):
+        """Recomputes the rollups from the supplier table
+
+        Args:
+            product_ids (iterable): the products to recompute, None for all
+        """
+        logger.info("Rebuilding product rollups")
+        if product_ids is not None:
+            product_ids = sorted(product_ids)
+            if not product_ids:
+                return
+        table = cls.__table__
+        # block concurrent supplier writes from adjusting the rows mid rebuild
+        db.session.execute("LOCK TABLE {} IN EXCLUSIVE MODE".format(table.name))
+        delete = table.delete()
+        if product_ids is not None:
+            delete = delete.where(table.c.product_id == any_(id_array(product_ids)))
+        db.session.execute(delete)
+        columns = ["product_id", "supplier_count", "available_count", "rating_sum"]
+        if shards.enabled:
+            rows = [dict(zip(columns, (product_id,) + counts))
+                    for product_id, counts in sorted(cls.expected(product_ids).items())]
+            if rows:
+                db.session.execute(table.insert().values(rows))
+        else:
+            db.session.execute(table.insert().from_select(columns, cls.computed(product_ids)))
+        db.session.commit()
+
+
+class SupplierChange(db.Model):
+    """
+    Append-only log of Supplier writes
+
+    Every create, update, penalize and delete appends a row in the same
+    transaction as the write, holding the supplier as written or no record
+    for a delete. Changes are read in (txid, id) order and only once the
+    transactions before them have finished, so a cursor never skips a
+    change that commits late.
+    """
+
+    __tablename__ = "supplier_change"
+
+    id = db.Column(db.BigInteger, primary_key=True)
+    txid = db.Column(db.BigInteger, nullable=False, server_default=func.txid_current())
+    supplier_id = db.Column(db.Integer, nullable=False)
+    action = db.Column(db.String(16), nullable=False)
+    record = db.Column(JSONB, nullable=True)
+    changed_at = db.Column(db.DateTime(timezone=True), nullable=False, server_default=func.now())
+
+    __table_args__ = (
+        db.Index("ix_supplier_change_txid_id", txid, id),
+    )
+
+    def __repr__(self):
+        return "<SupplierChange %s supplier_id=[%s] id=[%s]>" % (self.action, self.supplier_id, self.id)
+
+    @classmethod
+    def append(cls, action, supplier_id, record):
+        """ Records a write in the current transaction, consumers are notified on commit """
+        db.session.execute(cls.__table__.insert().values(
+            supplier_id=supplier_id, action=action, record=record
+        ))
+        db.session.execute("NOTIFY {}".format(CHANGE_CHANNEL))
+
+    @staticmethod
+    def parse_cursor(cursor):
+        """ Returns the (txid, id) position of a cursor, (0, 0) for the start """
+        if not cursor:
+            return (0, 0)
+        try:
+            txid, change_id = (int(part) for part in cursor.split("-"))
+        except ValueError:
+            raise DataValidationError("Invalid change cursor: {}".format(cursor))
+        return (txid, change_id)
+
+    @classmethod
+    def since(cls, cursor=None, limit=100):
+        """Returns the changes after a cursor
+
+        Returns:
+            list of dictionaries with the cursor of each change, oldest first
+        """
+        table = cls.__table__
+        position = cls.parse_cursor(cursor)
+        stmt = select([table.c.txid, table.c.id, table.c.supplier_id, table.c.action,
+                       table.c.record, table.c.changed_at]) \
+            .where(and_(
+                tuple_(table.c.txid, table.c.id) > tuple_(*position),
+                # only transactions that can no longer commit out of order
+                table.c.txid < func.txid_snapshot_xmin(func.txid_current_snapshot()),
+            )) \
+            .order_by(table.c.txid, table.c.id) \
+            .limit(limit)
+        with db.engine.connect() as connection:
+            rows = connection.execute(stmt).fetchall()
+        return [
+            {"cursor": "{}-{}".format(txid, change_id), "supplier_id": supplier_id,
+             "action": action, "supplier": record, "changed_at": changed_at.isoformat()}
+            for txid, change_id, supplier_id, action, record, changed_at in rows
+        ]
+
+    @classmethod
+    def wait(cls, cursor=None, limit=100, timeout=0):
+        """Returns the changes after a cursor, waiting up to timeout seconds for one
+
+        Waits on a LISTEN connection so a commit wakes it up straight away,
+        and checks again every second for changes that became readable when
+        an older transaction finished.
+        """
+        changes = cls.since(cursor, limit)
+        if changes or timeout <= 0:
+            return changes
+        deadline = time.monotonic() + timeout
+        connection = db.engine.raw_connection()
+        connection.detach()  # closed rather than pooled with LISTEN on it
+        try:
+            connection.connection.autocommit = True
+            connection.cursor().execute("LISTEN {}".format(CHANGE_CHANNEL))
+            while not changes:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                select_module.select([connection.connection], [], [], min(remaining, 1.0))
+                connection.connection.poll()
+                del connection.connection.notifies[:]
+                changes = cls.since(cursor, limit)
+        finally:
+            connection.close()
+        return changes
+
+    @classmethod
+    def unlogged(cls, since=None):
+        """Returns the supplier writes missing from the change log
+
+        With shards a supplier row commits on its shard and its change on
+        the primary, so a failure between the two commits leaves the write
+        unlogged. Suppliers written since a time whose row differs from
+        their latest logged record are missing an update, and logged
+        suppliers that no longer exist are missing a delete. A write whose
+        commit is still in flight can show up too.
+
+        Args:
+            since (datetime): the start of the writes to check, None for the
+                oldest change kept
+
+        Returns:
+            list of (action, supplier_id, record) changes to append
+        """
+        table = cls.__table__
+        if since is None:
+            since = db.session.execute(select([func.min(table.c.changed_at)])).scalar()
+            if since is None:
+                return []
+        latest = select([table.c.supplier_id, table.c.action, table.c.record]) \
+            .distinct(table.c.supplier_id) \
+            .order_by(table.c.supplier_id, table.c.id.desc())
+        logged = {row[0]: (row[1], row[2]) for row in db.session.execute(latest)}
+        supplier_ids = Supplier.changed_since(since)
+        supplier_ids.update(supplier_id for supplier_id, (action, _) in logged.items()
+                            if action != "delete")
+        if not supplier_ids:
+            return []
+        stored = {record["id"]: record for record in
+                  serialize_rows(Supplier.find_rows_by_ids(sorted(supplier_ids)))}
+        missing = []
+        for supplier_id in sorted(supplier_ids):
+            action, record = logged.get(supplier_id, (None, None))
+            current = stored.get(supplier_id)
+            if current is None:
+                if action is not None and action != "delete":
+                    missing.append(("delete", supplier_id, None))
+            elif record != current:
+                created = current["created_at"] == current["updated_at"]
+                missing.append(("create" if created else "update", supplier_id, current))
+        return missing
+
+    @classmethod
+    def repair(cls, changes):
+        """ Appends the changes found by unlogged() in one transaction """
+        for action, supplier_id, record in changes:
+            cls.append(action, supplier_id, record)
+        db.session.commit()
+
+    @classmethod
+    def prune(cls, days):
+        """ Deletes the changes older than days, returning how many were deleted """
+        table = cls.__table__
+        result = db.session.execute(table.delete().where(
+            table.c.changed_at < func.now() - func.make_interval(0, 0, 0, days)
+        ))
+        db.session.commit()
+        return result.rowcount
+
+
+class SupplierProduct(db.Model):
+    """
+    A product offered by a supplier
+
+    The normalized alternative to Supplier.product_list for suppliers with
+    large catalogues. Written when PRODUCT_STORAGE is dual or table, read
+    when it is table.
+    """
+
+    __tablename__ = "supplier_products"
+
+    supplier_id = db.Column(
+        db.Integer, db.ForeignKey("supplier.id", ondelete="CASCADE"), primary_key=True
+    )
+    product_id = db.Column(db.Integer, primary_key=True, autoincrement=False)
+
+    __table_args__ = (
+        db.Index("ix_supplier_products_product_supplier", product_id, supplier_id),
+    )
+
+    def __repr__(self):
+        return "<SupplierProduct supplier_id=[%s] product_id=[%s]>" % (self.supplier_id, self.product_id)
+
+    @classmethod
+    def track(cls, supplier_id, old, new):
+        """Writes the difference between two product lists of a supplier
+
+        Does nothing in array storage. Only added and removed products are
+        written, so a small change to a large catalogue stays small.
+        """
+        if Supplier.product_storage == "array":
+            return
+        old, new = set(old or ()), set(new or ())
+        table = cls.__table__
+        removed = sorted(old - new)
+        added = sorted(new - old)
+        if removed:
+            db.session.execute(table.delete().where(and_(
+                table.c.supplier_id == supplier_id, table.c.product_id.in_(removed)
+            )))
+        if added:
+            db.session.execute(
+                insert(table).values(
+                    [{"supplier_id": supplier_id, "product_id": product_id} for product_id in added]
+                ).on_conflict_do_nothing()
+            )
+
+    @classmethod
+    def aggregate(cls, supplier_id):
+        """ Returns the sorted product list of a supplier as a correlated subquery """
+        products = select([func.array_agg(aggregate_order_by(cls.product_id, cls.product_id))]) \
+            .where(cls.supplier_id == supplier_id).as_scalar()
+        return func.coalesce(products, literal_column("'{}'::integer[]")).label("product_list")
+
+    @classmethod
+    def product_ids(cls, supplier_id):
+        """ Returns the sorted product ids of a supplier """
+        stmt = select([cls.product_id]).where(cls.supplier_id == supplier_id).order_by(cls.product_id)
+        return [row[0] for row in db.session.execute(stmt)]
+
+    @classmethod
+    def migrate(cls, batch_size=1000):
+        """Copies the product_list arrays into supplier_products
+
+        Suppliers are copied in id ordered batches, each in its own
+        transaction. Run it once writes are in dual storage.
+
+        Returns:
+            the number of suppliers copied
+        """
+        supplier = Supplier.__table__
+        copied, last_id = 0, 0
+        while True:
+            rows = db.session.execute(
+                select([supplier.c.id]).where(supplier.c.id > last_id)
+                .order_by(supplier.c.id).limit(batch_size)
+            ).fetchall()
+            if not rows:
+                return copied
+            ids = [row[0] for row in rows]
+            offers = select([supplier.c.id, func.unnest(supplier.c.product_list)]) \
+                .where(supplier.c.id.in_(ids))
+            db.session.execute(
+                insert(cls.__table__).from_select(["supplier_id", "product_id"], offers)
+                .on_conflict_do_nothing()
+            )
+            db.session.commit()
+            data_generation.bump()
+            copied += len(ids)
+            last_id = ids[-1]
+            logger.info("Copied the products of %d suppliers, up to id %s", copied, last_id)
+
+
+@event.listens_for(Supplier, "load")
+@event.listens_for(Supplier, "refresh")
+def load_products(supplier, _context, attrs=None):
+    """ Fills in the product list of suppliers loaded or refreshed in table storage """
+    if Supplier.product_storage == "table" and (attrs is None or "product_list" in attrs):
+        set_committed_value(supplier, "product_list", SupplierProduct.product_ids(supplier.id))
+
+
+
+# tables created by create_all() get the trigger that maintains updated_at
+for statement in TOUCH_TRIGGER:
+    event.listen(Supplier.__table__, "after_create", DDL(statement))
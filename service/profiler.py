@@ -0,0 +1,151 @@
+"""
+Statistical profiler of a worker
+
+Sampler looks at the stacks of every thread of the process at a fixed
+interval and counts how often each stack was seen. The result is written
+in the collapsed stack format read by flamegraph.pl and speedscope: one
+line per distinct stack, frames from the outermost in, separated by
+semicolons and followed by the number of samples.
+
+Each stack is rooted at the route the thread was serving when it was
+sampled, recorded by a request hook, so the flamegraph splits time by
+route. Threads that were not serving a request are rooted at their name.
+
+A profile is taken from a background thread, so that a sync worker keeps
+serving requests on its main thread, which is then the one sampled.
+"""
+import os
+import sys
+import time
+import threading
+from collections import Counter
+from flask import request
+
+# Route each thread is serving, by thread ident
+active_routes = {}
+
+# Frame labels by code object
+_labels = {}
+
+
+def frame_label(code):
+    """ Returns the label of a code object, e.g. service/models.py:find_rows """
+    label = _labels.get(code)
+    if label is None:
+        path = code.co_filename.split(os.sep)
+        label = _labels[code] = "{}:{}".format("/".join(path[-2:]), code.co_name)
+    return label
+
+
+class ProfilerBusy(Exception):
+    """ Used when a worker is asked for a second profile at the same time """
+
+
+class Sampler:
+    """
+    Samples the stacks of the threads of the process
+
+    Args:
+        interval (float): seconds between samples
+        max_depth (int): the most frames kept of a stack, the innermost win
+    """
+
+    # one profile per process at a time
+    running = threading.Lock()
+
+    # the profile last started in the process
+    latest = None
+
+    def __init__(self, interval=0.01, max_depth=128):
+        self.interval = interval
+        self.max_depth = max_depth
+        self.stacks = Counter()
+        self.samples = 0
+        self.deadline = None
+        self.finished = threading.Event()
+
+    def sample(self, skip=()):
+        """ Records the current stack of every thread except those in skip """
+        names = {thread.ident: thread.name for thread in threading.enumerate()}
+        for ident, frame in sys._current_frames().items():  # pylint: disable=protected-access
+            if ident in skip:
+                continue
+            frames = []
+            while frame is not None and len(frames) < self.max_depth:
+                frames.append(frame_label(frame.f_code))
+                frame = frame.f_back
+            root = active_routes.get(ident) or "thread:{}".format(names.get(ident, ident))
+            frames.append(root)
+            self.stacks[";".join(reversed(frames))] += 1
+        self.samples += 1
+
+    def run(self, seconds):
+        """Samples the other threads for a number of seconds from this thread
+
+        Raises:
+            ProfilerBusy: when another profile is running in the process
+        """
+        self._begin(seconds)
+        self._sample_until_deadline()
+        return self
+
+    def start(self, seconds):
+        """Samples the threads for a number of seconds from a background thread
+
+        The profile is ready once finished is set.
+
+        Raises:
+            ProfilerBusy: when another profile is running in the process
+        """
+        self._begin(seconds)
+        threading.Thread(target=self._sample_until_deadline, name="profiler", daemon=True).start()
+        return self
+
+    @property
+    def remaining(self):
+        """ Seconds left until the profile is ready """
+        if self.finished.is_set() or self.deadline is None:
+            return 0.0
+        return max(self.deadline - time.monotonic(), 0.0)
+
+    def _begin(self, seconds):
+        if not self.running.acquire(blocking=False):
+            raise ProfilerBusy("A profile is already running in this worker")
+        self.deadline = time.monotonic() + seconds
+        Sampler.latest = self
+
+    def _sample_until_deadline(self):
+        try:
+            own = {threading.get_ident()}
+            next_sample = time.monotonic()
+            while next_sample < self.deadline:
+                self.sample(own)
+                next_sample += self.interval
+                time.sleep(max(next_sample - time.monotonic(), 0))
+        finally:
+            self.finished.set()
+            self.running.release()
+
+    def collapsed(self):
+        """ Returns the stacks in the collapsed format, most sampled first """
+        return "".join("{} {}\n".format(stack, count) for stack, count in self.stacks.most_common())
+
+
+######################################################################
+#  R O U T E   A T T R I B U T I O N
+######################################################################
+def start_request():
+    """ Records the route the current thread is serving """
+    rule = request.url_rule.rule if request.url_rule is not None else request.path
+    active_routes[threading.get_ident()] = "{} {}".format(request.method, rule)
+
+
+def end_request(_error=None):
+    """ Forgets the route of the current thread once the request is done """
+    active_routes.pop(threading.get_ident(), None)
+
+
+def init_app(app):
+    """ Tracks the route served by each thread of app """
+    app.before_request(start_request)
+    app.teardown_request(end_request)
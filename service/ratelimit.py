@@ -0,0 +1,218 @@
+"""
+Per client rate limiting for the Supplier service
+
+Every client has a token bucket per route class: reads, writes and bulk
+(unfiltered listings, fetches by many ids and product lookups). A request
+takes a token from the bucket of its client and class, and is refused with
+the seconds until a token is back when the bucket is empty. Buckets refill
+at a steady rate up to a burst size.
+
+Clients are the API keys, each with its own quotas, and the remote
+addresses of requests made without a key. The buckets live in a memory
+mapped file, by default under /dev/shm, so the workers of a host share
+them; each bucket sits in a fixed slot found by a hash of its name and is
+updated under a byte range lock of the file, which keeps a check to a
+couple of system calls. Hosts do not share buckets, so a client's quota
+applies per host.
+"""
+import os
+import mmap
+import fcntl
+import struct
+import hashlib
+import tempfile
+import threading
+import time
+from collections import namedtuple
+
+# The route classes quotas are given for
+ROUTE_CLASSES = ("reads", "writes", "bulk")
+
+# A bucket slot: name fingerprint, tokens left and the time they were counted
+SLOT = struct.Struct("<Qdd")
+
+# Slots searched for a bucket from the one its hash points at
+PROBE = 8
+
+
+class Quota(namedtuple("Quota", ("rate", "burst"))):
+    """ Tokens added per second and the most tokens a bucket holds """
+
+
+def parse_quota(value):
+    """ Returns a Quota from "rate:burst", "rate" or a [rate, burst] list, the burst defaults to the rate """
+    parts = value if isinstance(value, (list, tuple)) else str(value).split(":")
+    try:
+        rate = float(parts[0])
+        burst = float(parts[1]) if len(parts) > 1 else rate
+    except (ValueError, IndexError):
+        raise ValueError("Invalid quota {!r}, expected rate:burst".format(value))
+    if rate <= 0 or burst < 1:
+        raise ValueError("Invalid quota {!r}, the rate must be positive and the burst at least 1".format(value))
+    return Quota(rate, burst)
+
+
+def parse_quotas(text):
+    """ Returns the quotas by route class of "reads=50:100,writes=5:10,bulk=1:5" """
+    quotas = {}
+    for item in filter(None, (part.strip() for part in text.split(","))):
+        route_class, _, value = item.partition("=")
+        route_class = route_class.strip()
+        if route_class not in ROUTE_CLASSES:
+            raise ValueError("Unknown route class {!r}, expected one of {}".format(
+                route_class, ", ".join(ROUTE_CLASSES)))
+        quotas[route_class] = parse_quota(value.strip())
+    return quotas
+
+
+def default_path():
+    """ Returns where the buckets are kept when no file is configured """
+    directory = "/dev/shm" if os.path.isdir("/dev/shm") else tempfile.gettempdir()
+    return os.path.join(directory, "supplier-ratelimit")
+
+
+class BucketTable:
+    """
+    Token buckets in a memory mapped file
+
+    Processes that map the same file share the buckets. A bucket whose slots
+    are all taken by other buckets replaces the one idle the longest, which
+    starts it full again.
+
+    Args:
+        path (string): the file holding the buckets, created if missing
+        slots (int): the number of buckets the file holds
+    """
+
+    def __init__(self, path, slots=4096):
+        self.path = path
+        self.slots = slots
+        size = (slots + PROBE) * SLOT.size
+        self.fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o600)
+        if os.fstat(self.fd).st_size < size:
+            os.ftruncate(self.fd, size)
+        self.map = mmap.mmap(self.fd, size)
+        # file locks are held per process, this one orders the threads of one
+        self._lock = threading.Lock()
+
+    def close(self):
+        """ Unmaps the file """
+        self.map.close()
+        os.close(self.fd)
+
+    def position(self, name):
+        """Returns the fingerprint of a bucket name and the first slot it may be in
+
+        Not cached: hashing a short name takes under a microsecond, and a
+        cache by name would grow with every client address seen.
+        """
+        digest = hashlib.blake2b(name.encode("utf-8"), digest_size=8).digest()
+        fingerprint = int.from_bytes(digest, "little") | 1
+        return fingerprint, fingerprint % self.slots
+
+    def take(self, name, quota, cost=1, now=None):
+        """Takes cost tokens from a bucket
+
+        Returns:
+            float: 0 when the tokens were taken, otherwise the seconds until
+                the bucket holds enough of them
+        """
+        fingerprint, first = self.position(name)
+        now = time.monotonic() if now is None else now
+        start, length = first * SLOT.size, PROBE * SLOT.size
+        with self._lock:
+            fcntl.lockf(self.fd, fcntl.LOCK_EX, length, start)
+            try:
+                offset = self._find(fingerprint, start, length)
+                found, tokens, counted = SLOT.unpack_from(self.map, offset)
+                if found != fingerprint:
+                    tokens = quota.burst
+                else:
+                    # buckets counted in the future come from before a reboot
+                    tokens = min(quota.burst, tokens + max(now - counted, 0) * quota.rate)
+                allowed = tokens >= cost
+                if allowed:
+                    tokens -= cost
+                SLOT.pack_into(self.map, offset, fingerprint, tokens, now)
+            finally:
+                fcntl.lockf(self.fd, fcntl.LOCK_UN, length, start)
+        return 0.0 if allowed else (cost - tokens) / quota.rate
+
+    def _find(self, fingerprint, start, length):
+        """ Returns the offset of the slot of a bucket, an empty one or the idlest one """
+        idlest, idle_since = start, None
+        for offset in range(start, start + length, SLOT.size):
+            found, _tokens, counted = SLOT.unpack_from(self.map, offset)
+            if found == fingerprint or found == 0:
+                return offset
+            if idle_since is None or counted < idle_since:
+                idlest, idle_since = offset, counted
+        return idlest
+
+
+class RateLimiter:
+    """ Charges requests to the token buckets of their clients """
+
+    def __init__(self):
+        self.table = None
+        self.quotas = {}
+        self.keys = {}
+
+    def configure(self, quotas=None, keys=None, path=None, slots=4096):
+        """Replaces the quotas and API keys
+
+        Args:
+            quotas (dict): the Quota of each route class for clients without
+                quotas of their own, classes left out are not limited
+            keys (dict): API key to {"name": ..., route class: quota}, the
+                name identifies the client's buckets and defaults to the key
+            path (string): the file the buckets are shared through
+            slots (int): the number of buckets the file holds
+        """
+        self.quotas = dict(quotas or {})
+        self.keys = {}
+        for key, settings in (keys or {}).items():
+            own = {route_class: parse_quota(value) for route_class, value in settings.items()
+                   if route_class in ROUTE_CLASSES}
+            self.keys[key] = ("key:" + str(settings.get("name", key)), dict(self.quotas, **own))
+        if self.table is not None:
+            self.table.close()
+            self.table = None
+        if self.quotas or any(own for _client, own in self.keys.values()):
+            self.table = BucketTable(path or default_path(), slots)
+
+    @property
+    def enabled(self):
+        """ True when some route class is limited """
+        return self.table is not None
+
+    def check(self, key, address, route_class, cost=1):
+        """Charges a request to its client
+
+        The client is the API key when it is a known one, otherwise the
+        remote address.
+
+        Returns:
+            float: 0 when the request may proceed, otherwise the seconds
+                until the client may make it
+        """
+        client = self.keys.get(key)
+        name, quotas = client if client is not None else ("addr:{}".format(address), self.quotas)
+        quota = quotas.get(route_class)
+        if quota is None or self.table is None:
+            return 0.0
+        return self.table.take("{}:{}".format(name, route_class), quota, cost)
+
+
+# The rate limiter of the service
+limiter = RateLimiter()
+
+
+def init_app(app):
+    """ Configures the limiter from the app config """
+    keys = dict(app.config.get("API_KEYS") or {})
+    if app.config.get("API_KEY"):
+        keys.setdefault(app.config["API_KEY"], {"name": "default"})
+    limiter.configure(parse_quotas(app.config.get("RATE_LIMITS", "")), keys,
+                      app.config.get("RATE_LIMIT_FILE") or None,
+                      app.config.get("RATE_LIMIT_SLOTS", 4096))
@@ -0,0 +1,134 @@
+"""
+Read replica routing for the Supplier service
+
+ReplicaRouter hands out the configured replica engines in round-robin
+order, skipping replicas whose last health check failed. Code that runs
+inside router.reading(engine) has the statements of its database session
+sent to that replica, everything else goes to the primary.
+
+RoutingSQLAlchemy is a drop-in SQLAlchemy extension whose sessions consult
+the router. Flushes always go to the primary.
+"""
+import time
+import logging
+import threading
+from contextlib import contextmanager
+from contextvars import ContextVar
+from flask_sqlalchemy import SQLAlchemy, SignallingSession
+from sqlalchemy import create_engine, orm
+from sqlalchemy.exc import SQLAlchemyError
+
+logger = logging.getLogger("flask.app.replicas")
+
+
+class Replica:
+    """ A replica engine and the result of its last health check """
+
+    def __init__(self, engine):
+        self.engine = engine
+        self.healthy = True
+        self.checked_at = None
+
+    def available(self, interval):
+        """ Returns True if the replica is healthy, checking it at most every interval seconds """
+        if self.checked_at is None or time.monotonic() - self.checked_at > interval:
+            self.check()
+        return self.healthy
+
+    def check(self):
+        """ Runs a trivial query on the replica and records whether it answered """
+        try:
+            with self.engine.connect() as connection:
+                connection.execute("SELECT 1")
+            if not self.healthy:
+                logger.info("Replica %s is back", self.engine.url)
+            self.healthy = True
+        except SQLAlchemyError as error:
+            logger.warning("Replica %s failed its health check: %s", self.engine.url, error)
+            self.healthy = False
+        self.checked_at = time.monotonic()
+
+
+class ReplicaRouter:
+    """ Chooses the replica engine that reads are sent to """
+
+    def __init__(self):
+        self.replicas = []
+        self.health_interval = 5
+        self._next = 0
+        self._lock = threading.Lock()
+        self._current = ContextVar("replica", default=None)
+
+    def configure(self, uris, health_interval=5, connect_timeout=2):
+        """Replaces the replicas
+
+        Args:
+            uris (list): database URIs of the replicas, empty to read from
+                the primary only
+            health_interval (int): seconds between health checks of a replica
+            connect_timeout (int): seconds to wait for a replica connection
+        """
+        for replica in self.replicas:
+            replica.engine.dispose()
+        self.replicas = [
+            Replica(create_engine(uri, pool_pre_ping=True,
+                                  connect_args={"connect_timeout": connect_timeout}))
+            for uri in uris
+        ]
+        self.health_interval = health_interval
+        self._next = 0
+
+    def choose(self):
+        """ Returns the next healthy replica engine, or None to use the primary """
+        with self._lock:
+            for _ in range(len(self.replicas)):
+                replica = self.replicas[self._next]
+                self._next = (self._next + 1) % len(self.replicas)
+                if replica.available(self.health_interval):
+                    return replica.engine
+        return None
+
+    def mark_down(self, engine):
+        """ Records that a replica failed a query so it is skipped until its next check """
+        for replica in self.replicas:
+            if replica.engine is engine:
+                replica.healthy = False
+                replica.checked_at = time.monotonic()
+
+    @property
+    def current(self):
+        """ The replica engine reads of this context are sent to, if any """
+        return self._current.get()
+
+    @contextmanager
+    def reading(self, engine):
+        """ Sends the session statements run inside the block to engine """
+        token = self._current.set(engine)
+        try:
+            yield engine
+        finally:
+            self._current.reset(token)
+
+
+# The router used by the sessions of RoutingSQLAlchemy
+router = ReplicaRouter()
+
+
+class RoutingSession(SignallingSession):
+    """ A session that sends reads to the replica chosen by the router """
+
+    def get_bind(self, mapper=None, clause=None):
+        engine = router.current
+        if engine is not None and not self._flushing:
+            return engine
+        return SignallingSession.get_bind(self, mapper, clause)
+
+
+class RoutingSQLAlchemy(SQLAlchemy):
+    """ SQLAlchemy extension whose sessions are routed by the replica router """
+
+    # replaced by service.sharding when the supplier table is sharded
+    session_class = RoutingSession
+
+    def create_session(self, options):
+        return orm.sessionmaker(class_=self.session_class, db=self, **options)
@@ -7,6 +7,10 @@ Routes:
 - GET /suppliers/{id} - Return the supplier with a given id number
 - PUT /suppliers/{id} - Update a supplier record in the database
 - DELETE /suppliers/{id} - Delete a supplier record in the database
+- GET /suppliers?id={ids} - Return the Suppliers with the given ids, in order
+- POST /suppliers/batch - Return the Suppliers with the ids in the body, in order
+- GET /suppliers/changes?since={cursor} - Return the Supplier changes after a cursor
+- GET /suppliers/products?product_ids={ids} - Return the Suppliers offering each product
 - GET /suppliers/favorites - Return the list of all suppliers marked as favorites previously
 - GET /suppliers/?search={text}&supplier-id={id}&category=${category}&supplier-name=${name}
     - Return the list of all suppliers according to the search query
@@ -14,21 +18,77 @@ Routes:
 
 import os
 import sys
+import math
+import time
 import logging, uuid
+import threading
+from contextlib import ExitStack
+from datetime import timezone
 from functools import wraps
-from flask import Flask, jsonify, request, url_for, make_response, abort
+from flask import Flask, Request, jsonify, request, url_for, make_response, abort, session, has_request_context, \
+    Response, stream_with_context
 from flask_restx import Api, Resource, fields, reqparse, inputs
 from flask_api import status  # HTTP Status Codes
-from werkzeug.exceptions import NotFound, UnsupportedMediaType
+from werkzeug.exceptions import BadRequest, NotFound, UnsupportedMediaType
+from sqlalchemy.exc import OperationalError
 
 # For this example we'll use SQLAlchemy, a popular ORM that supports a
 # variety of backends including SQLite, MySQL, and PostgreSQL
 from flask_sqlalchemy import SQLAlchemy
-from service.models import Supplier, DataValidationError
+from service.models import Supplier, ProductRollup, SupplierChange, DataValidationError, db
+from service.autocomplete import PrefixIndex
+from service.cache import ResponseCache, TTLCache, data_generation
+from service.replicas import router as replica_router
+from service.serializers import MSGPACK_MIMETYPE, SUPPLIER_FIELDS, dumps, packb, row_serializer, \
+    serialize_rows, unpackb
+from service.tracing import tracer
+from service.profiler import ProfilerBusy, Sampler
+from service.ratelimit import limiter
+from service.admission import Overloaded, admission, request_start
 
 # Import Flask application
 from . import app
 
+# Most Suppliers fetched by id in one request
+MAX_BATCH_IDS = 1000
+
+# Limits of the product lookup endpoint
+MAX_LOOKUP_IDS = 1000
+DEFAULT_LOOKUP_PAGE = 1000
+MAX_LOOKUP_PAGE = 10000
+
+# Longest a change feed request is held open, in seconds. A sync worker
+# serves nothing else meanwhile and is killed after gunicorn's 30 second
+# timeout, see gunicorn.conf.py
+MAX_CHANGE_WAIT = 20
+
+# Ids are stored as Postgres integers
+MIN_ID, MAX_ID = -2 ** 31, 2 ** 31 - 1
+
+# No table has more rows than there are ids, so no offset skips more
+MAX_OFFSET = MAX_ID
+
+
+def id_list(value):
+    """ Parses a list or comma separated string of ids, for use as a reqparse type """
+    items = value if isinstance(value, list) else str(value).split(',')
+    try:
+        ids = [int(item) for item in items if str(item).strip()]
+    except ValueError:
+        raise ValueError('ids must be integers separated by commas')
+    if not ids:
+        raise ValueError('at least one id is required')
+    if not all(MIN_ID <= item <= MAX_ID for item in ids):
+        raise ValueError('ids must be between {} and {}'.format(MIN_ID, MAX_ID))
+    return ids
+
+
+def utc_datetime(value):
+    """ Parses an ISO 8601 time, for use as a reqparse type, reading it as UTC when it has no offset """
+    parsed = inputs.datetime_from_iso8601(value)
+    return parsed if parsed.tzinfo is not None else parsed.replace(tzinfo=timezone.utc)
+
+
 # Document the type of autorization required
 authorizations = {
     'apikey': {
@@ -47,6 +107,15 @@ def index():
     return app.send_static_file("index.html")
 
 
+######################################################################
+# HEALTH CHECK
+######################################################################
+@app.route("/health")
+def health():
+    """ Health check for load balancers, answered even while the worker sheds load """
+    return jsonify(status='OK', in_flight=admission.in_flight, shed=admission.shed), status.HTTP_200_OK
+
+
 ######################################################################
 # Configure Swagger before initializing it
 ######################################################################
@@ -62,6 +131,49 @@ api = Api(app,
          )
 
 
+@api.representation('application/json')
+def output_json(data, code, headers=None):
+    """ Encodes API responses with the fast JSON encoder """
+    with tracer.span('marshal'):
+        response = make_response(dumps(data), code)
+        response.headers.extend(headers or {})
+        response.mimetype = 'application/json'
+        return response
+
+
+@api.representation(MSGPACK_MIMETYPE)
+def output_msgpack(data, code, headers=None):
+    """ Encodes API responses as MessagePack for clients that accept it """
+    with tracer.span('marshal'):
+        response = make_response(packb(data), code)
+        response.headers.extend(headers or {})
+        response.mimetype = MSGPACK_MIMETYPE
+        return response
+
+
+class MessagePackRequest(Request):
+    """ A request whose body may be sent as MessagePack instead of JSON """
+
+    def get_json(self, force=False, silent=False, cache=True):
+        """ Returns the decoded body, of either media type """
+        if self.mimetype != MSGPACK_MIMETYPE:
+            return super().get_json(force, silent, cache)
+        if '_msgpack_body' in self.__dict__:
+            return self.__dict__['_msgpack_body']
+        try:
+            body = unpackb(self.get_data(cache=cache))
+        except ValueError as error:
+            if silent:
+                return None
+            raise BadRequest('Failed to decode MessagePack object: {}'.format(error))
+        if cache:
+            self.__dict__['_msgpack_body'] = body
+        return body
+
+
+# Payloads are read through get_json whatever their media type
+app.request_class = MessagePackRequest
+
 
 # Define the model so that the docs reflect what can be sent
 create_model = api.model('Supplier', {
@@ -83,20 +195,207 @@ supplier_model = api.inherit(
     'SupplierModel', 
     create_model,
     {
-        'id': fields.String(readOnly=True,
+        'id': fields.Integer(readOnly=True,
                             description='The unique id assigned internally by service'),
+        'created_at': fields.DateTime(readOnly=True,
+                                      description='When the Supplier was created'),
+        'updated_at': fields.DateTime(readOnly=True,
+                                      description='When the Supplier was last written'),
     }
 )
 
+histogram_bucket_model = api.model('RatingBucket', {
+    'min': fields.Float(description='The lowest rating in the bucket'),
+    'max': fields.Float(description='The rating the bucket goes up to'),
+    'count': fields.Integer(description='The number of Suppliers in the bucket'),
+})
+
+product_count_model = api.model('ProductCount', {
+    'product_id': fields.Integer(description='The product identifier'),
+    'supplier_count': fields.Integer(description='The number of Suppliers offering the product'),
+})
+
+stats_model = api.model('SupplierStats', {
+    'count': fields.Integer(description='The number of matching Suppliers'),
+    'available_count': fields.Integer(description='The number of available Suppliers'),
+    'unavailable_count': fields.Integer(description='The number of unavailable Suppliers'),
+    'average_rating': fields.Float(description='The average rating'),
+    'rating_histogram': fields.List(fields.Nested(histogram_bucket_model),
+                                    description='Supplier counts by rating range'),
+    'products': fields.List(fields.Nested(product_count_model),
+                            description='Supplier counts by product'),
+})
+
+rollup_model = api.model('ProductRollup', {
+    'product_id': fields.Integer(description='The product identifier'),
+    'supplier_count': fields.Integer(description='The number of Suppliers offering the product'),
+    'available_count': fields.Integer(description='The number of those Suppliers available'),
+    'rating_sum': fields.Float(description='The sum of their ratings'),
+    'average_rating': fields.Float(description='The average of their ratings'),
+})
+
+product_suppliers_model = api.model('ProductSuppliers', {
+    'products': fields.Raw(description='The Supplier ids offering each product, keyed by product id'),
+    'suppliers': fields.List(fields.Nested(supplier_model),
+                             description='The Suppliers of this page, when records were requested'),
+    'next_offset': fields.Integer(description='The offset of the next page, null on the last page'),
+})
+
+lookup_model = api.model('ProductLookup', {
+    'product_ids': fields.List(fields.Integer, required=True, description='The products to look up'),
+    'records': fields.Boolean(description='Also return the Supplier records'),
+    'fields': fields.String(description='Comma separated list of record fields to return'),
+    'limit': fields.Integer(description='Maximum number of product and Supplier pairs'),
+    'offset': fields.Integer(description='Number of product and Supplier pairs to skip'),
+})
+
+batch_model = api.model('SupplierBatch', {
+    'ids': fields.List(fields.Integer, required=True, description='The Supplier ids to fetch'),
+    'fields': fields.String(description='Comma separated list of fields to return'),
+})
+
+change_model = api.model('SupplierChange', {
+    'cursor': fields.String(description='The position of the change, pass it as since to read on'),
+    'supplier_id': fields.Integer(description='The id of the changed Supplier'),
+    'action': fields.String(description='create, update, penalize or delete'),
+    'supplier': fields.Nested(supplier_model, allow_null=True,
+                              description='The Supplier as written, null for a delete'),
+    'changed_at': fields.DateTime(description='When the change was written'),
+})
+
+change_feed_model = api.model('SupplierChangeFeed', {
+    'changes': fields.List(fields.Nested(change_model), description='The changes, oldest first'),
+    'cursor': fields.String(description='The cursor to read the next changes from'),
+})
+
+# Short lived cache of stats results, disabled when STATS_CACHE_TTL is 0
+stats_cache = TTLCache(app.config.get('STATS_CACHE_TTL', 0))
+
+# Full Supplier rows by id, dropped on every write made by this worker and
+# disabled when SUPPLIER_CACHE_TTL is 0
+row_cache = TTLCache(app.config.get('SUPPLIER_CACHE_TTL', 0),
+                     maxsize=app.config.get('SUPPLIER_CACHE_SIZE', 10000))
+Supplier.add_write_listener(lambda action, record: row_cache.delete(record['id']))
+
+# Encoded list responses by query, dropped once any worker of the host writes
+# and disabled when LIST_CACHE_MAX_BYTES is 0
+data_generation.configure(app.config.get('DATA_GENERATION_FILE') or None)
+list_cache = ResponseCache(data_generation, app.config.get('LIST_CACHE_MAX_BYTES', 0),
+                           ttl=app.config.get('LIST_CACHE_TTL', 0))
+
+suggestion_model = api.model('SupplierSuggestion', {
+    'id': fields.Integer(description='The unique id of the Supplier'),
+    'name': fields.String(description='The name of the Supplier'),
+    'rating': fields.Float(description='The rating of the Supplier'),
+})
+
+# Prefix index of Supplier names, kept current by the Supplier writes
+name_index = PrefixIndex(max_entries=app.config.get('AUTOCOMPLETE_MAX_ENTRIES', 100000),
+                         refresh=app.config.get('AUTOCOMPLETE_REFRESH', 0))
+Supplier.add_write_listener(name_index.on_write)
+
+class RequestParser(reqparse.RequestParser):
+    """ A request parser whose parsing is traced """
+
+    def parse_args(self, req=None, strict=False):
+        with tracer.span('parse_args'):
+            return super().parse_args(req, strict)
+
+
+# query string arguments shared by the list and stats endpoints
+filter_args = RequestParser()
+filter_args.add_argument('name', type=str, required=False, help='List Suppliers by name')
+filter_args.add_argument('phone', type=str, required=False, help='List Suppliers by phone')
+filter_args.add_argument('address', type=str, required=False, help='List Suppliers by address')
+filter_args.add_argument('rating', type=float, required=False, help='List Suppliers by rating')
+filter_args.add_argument('product_id', type=inputs.int_range(MIN_ID, MAX_ID), required=False,
+                         help='List Suppliers by product id')
+filter_args.add_argument('available', type=inputs.boolean, required=False, help='List Suppliers by availability')
+filter_args.add_argument('match', type=str, required=False, choices=('exact', 'insensitive'),
+                         default='exact',
+                         help='Match name and address exactly or ignoring case and whitespace')
+filter_args.add_argument('q', type=str, required=False,
+                         help='Search Suppliers by name and address, ranked by similarity')
+filter_args.add_argument('updated_since', type=utc_datetime, required=False,
+                         help='List Suppliers written at or after this ISO 8601 time')
+
+# query string arguments of the list endpoint
+supplier_args = filter_args.copy()
+supplier_args.add_argument('fields', type=str, required=False,
+                           help='Comma separated list of fields to return, e.g. id,name,rating')
+supplier_args.add_argument('id', type=id_list, required=False,
+                           help='Comma separated list of Supplier ids to fetch, in order, '
+                                'at most {}'.format(MAX_BATCH_IDS))
+supplier_args.add_argument('sort', type=str, required=False,
+                           choices=('id', 'name', 'rating', 'updated_at'),
+                           help='Sort Suppliers by id, name, rating or updated_at')
+supplier_args.add_argument('order', type=str, required=False, choices=('asc', 'desc'),
+                           default='asc', help='Sort order, asc or desc')
+supplier_args.add_argument('limit', type=inputs.positive, required=False,
+                           help='Maximum number of Suppliers to return')
+supplier_args.add_argument('offset', type=inputs.int_range(0, MAX_OFFSET), required=False,
+                           help='Number of Suppliers to skip')
+
+# query string arguments of the stats endpoint
+stats_args = filter_args.copy()
+stats_args.add_argument('buckets', type=inputs.int_range(1, 100), required=False, default=5,
+                        help='Number of rating histogram buckets')
+
+# query string arguments of the autocomplete endpoint
+autocomplete_args = RequestParser()
+autocomplete_args.add_argument('prefix', type=str, required=True, location='args',
+                               help='The start of the Supplier name')
+autocomplete_args.add_argument('limit', type=inputs.int_range(1, 50), required=False,
+                               default=10, location='args', help='Maximum number of names')
+
+# query string arguments of the get endpoint
+fields_args = RequestParser()
+fields_args.add_argument('fields', type=str, required=False, location='args',
+                         help='Comma separated list of fields to return, e.g. id,name,rating')
 
-# query string arguments
-supplier_args = reqparse.RequestParser()
-supplier_args.add_argument('name', type=str, required=False, help='List Suppliers by name')
-supplier_args.add_argument('phone', type=str, required=False, help='List Suppliers by phone')
-supplier_args.add_argument('address', type=str, required=False, help='List Suppliers by address')
-supplier_args.add_argument('rating', type=float, required=False, help='List Suppliers by rating')
-supplier_args.add_argument('product_id', type=int, required=False, help='List Suppliers by product id')
-supplier_args.add_argument('available', type=inputs.boolean, required=False, help='List Suppliers by availability')
+# query string arguments of the change feed
+change_args = RequestParser()
+change_args.add_argument('since', type=str, required=False, location='args',
+                         help='The cursor of the last change read, omit to start from the oldest')
+change_args.add_argument('limit', type=inputs.int_range(1, 1000), required=False, default=100,
+                         location='args', help='Maximum number of changes')
+change_args.add_argument('wait', type=inputs.int_range(0, MAX_CHANGE_WAIT), required=False, default=0,
+                         location='args', help='Seconds to wait for a change when there is none')
+
+# query string arguments of the profiler
+profile_args = RequestParser()
+profile_args.add_argument('seconds', type=inputs.int_range(1, 60), required=False, default=10,
+                          location='args', help='Seconds to sample for')
+profile_args.add_argument('interval', type=inputs.int_range(1, 1000), required=False, default=10,
+                          location='args', help='Milliseconds between samples')
+
+# body of the batch fetch endpoint
+batch_args = RequestParser()
+batch_args.add_argument('ids', type=id_list, required=True, location='json',
+                        help='List of Supplier ids, at most {}'.format(MAX_BATCH_IDS))
+batch_args.add_argument('fields', type=str, required=False, location='json',
+                        help='Comma separated list of fields to return, e.g. id,name,rating')
+
+# arguments of the product lookup endpoint, from the query string on GET and
+# from the body on POST
+lookup_args = RequestParser()
+lookup_args.add_argument('product_ids', type=id_list, required=True, location='args',
+                         help='Comma separated list of product ids, at most {}'.format(MAX_LOOKUP_IDS))
+lookup_args.add_argument('records', type=inputs.boolean, required=False, default=False,
+                         location='args', help='Also return the Supplier records')
+lookup_args.add_argument('fields', type=str, required=False, location='args',
+                         help='Comma separated list of record fields to return, e.g. id,name,rating')
+lookup_args.add_argument('limit', type=inputs.int_range(1, MAX_LOOKUP_PAGE), required=False,
+                         default=DEFAULT_LOOKUP_PAGE, location='args',
+                         help='Maximum number of product and Supplier pairs')
+lookup_args.add_argument('offset', type=inputs.int_range(0, MAX_OFFSET), required=False, default=0,
+                         location='args', help='Number of product and Supplier pairs to skip')
+
+lookup_body = lookup_args.copy()
+for argument in lookup_body.args:
+    argument.location = 'json'
+lookup_body.replace_argument('product_ids', type=id_list, required=True, location='json',
+                             help='List of product ids, at most {}'.format(MAX_LOOKUP_IDS))
 
 ######################################################################
 # Special Error Handlers
@@ -113,22 +412,167 @@ def request_validation_error(error):
     }, status.HTTP_400_BAD_REQUEST
 
 
+@api.errorhandler(Overloaded)
+def overloaded(error):
+    """ Turns requests away quickly when the worker is overloaded """
+    message = str(error)
+    app.logger.warning(message)
+    return {
+        'status_code': status.HTTP_503_SERVICE_UNAVAILABLE,
+        'error': 'Service Unavailable',
+        'message': message
+    }, status.HTTP_503_SERVICE_UNAVAILABLE, {'Retry-After': str(error.retry_after)}
+
+
 ######################################################################
 # Authorization Decorator
 ######################################################################
-def token_required(f):
+# What an API key may be allowed to do: write Suppliers, or use /admin
+SCOPES = ('writes', 'admin')
+
+
+def token_required(scope):
+    """Runs a handler only for requests whose X-Api-Key grants a scope
+
+    API_KEY grants every scope, the keys of API_KEYS the ones listed in
+    their "scopes" setting, none by default.
+    """
+    def decorator(f):
+        @wraps(f)
+        def decorated(*args, **kwargs):
+            with tracer.span('token_required'):
+                scopes = key_scopes(request.headers.get('X-Api-Key'))
+
+            if scopes is None:
+                return {'message': 'Invalid or missing token'}, 401
+            if scope not in scopes:
+                return {'message': 'The API key is not allowed {} access'.format(scope)}, 403
+            return f(*args, **kwargs)
+        return decorated
+    return decorator
+
+
+def key_scopes(token):
+    """ Returns the scopes an API key grants, None when it is not a known key """
+    if token is None:
+        return None
+    if token == app.config.get('API_KEY'):
+        return SCOPES
+    settings = (app.config.get('API_KEYS') or {}).get(token)
+    return tuple(settings.get('scopes', ())) if settings is not None else None
+
+######################################################################
+# Rate Limit Decorator
+######################################################################
+def rate_limited(route_class):
+    """Charges a request to the token bucket of its client for a route class
+
+    route_class is reads, writes or bulk, or a function of the request that
+    returns one. Requests of a client whose bucket is empty get a 429 with
+    the seconds until it may retry in the Retry-After header.
+    """
+    def decorator(f):
+        @wraps(f)
+        def decorated(*args, **kwargs):
+            if limiter.enabled:
+                name = route_class(request) if callable(route_class) else route_class
+                retry_after = limiter.check(request.headers.get('X-Api-Key'), request.remote_addr, name)
+                if retry_after:
+                    app.logger.warning('Rate limited %s request from %s', name, request.remote_addr)
+                    return {'message': 'Too many {} requests'.format(name)}, \
+                        status.HTTP_429_TOO_MANY_REQUESTS, {'Retry-After': str(math.ceil(retry_after))}
+            return f(*args, **kwargs)
+        return decorated
+    return decorator
+
+
+# Largest limit of a listing charged as a read. Filters do not bound a
+# listing, so one without a limit or with a larger one is bulk
+MAX_READ_LIMIT = 100
+
+
+def list_class(req):
+    """ Returns the route class of a listing: a read when a small limit bounds it, else bulk """
+    if 'id' in req.args:
+        return 'bulk'
+    try:
+        limit = int(req.args.get('limit', ''))
+    except ValueError:
+        return 'bulk'
+    return 'reads' if 0 < limit <= MAX_READ_LIMIT else 'bulk'
+
+
+######################################################################
+# Admission Control Decorator
+######################################################################
+def admitted(route_class):
+    """Runs a handler in an admission slot of a route class
+
+    Requests that waited too long, or find no free slot in time, get a 503
+    with Retry-After instead of adding to the load.
+    """
+    def decorator(f):
+        @wraps(f)
+        def decorated(*args, **kwargs):
+            with admission_slot(route_class):
+                return f(*args, **kwargs)
+        return decorated
+    return decorator
+
+
+def admission_slot(route_class):
+    """ Returns the admission slot of the current request, timed from its X-Request-Start header """
+    return admission.slot(route_class, request_start(request.headers.get('X-Request-Start')))
+
+
+######################################################################
+# Read Replica Decorator
+######################################################################
+# Requests carrying this header are always read from the primary
+READ_PRIMARY_HEADER = 'X-Read-Primary'
+
+
+def read_replica(f):
+    """Runs a read-only handler against a read replica
+
+    The primary is used when no replica is configured or healthy, when the
+    client asks for it with the X-Read-Primary header, and for a few seconds
+    after the client session wrote. A handler that fails on its replica is
+    retried on the primary.
+    """
     @wraps(f)
     def decorated(*args, **kwargs):
-        token = None
-        if 'X-Api-Key' in request.headers:
-            token = request.headers['X-Api-Key']
-
-        if app.config.get('API_KEY') and app.config['API_KEY'] == token:
+        engine = None if reads_primary() else replica_router.choose()
+        if engine is None:
             return f(*args, **kwargs)
-        else:
-            return {'message': 'Invalid or missing token'}, 401
+        try:
+            with replica_router.reading(engine):
+                return f(*args, **kwargs)
+        except OperationalError as error:
+            app.logger.warning('Read replica failed, retrying on the primary: %s', error)
+            replica_router.mark_down(engine)
+        finally:
+            # end the replica transaction so the session does not hold it open
+            db.session.rollback()
+        return f(*args, **kwargs)
     return decorated
 
+
+def reads_primary():
+    """ Returns True if this request must see the latest writes """
+    if request.headers.get(READ_PRIMARY_HEADER, '').lower() in ('1', 'true', 'yes'):
+        return True
+    return session.get('primary_until', 0) > time.time()
+
+
+def pin_to_primary(action, record):
+    """ Sends the reads of the writing client session to the primary for a while """
+    if replica_router.replicas and has_request_context():
+        session['primary_until'] = time.time() + app.config.get('READ_YOUR_WRITES_SECONDS', 5)
+
+
+Supplier.add_write_listener(pin_to_primary)
+
 ######################################################################
 # Function to generate a random API key (good for testing)
 ######################################################################
@@ -170,8 +614,14 @@ class SupplierResource(Resource):
     # RETRIEVE A SUPPLIER
     #------------------------------------------------------------------
     @api.doc('get_suppliers')
+    @api.expect(fields_args, validate=True)
     @api.response(404, 'Supplier not found')
-    @api.marshal_with(supplier_model)
+    @api.response(400, 'The requested fields were not valid')
+    @api.response(200, 'Success', supplier_model)
+    @api.response(429, 'Too many requests')
+    @rate_limited('reads')
+    @admitted('reads')
+    @read_replica
     def get(self, supplier_id):
         """
         Retrieve a single Supplier
@@ -179,10 +629,14 @@ class SupplierResource(Resource):
         This endpoint will return a Supplier based on it's id
         """
         app.logger.info("Request to Retrieve a supplier with id [%s]", supplier_id)
-        supplier = Supplier.find(supplier_id)
-        if not supplier:
+        fields = requested_fields(fields_args.parse_args()['fields'])
+        try:
+            rows, _ = fetch_rows([int(supplier_id)], fields)
+        except ValueError:
+            rows = []
+        if not rows:
             abort(status.HTTP_404_NOT_FOUND, "Supplier with id '{}' was not found.".format(supplier_id))
-        return supplier.serialize(), status.HTTP_200_OK
+        return row_serializer(fields)(rows[0]), status.HTTP_200_OK
 
     #------------------------------------------------------------------
     # UPDATE AN EXISTING SUPPLIER
@@ -191,8 +645,11 @@ class SupplierResource(Resource):
     @api.response(404, 'Supplier not found')
     @api.response(400, 'The posted Supplier data was not valid')
     @api.expect(supplier_model)
-    @api.marshal_with(supplier_model)
-    @token_required
+    @api.response(200, 'Success', supplier_model)
+    @api.response(429, 'Too many requests')
+    @token_required('writes')
+    @rate_limited('writes')
+    @admitted('writes')
     def put(self, supplier_id):
         """
         Update a Supplier
@@ -206,7 +663,7 @@ class SupplierResource(Resource):
         app.logger.debug('Payload = %s', api.payload)
         data = api.payload
         supplier.deserialize(data)
-        supplier.id = supplier_id
+        supplier.id = int(supplier_id)
         supplier.update()
         return supplier.serialize(), status.HTTP_200_OK
 
@@ -215,7 +672,10 @@ class SupplierResource(Resource):
     #------------------------------------------------------------------
     @api.doc('delete_suppliers', security='apikey')
     @api.response(204, 'Supplier deleted')
-    @token_required
+    @api.response(429, 'Too many requests')
+    @token_required('writes')
+    @rate_limited('writes')
+    @admitted('writes')
     def delete(self, supplier_id):
         """
         Delete a Supplier
@@ -242,37 +702,52 @@ class SupplierCollection(Resource):
     #------------------------------------------------------------------
     @api.doc('list_suppliers')
     @api.expect(supplier_args, validate=True)
-    @api.marshal_list_with(supplier_model)
+    @api.response(400, 'The requested fields were not valid')
+    @api.response(200, 'Success', [supplier_model],
+                  headers={'X-Missing-Ids': 'The requested ids that were not found'})
+    @api.response(429, 'Too many requests')
+    @rate_limited(list_class)
+    @read_replica
     def get(self):
-        """ Returns all of the Suppliers """
+        """
+        Returns all of the Suppliers
+
+        With id, returns the Suppliers with those ids in the requested order
+        instead, listing the ids that do not exist in the X-Missing-Ids header
+        """
         app.logger.info('Request to list Suppliers...')
-        suppliers = []
         args = supplier_args.parse_args()
-        if args["name"]:
-            app.logger.info('Find suppliers by name: %s', args["name"])
-            suppliers = Supplier.find_by_name(args["name"])
-        elif args["phone"]:
-            app.logger.info('Find suppliers with phone number: %s', args["phone"])
-            suppliers = Supplier.find_by_phone(args["phone"])
-        elif args["address"]:
-            app.logger.info('Find suppliers with address: %s', args["address"])
-            suppliers = Supplier.find_by_address(args["address"])
-        elif args["available"] is not None:
-            app.logger.info('Find all suppliers that are available: %s', args["available"])
-            suppliers = Supplier.find_by_availability(args["available"])
-        elif args["rating"]:
-            app.logger.info('Find suppliers with rating greater than: %s', args["rating"])
-            suppliers = Supplier.find_by_greater_rating(args["rating"])
-        elif args["product_id"]:
-            app.logger.info('Find suppliers containing product with id %s in their products', \
-                args["product_id"])
-            suppliers = Supplier.find_by_product(args["product_id"])
-        else:
-            app.logger.info('Find all suppliers')
-            suppliers = Supplier.all()
-
-        results = [supplier.serialize() for supplier in suppliers]
-        return results, status.HTTP_200_OK
+        fields = requested_fields(args.pop('fields'))
+        descending = args.pop('order') == 'desc'
+        ids = args.pop('id')
+        filters = {key: value for key, value in args.items() if value is not None}
+        if ids is not None:
+            others = sorted(key for key in filters if key != 'match')
+            if others or descending:
+                raise DataValidationError('id cannot be combined with {}'.format(
+                    ', '.join(others or ['order'])))
+            with admission_slot('bulk'):
+                return batch_response(ids, fields)
+        if list_cache.enabled:
+            mediatype = request.accept_mimetypes.best_match(api.representations,
+                                                            default=api.default_mediatype)
+            key = (mediatype, fields, descending, tuple(sorted(filters.items())))
+            cached = list_cache.get(key)
+            if cached is not None:
+                return cached_response(*cached)
+            generation = data_generation.value
+        app.logger.info('Find suppliers matching %s', filters)
+        # cache hits were served above, only the query takes an admission slot
+        with admission_slot(list_class(request)):
+            rows = Supplier.find_rows(fields, descending=descending, **filters)
+            results = serialize_rows(rows, fields)
+        if not list_cache.enabled:
+            return results, status.HTTP_200_OK
+        response = api.representations[mediatype](results, status.HTTP_200_OK, {'X-Cache': 'miss'})
+        # replicas may lag the generation, only results read from the primary are kept
+        if replica_router.current is None:
+            list_cache.set(key, generation, response.get_data(), mediatype)
+        return response
 
 
     #------------------------------------------------------------------
@@ -281,9 +756,11 @@ class SupplierCollection(Resource):
     @api.doc('create_suppliers', security='apikey')
     @api.expect(create_model)
     @api.response(400, 'The posted data was not valid')
-    @api.response(201, 'Supplier created successfully')
-    @api.marshal_with(supplier_model, code=201)
-    @token_required
+    @api.response(201, 'Supplier created successfully', supplier_model)
+    @api.response(429, 'Too many requests')
+    @token_required('writes')
+    @rate_limited('writes')
+    @admitted('writes')
     def post(self):
         """
         Creates a Supplier
@@ -299,6 +776,217 @@ class SupplierCollection(Resource):
         return supplier.serialize(), status.HTTP_201_CREATED, {'Location': location_url}
 
 
+######################################################################
+#  PATH: /suppliers/stats
+######################################################################
+@api.route('/suppliers/stats')
+class SupplierStatsResource(Resource):
+    """ Aggregate statistics over Suppliers """
+    @api.doc('stats_suppliers')
+    @api.expect(stats_args, validate=True)
+    @api.response(200, 'Success', stats_model)
+    @api.response(429, 'Too many requests')
+    @rate_limited('reads')
+    @read_replica
+    def get(self):
+        """
+        Returns Supplier statistics
+
+        Counts by availability, rating average and histogram and supplier counts
+        per product, over the Suppliers matching the same filters as the list
+        """
+        app.logger.info('Request for Supplier statistics')
+        args = stats_args.parse_args()
+        buckets = args.pop('buckets')
+        filters = {key: value for key, value in args.items() if value is not None}
+        key = (buckets, tuple(sorted(filters.items())))
+        results = stats_cache.get(key)
+        if results is None:
+            with admission_slot('reads'):
+                results = Supplier.stats(buckets, **filters)
+            stats_cache.set(key, results)
+        return results, status.HTTP_200_OK
+
+
+######################################################################
+#  PATH: /suppliers/autocomplete
+######################################################################
+@api.route('/suppliers/autocomplete')
+class SupplierAutocompleteResource(Resource):
+    """ Type-ahead suggestions of Supplier names """
+    @api.doc('autocomplete_suppliers')
+    @api.expect(autocomplete_args, validate=True)
+    @api.response(200, 'Success', [suggestion_model])
+    @api.response(429, 'Too many requests')
+    @rate_limited('reads')
+    @admitted('reads')
+    @read_replica
+    def get(self):
+        """
+        Returns the best rated Suppliers whose name starts with the prefix
+
+        Case, accents and punctuation are ignored
+        """
+        args = autocomplete_args.parse_args()
+        if name_index.built_at is None:
+            load_name_index()
+        elif name_index.stale:
+            refresh_name_index()
+        matches = name_index.search(args['prefix'], args['limit'])
+        return serialize_rows(matches, ('id', 'name', 'rating')), status.HTTP_200_OK
+
+
+######################################################################
+#  PATH: /suppliers/rollups
+######################################################################
+@api.route('/suppliers/rollups')
+class ProductRollupCollection(Resource):
+    """ Per product Supplier summaries """
+    @api.doc('list_rollups')
+    @api.response(200, 'Success', [rollup_model])
+    @api.response(429, 'Too many requests')
+    @rate_limited('bulk')
+    @admitted('bulk')
+    @read_replica
+    def get(self):
+        """ Returns the Supplier summary of every product """
+        app.logger.info('Request to list product rollups')
+        results = [rollup.serialize() for rollup in ProductRollup.all()]
+        return results, status.HTTP_200_OK
+
+
+######################################################################
+#  PATH: /suppliers/rollups/{product_id}
+######################################################################
+@api.route('/suppliers/rollups/<int:product_id>')
+@api.param('product_id', 'The product identifier')
+class ProductRollupResource(Resource):
+    """ Supplier summary of a single product """
+    @api.doc('get_rollups')
+    @api.response(404, 'No Supplier offers the product')
+    @api.response(200, 'Success', rollup_model)
+    @api.response(429, 'Too many requests')
+    @rate_limited('reads')
+    @admitted('reads')
+    @read_replica
+    def get(self, product_id):
+        """
+        Retrieve the Supplier summary of a product
+
+        The summary is maintained on every write, so this is a single lookup
+        """
+        app.logger.info('Request for the rollup of product [%s]', product_id)
+        rollup = ProductRollup.find(product_id)
+        if not rollup or not rollup.supplier_count:
+            abort(status.HTTP_404_NOT_FOUND, 'No Supplier offers product [{}].'.format(product_id))
+        return rollup.serialize(), status.HTTP_200_OK
+
+
+######################################################################
+#  PATH: /suppliers/changes
+######################################################################
+@api.route('/suppliers/changes')
+class SupplierChangeFeed(Resource):
+    """ Incremental feed of Supplier writes """
+    @api.doc('list_supplier_changes')
+    @api.expect(change_args, validate=True)
+    @api.response(400, 'The cursor was not valid')
+    @api.response(200, 'Success', change_feed_model)
+    @api.response(429, 'Too many requests')
+    @rate_limited('reads')
+    def get(self):
+        """
+        Returns the Supplier changes after a cursor
+
+        Deletes appear as changes without a supplier. With wait, the request
+        is held until a change arrives or wait seconds pass. With an Accept
+        header of text/event-stream the changes are streamed as Server-Sent
+        Events, resuming from the Last-Event-ID header when it is sent.
+        Requests held open take a bulk admission slot until they end.
+        """
+        args = change_args.parse_args()
+        if request.accept_mimetypes.best == 'text/event-stream':
+            since = request.headers.get('Last-Event-ID') or args['since']
+            SupplierChange.parse_cursor(since)
+            slot = ExitStack()
+            slot.enter_context(admission_slot('bulk'))
+            response = Response(stream_with_context(change_events(since, args['limit'])),
+                                mimetype='text/event-stream',
+                                headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+            # the stream runs after this returns, the slot is freed when it is closed
+            response.call_on_close(slot.close)
+            return response
+        app.logger.info('Request for Supplier changes since %s', args['since'])
+        with admission_slot('bulk' if args['wait'] else 'reads'):
+            changes = SupplierChange.wait(args['since'], args['limit'], args['wait'])
+        cursor = changes[-1]['cursor'] if changes else args['since']
+        return {'changes': changes, 'cursor': cursor}, status.HTTP_200_OK
+
+
+######################################################################
+#  PATH: /suppliers/batch
+######################################################################
+@api.route('/suppliers/batch')
+class SupplierBatchResource(Resource):
+    """ Fetches many Suppliers by id in one request """
+    @api.doc('batch_suppliers')
+    @api.expect(batch_model)
+    @api.response(400, 'The ids or fields were not valid')
+    @api.response(200, 'Success', [supplier_model],
+                  headers={'X-Missing-Ids': 'The requested ids that were not found'})
+    @api.response(429, 'Too many requests')
+    @rate_limited('bulk')
+    @admitted('bulk')
+    @read_replica
+    def post(self):
+        """
+        Returns the Suppliers with the posted ids
+
+        The same as GET /suppliers?id= for lists too long for a query string
+        """
+        args = batch_args.parse_args()
+        return batch_response(args['ids'], requested_fields(args['fields']))
+
+
+######################################################################
+#  PATH: /suppliers/products
+######################################################################
+@api.route('/suppliers/products')
+class ProductSuppliersResource(Resource):
+    """ Reverse lookup of the Suppliers offering many products at once """
+    @api.doc('lookup_product_suppliers')
+    @api.expect(lookup_args, validate=True)
+    @api.response(400, 'The product ids or fields were not valid')
+    @api.response(200, 'Success', product_suppliers_model)
+    @api.response(429, 'Too many requests')
+    @rate_limited('bulk')
+    @admitted('bulk')
+    @read_replica
+    def get(self):
+        """
+        Returns the Suppliers offering each of the products
+
+        The product ids come from the query string, use POST for long lists
+        """
+        return lookup_product_suppliers(lookup_args.parse_args()), status.HTTP_200_OK
+
+    @api.doc('lookup_product_suppliers_body')
+    @api.expect(lookup_model)
+    @api.response(400, 'The product ids or fields were not valid')
+    @api.response(200, 'Success', product_suppliers_model)
+    @api.response(429, 'Too many requests')
+    @rate_limited('bulk')
+    @admitted('bulk')
+    @read_replica
+    def post(self):
+        """
+        Returns the Suppliers offering each of the products
+
+        The same lookup as GET with the arguments posted as a JSON body
+        """
+        return lookup_product_suppliers(lookup_body.parse_args()), status.HTTP_200_OK
+
+
 ######################################################################
 #  PATH: /suppliers/{id}/penalize
 ######################################################################
@@ -308,6 +996,10 @@ class PenalizeResource(Resource):
     """ Penalize actions on a Supplier """
     @api.doc('penalize_suppliers')
     @api.response(404, 'Supplier not found')
+    @api.response(200, 'Success', supplier_model)
+    @api.response(429, 'Too many requests')
+    @rate_limited('writes')
+    @admitted('writes')
     def put(self, supplier_id):
         """
         Penalize a Supplier
@@ -317,12 +1009,7 @@ class PenalizeResource(Resource):
         if not supplier:
             abort(status.HTTP_404_NOT_FOUND, 'Supplier with id [{}] was not found.'.format(supplier_id))
 
-        if supplier.rating >= 1:
-            supplier.rating -= 1
-        else:
-            supplier.rating = 0
-
-        supplier.update()        
+        supplier.penalize()
         app.logger.info('Supplier with id [%s] has been penalized!', supplier.id)
         return supplier.serialize(), status.HTTP_200_OK
 
@@ -336,6 +1023,197 @@ def init_db():
     Supplier.init_db(app)
 
 
+def load_name_index():
+    """ Builds the autocomplete index from the best rated Suppliers """
+    app.logger.info('Loading the Supplier name index')
+    rows = Supplier.find_rows(('id', 'name', 'rating'), sort='rating', descending=True,
+                              limit=name_index.max_entries)
+    name_index.build(rows)
+
+
+def refresh_name_index():
+    """ Rebuilds the autocomplete index in a background thread, the old one answers meanwhile """
+    if name_index.begin_refresh():
+        threading.Thread(target=rebuild_name_index, name="name-index", daemon=True).start()
+
+
+def rebuild_name_index():
+    """ Runs load_name_index() outside of a request, see refresh_name_index() """
+    with app.app_context():
+        try:
+            load_name_index()
+        except Exception as error:  # pylint: disable=broad-except
+            app.logger.error('Cannot rebuild the Supplier name index: %s', error)
+            name_index.end_refresh()
+        finally:
+            db.session.remove()
+
+
+def change_events(since, limit):
+    """Streams Supplier changes as Server-Sent Events
+
+    Ends after CHANGE_STREAM_SECONDS, at most MAX_CHANGE_WAIT, so clients
+    reconnect with Last-Event-ID, sending a comment line while idle to keep
+    proxies from timing out.
+    """
+    seconds = min(app.config.get('CHANGE_STREAM_SECONDS', MAX_CHANGE_WAIT), MAX_CHANGE_WAIT)
+    deadline = time.monotonic() + seconds
+    cursor = since
+    while True:
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            return
+        changes = SupplierChange.wait(cursor, limit, min(remaining, 15))
+        if not changes:
+            yield ': keep-alive\n\n'
+            continue
+        for change in changes:
+            yield 'id: {}\nevent: {}\ndata: {}\n\n'.format(
+                change['cursor'], change['action'], dumps(change).decode('utf-8'))
+        cursor = changes[-1]['cursor']
+
+
+def fetch_rows(ids, fields):
+    """Returns the rows of the Suppliers with the given ids and the missing ids
+
+    Rows come back in the order of ids. Cached rows are used first and the
+    misses are read with one query. Full rows are read to fill the cache
+    when it is enabled, otherwise only the requested fields.
+    """
+    cached = row_cache.ttl > 0
+    found, misses = {}, []
+    for supplier_id in ids:
+        row = row_cache.get(supplier_id)
+        if row is None:
+            misses.append(supplier_id)
+        else:
+            found[supplier_id] = row
+    if misses:
+        query_fields = SUPPLIER_FIELDS if cached else tuple(dict.fromkeys(('id',) + fields))
+        for row in Supplier.find_rows_by_ids(misses, query_fields):
+            found[row[0]] = row
+            if cached:
+                row_cache.set(row[0], row)
+    else:
+        query_fields = SUPPLIER_FIELDS
+    if query_fields != fields:
+        indexes = [query_fields.index(field) for field in fields]
+        found = {key: tuple(row[i] for i in indexes) for key, row in found.items()}
+    rows = [found[supplier_id] for supplier_id in ids if supplier_id in found]
+    missing = [supplier_id for supplier_id in ids if supplier_id not in found]
+    return rows, missing
+
+
+def cached_response(body, mimetype, headers):
+    """ Builds a response from a cached encoded body """
+    response = make_response(body, status.HTTP_200_OK)
+    response.headers.extend(headers)
+    response.headers['X-Cache'] = 'hit'
+    response.mimetype = mimetype
+    return response
+
+
+def batch_response(ids, fields):
+    """ Builds the response of a batch fetch by id """
+    ids = list(dict.fromkeys(ids))
+    if len(ids) > MAX_BATCH_IDS:
+        raise DataValidationError('At most {} Suppliers can be fetched at once'.format(MAX_BATCH_IDS))
+    app.logger.info('Request to fetch %d Suppliers by id', len(ids))
+    rows, missing = fetch_rows(ids, fields)
+    headers = {'X-Missing-Ids': ','.join(map(str, missing))} if missing else {}
+    return serialize_rows(rows, fields), status.HTTP_200_OK, headers
+
+
+def lookup_product_suppliers(args):
+    """Pages through the Suppliers of many products
+
+    Products map to the ids of their Suppliers in this page, products that
+    no Supplier offers are left out. Pages hold up to limit product and
+    Supplier pairs, next_offset is null on the last one.
+    """
+    product_ids = list(dict.fromkeys(args['product_ids']))
+    if len(product_ids) > MAX_LOOKUP_IDS:
+        raise DataValidationError('At most {} product ids can be looked up at once'.format(MAX_LOOKUP_IDS))
+    fields = requested_fields(args['fields']) if args['records'] else None
+    limit, offset = args['limit'], args['offset']
+    app.logger.info('Request for the Suppliers of %d products', len(product_ids))
+    offers = Supplier.find_offers(product_ids, limit=limit + 1, offset=offset)
+    more = len(offers) > limit
+    products = {}
+    for product_id, supplier_id in offers[:limit]:
+        products.setdefault(product_id, []).append(supplier_id)
+    results = {'products': products, 'next_offset': offset + limit if more else None}
+    if fields is not None:
+        supplier_ids = sorted({supplier_id for ids in products.values() for supplier_id in ids})
+        rows = Supplier.find_rows_by_ids(supplier_ids, fields) if supplier_ids else []
+        results['suppliers'] = serialize_rows(rows, fields)
+    return results
+
+
+######################################################################
+#  PATH: /admin/profile
+######################################################################
+@api.route('/admin/profile')
+class ProfileResource(Resource):
+    """ Statistical profile of the worker serving the request """
+    @api.doc('start_profile', security='apikey')
+    @api.expect(profile_args, validate=True)
+    @api.response(202, 'The profile started, GET it once Retry-After seconds have passed')
+    @api.response(409, 'A profile is already running in this worker')
+    @token_required('admin')
+    def post(self):
+        """
+        Starts profiling this worker
+
+        Samples the stacks of the threads of the worker from a background
+        thread for the given number of seconds, while the worker keeps
+        serving requests.
+        """
+        args = profile_args.parse_args()
+        app.logger.info('Profiling the worker for %d seconds', args['seconds'])
+        try:
+            Sampler(interval=args['interval'] / 1000).start(args['seconds'])
+        except ProfilerBusy as error:
+            abort(status.HTTP_409_CONFLICT, str(error))
+        return {'seconds': args['seconds'], 'interval': args['interval']}, status.HTTP_202_ACCEPTED, \
+            {'Location': api.url_for(ProfileResource, _external=True),
+             'Retry-After': str(args['seconds'])}
+
+    @api.doc('get_profile', security='apikey')
+    @api.response(200, 'Collapsed stacks, one "frame;frame;... samples" line per stack, '
+                       'rooted at the route each thread was serving')
+    @api.response(202, 'The profile is still running, retry after Retry-After seconds')
+    @api.response(404, 'No profile was started in this worker')
+    @token_required('admin')
+    def get(self):
+        """
+        Returns the last profile of this worker
+
+        In the collapsed format read by flamegraph tools
+        """
+        sampler = Sampler.latest
+        if sampler is None:
+            abort(status.HTTP_404_NOT_FOUND, 'No profile was started in this worker.')
+        if not sampler.finished.is_set():
+            return {'remaining': round(sampler.remaining, 1)}, status.HTTP_202_ACCEPTED, \
+                {'Retry-After': str(math.ceil(sampler.remaining) or 1)}
+        response = make_response(sampler.collapsed(), status.HTTP_200_OK)
+        response.mimetype = 'text/plain'
+        response.headers['X-Profile-Samples'] = str(sampler.samples)
+        return response
+
+
+def requested_fields(value):
+    """ Parses the fields query argument into a tuple of supplier columns """
+    if not value:
+        return SUPPLIER_FIELDS
+    fields = tuple(dict.fromkeys(field.strip() for field in value.split(',') if field.strip()))
+    unknown = [field for field in fields if field not in SUPPLIER_FIELDS]
+    if unknown or not fields:
+        raise DataValidationError('Invalid fields: {}'.format(', '.join(unknown) or value))
+    return fields
+
+
 def abort(error_code: int, message: str):
     """Logs errors before aborting"""
     app.logger.error(message)
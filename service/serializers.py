@@ -0,0 +1,101 @@
+"""
+Serializers for Supplier responses
+
+Supplier rows are turned into response dictionaries straight from column
+tuples. The field names and timestamp conversions of a field list are
+worked out once, so that a list response only zips each row, and the result
+is encoded with orjson when it is installed, or with MessagePack for
+clients that ask for it.
+"""
+import json
+from datetime import date
+from functools import lru_cache
+import msgpack
+from service.tracing import tracer
+
+try:
+    import orjson
+except ImportError:  # pragma: no cover
+    orjson = None
+
+# Column order of a full supplier row
+SUPPLIER_FIELDS = ("id", "name", "phone", "address", "available", "product_list", "rating",
+                   "created_at", "updated_at")
+
+# Media type of MessagePack payloads
+MSGPACK_MIMETYPE = "application/msgpack"
+
+# Fields holding datetimes, which are returned as ISO 8601 strings
+TIMESTAMP_FIELDS = ("created_at", "updated_at")
+
+
+def isoformat(value):
+    """ Returns a datetime as an ISO 8601 string, None stays None """
+    return value.isoformat() if value is not None else None
+
+
+@lru_cache(maxsize=128)
+def row_serializer(fields=SUPPLIER_FIELDS):
+    """
+    Returns a function that turns a row tuple into a dictionary
+
+    Args:
+        fields (tuple): the column names of the row, in order
+    """
+    unknown = [field for field in fields if field not in SUPPLIER_FIELDS]
+    if unknown:
+        raise ValueError("Unknown supplier fields: {}".format(", ".join(unknown)))
+    timestamps = [field for field in fields if field in TIMESTAMP_FIELDS]
+    if not timestamps:
+        return lambda row: dict(zip(fields, row))
+
+    def serialize(row):
+        result = dict(zip(fields, row))
+        for field in timestamps:
+            result[field] = isoformat(result[field])
+        return result
+    return serialize
+
+
+def serialize_rows(rows, fields=SUPPLIER_FIELDS):
+    """ Serializes a sequence of row tuples into a list of dictionaries """
+    with tracer.span("serialize") as span:
+        results = list(map(row_serializer(tuple(fields)), rows))
+        if span is not None:
+            span.set("rows", len(results))
+        return results
+
+
+def dumps(data, default=None):
+    """Encodes data as JSON bytes, using orjson when it is available
+
+    Args:
+        default (callable): converts values JSON has no type for
+    """
+    if orjson is not None:
+        return orjson.dumps(data, default=default, option=orjson.OPT_NON_STR_KEYS)
+    return json.dumps(data, default=default, separators=(",", ":")).encode("utf-8")
+
+
+def _msgpack_default(value):
+    """ Encodes the values MessagePack has no type for like the JSON encoder does """
+    if isinstance(value, date):
+        return value.isoformat()
+    raise TypeError("Cannot serialize {!r} to MessagePack".format(type(value).__name__))
+
+
+def packb(data):
+    """ Encodes data as MessagePack bytes, datetimes as ISO 8601 strings """
+    return msgpack.packb(data, default=_msgpack_default, use_bin_type=True)
+
+
+def unpackb(data):
+    """Decodes MessagePack bytes
+
+    Raises:
+        ValueError: when data is not a single MessagePack object
+    """
+    try:
+        return msgpack.unpackb(data, raw=False)
+    except (ValueError, msgpack.UnpackException) as error:
+        raise ValueError(str(error) or "incomplete MessagePack data")
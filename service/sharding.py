@@ -0,0 +1,190 @@
+"""
+Hash sharding of the supplier table
+
+When shard URIs are configured the supplier rows are spread over the shard
+databases by a hash of their id, while every other table stays on the
+primary database. Ids come from a sequence on the primary so they are
+unique across shards.
+
+ShardedRoutingSession is the session used in sharded mode. It is built on
+SQLAlchemy's horizontal sharding extension: instances are flushed to the
+shard of their id, lookups by id go to that shard only, and other ORM
+queries of suppliers visit every shard. ShardRouter.gather() runs a core
+select on every shard in parallel for the merged list queries.
+
+A write commits its supplier row on the shard and its rollup and change
+log rows on the primary, one after the other rather than as one two
+phase commit, which would need max_prepared_transactions set on every
+database. If the primary commit fails after the shard commit the
+rollups and the change log miss the write until `flask rollups
+reconcile` repairs them.
+"""
+import zlib
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from flask_sqlalchemy import BaseQuery
+from sqlalchemy import create_engine, func, select
+from sqlalchemy.ext.horizontal_shard import ShardedQuery, ShardedSession
+from sqlalchemy.sql.util import find_tables
+from service.replicas import RoutingSession
+
+logger = logging.getLogger("flask.app.sharding")
+
+# Shard id of the primary database, which keeps the tables that are not sharded
+PRIMARY = "primary"
+
+# Sequence on the primary that supplier ids are allocated from
+ID_SEQUENCE = "supplier_global_id_seq"
+
+
+class ShardingError(Exception):
+    """ Used for statements that cannot be routed to a shard """
+
+
+class ShardRouter:
+    """ Maps supplier ids to shard engines and runs selects on every shard """
+
+    def __init__(self):
+        self.engines = {}
+        self.tables = set()
+        self._executor = None
+
+    @property
+    def enabled(self):
+        """ True when shard databases are configured """
+        return bool(self.engines)
+
+    @property
+    def shard_ids(self):
+        """ The shard ids in configuration order """
+        return list(self.engines)
+
+    def configure(self, uris, tables=()):
+        """Replaces the shards
+
+        Args:
+            uris (list): database URIs of the shards, empty to keep every
+                table on the primary. The number of shards must not change
+                once suppliers are stored.
+            tables (iterable): names of the tables that are sharded
+        """
+        for engine in self.engines.values():
+            engine.dispose()
+        if self._executor is not None:
+            self._executor.shutdown(wait=False)
+        self.engines = {"shard{}".format(i): create_engine(uri) for i, uri in enumerate(uris)}
+        self.tables = set(tables)
+        self._executor = ThreadPoolExecutor(len(uris), "shard") if uris else None
+
+    def shard_of(self, supplier_id):
+        """ Returns the id of the shard that stores a supplier """
+        digest = zlib.crc32(int(supplier_id).to_bytes(8, "little", signed=True))
+        return self.shard_ids[digest % len(self.engines)]
+
+    def engine_for(self, supplier_id):
+        """ Returns the engine of the shard that stores a supplier """
+        return self.engines[self.shard_of(supplier_id)]
+
+    def group(self, supplier_ids):
+        """ Returns the given ids grouped by shard id """
+        groups = {}
+        for supplier_id in supplier_ids:
+            groups.setdefault(self.shard_of(supplier_id), []).append(supplier_id)
+        return groups
+
+    def gather(self, statements):
+        """Runs selects on the shards in parallel
+
+        Args:
+            statements: a statement to run on every shard, or a dictionary
+                of shard id to the statement to run on that shard
+
+        Returns:
+            a list of row lists, one per shard that was queried
+        """
+        if not isinstance(statements, dict):
+            statements = dict.fromkeys(self.engines, statements)
+
+        def run(shard_id):
+            with self.engines[shard_id].connect() as connection:
+                return [tuple(row) for row in connection.execute(statements[shard_id])]
+
+        return list(self._executor.map(run, statements))
+
+    def sharded(self, mapper=None, clause=None):
+        """ Returns True if a mapper or clause uses a sharded table """
+        if mapper is not None:
+            return mapper.persist_selectable.name in self.tables
+        if clause is not None:
+            return any(getattr(table, "name", None) in self.tables
+                       for table in find_tables(clause, include_crud=True))
+        return False
+
+
+# The router used by the Supplier model
+router = ShardRouter()
+
+
+def allocate_id(session):
+    """ Returns the next supplier id from the sequence on the primary """
+    return session.execute(select([func.nextval(ID_SEQUENCE)])).scalar()
+
+
+######################################################################
+#  S E S S I O N
+######################################################################
+def choose_shard(mapper, instance, clause=None):
+    """ Returns the shard of a flushed instance or of a statement """
+    if instance is not None and router.sharded(mapper=mapper):
+        if instance.id is None:
+            raise ShardingError("Suppliers need an id before they can be routed to a shard")
+        return router.shard_of(instance.id)
+    if router.sharded(mapper=mapper, clause=clause):
+        raise ShardingError("Statements on sharded tables must be run on a shard")
+    return PRIMARY
+
+
+def choose_by_id(query, ident):
+    """ Returns the shards where a primary key may be found """
+    if router.sharded(mapper=query._bind_mapper()):  # pylint: disable=protected-access
+        return [router.shard_of(ident[0])]
+    return [PRIMARY]
+
+
+def choose_by_query(query):
+    """ Returns the shards an ORM query is run on """
+    if router.sharded(mapper=query._bind_mapper()):  # pylint: disable=protected-access
+        return router.shard_ids
+    return [PRIMARY]
+
+
+class ShardedBaseQuery(ShardedQuery, BaseQuery):
+    """ The Flask-SQLAlchemy query class for sharded sessions """
+
+    def count(self):
+        if self._shard_id is not None:
+            return super().count()
+        return sum(self.set_shard(shard_id).count() for shard_id in self.query_chooser(self))
+
+
+class ShardedRoutingSession(ShardedSession):
+    """ A Flask-SQLAlchemy session over the primary and the shards """
+
+    def __init__(self, db, autocommit=False, autoflush=True, **options):
+        self.app = db.get_app()
+        options.pop("bind", None)
+        options.pop("binds", None)
+        options["query_cls"] = ShardedBaseQuery
+        shards = dict(router.engines, **{PRIMARY: db.engine})
+        ShardedSession.__init__(
+            self, choose_shard, choose_by_id, choose_by_query, shards=shards,
+            autocommit=autocommit, autoflush=autoflush, **options
+        )
+
+
+def use_sessions(db):
+    """ Rebuilds the sessions of db for the current shard configuration """
+    db.session.remove()
+    db.session_class = ShardedRoutingSession if router.enabled else RoutingSession
+    db.Model.query_class = ShardedBaseQuery if router.enabled else BaseQuery
+    db.session = db.create_scoped_session()
@@ -0,0 +1,370 @@
+"""
+Request tracing for the Supplier service
+
+A sampled request gets a server span, and the work done while serving it
+(authentication, argument parsing, database statements, serialization and
+response encoding) gets child spans. The W3C traceparent header of a
+request is continued: its trace id and parent span are kept and its
+sampled flag is honoured, other requests are sampled at the configured
+rate. Code that opens a span while no sampled request is being served
+gets a no-op, so tracing costs a context variable lookup when it is off.
+
+Finished spans are batched by BatchExporter on a background thread and
+written as OTLP JSON, one export request per line, to a file or posted to
+a collector's /v1/traces endpoint.
+"""
+import re
+import json
+import time
+import queue
+import atexit
+import random
+import logging
+import threading
+import urllib.request
+from contextlib import nullcontext
+from contextvars import ContextVar
+from flask import g, request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+logger = logging.getLogger("flask.app.tracing")
+
+# traceparent header of version 00: trace id, parent span id and flags
+TRACEPARENT = re.compile(r"^00-([0-9a-f]{32})-([0-9a-f]{16})-([0-9a-f]{2})$")
+SAMPLED_FLAG = 0x01
+
+# OTLP span kinds
+KIND_INTERNAL = 1
+KIND_SERVER = 2
+KIND_CLIENT = 3
+
+# OTLP status codes
+STATUS_OK = 1
+STATUS_ERROR = 2
+
+# Longest database statement recorded on a span
+MAX_STATEMENT_LENGTH = 1000
+
+# The no-op returned by Tracer.span() outside a sampled request
+NO_SPAN = nullcontext()
+
+
+def attribute(key, value):
+    """ Returns an attribute as an OTLP key and typed value """
+    if isinstance(value, bool):
+        typed = {"boolValue": value}
+    elif isinstance(value, int):
+        typed = {"intValue": str(value)}
+    elif isinstance(value, float):
+        typed = {"doubleValue": value}
+    else:
+        typed = {"stringValue": str(value)}
+    return {"key": key, "value": typed}
+
+
+class Span:
+    """ A timed operation of a trace """
+
+    __slots__ = ("name", "trace_id", "span_id", "parent_id", "kind", "attributes",
+                 "start", "end", "error")
+
+    def __init__(self, name, trace_id, parent_id=None, kind=KIND_INTERNAL, attributes=None):
+        self.name = name
+        self.trace_id = trace_id
+        self.span_id = "%016x" % random.getrandbits(64)
+        self.parent_id = parent_id
+        self.kind = kind
+        self.attributes = attributes or {}
+        self.start = time.time_ns()
+        self.end = None
+        self.error = None
+
+    def set(self, key, value):
+        """ Sets an attribute of the span """
+        self.attributes[key] = value
+
+    def finish(self, error=None):
+        """ Ends the span, recording the error that ended it if any """
+        self.end = time.time_ns()
+        if error is not None:
+            self.error = "{}: {}".format(type(error).__name__, error)
+
+    def serialize(self):
+        """ Serializes the span into an OTLP JSON span """
+        data = {
+            "traceId": self.trace_id,
+            "spanId": self.span_id,
+            "name": self.name,
+            "kind": self.kind,
+            "startTimeUnixNano": str(self.start),
+            "endTimeUnixNano": str(self.end),
+            "attributes": [attribute(key, value) for key, value in self.attributes.items()],
+            "status": {"code": STATUS_OK} if self.error is None
+                      else {"code": STATUS_ERROR, "message": self.error},
+        }
+        if self.parent_id:
+            data["parentSpanId"] = self.parent_id
+        return data
+
+
+class ActiveSpan:
+    """ Makes a span current for the duration of a with block """
+
+    def __init__(self, tracer, span):
+        self.tracer = tracer
+        self.span = span
+        self.token = None
+
+    def __enter__(self):
+        self.token = self.tracer.activate(self.span)
+        return self.span
+
+    def __exit__(self, _type, error, _traceback):
+        self.tracer.deactivate(self.token)
+        self.span.finish(error)
+        self.tracer.export(self.span)
+        return False
+
+
+class BatchExporter:
+    """
+    Writes finished spans in batches from a background thread
+
+    Args:
+        target (string): a file path, or an http(s) URL of an OTLP/HTTP
+            collector traces endpoint
+        batch_size (int): the most spans written at once
+        interval (float): the most seconds a span waits to be written
+        maxsize (int): the most spans waiting, further spans are dropped
+    """
+
+    def __init__(self, target, batch_size=512, interval=5.0, maxsize=10000, service="supplier"):
+        self.target = target
+        self.batch_size = batch_size
+        self.interval = interval
+        self.resource = {"attributes": [attribute("service.name", service)]}
+        self.spans = queue.Queue(maxsize)
+        self.dropped = 0
+        self._thread = None
+        self._start_lock = threading.Lock()
+        self._write_lock = threading.Lock()
+
+    def export(self, span):
+        """ Queues a finished span """
+        if self._thread is None:
+            self._start()
+        try:
+            self.spans.put_nowait(span)
+        except queue.Full:
+            self.dropped += 1
+
+    def flush(self, timeout=10):
+        """ Writes the queued spans, waiting up to timeout seconds for the writer thread """
+        if self._thread is None:
+            return
+        written = threading.Event()
+        try:
+            self.spans.put(written, timeout=timeout)
+        except queue.Full:
+            return
+        written.wait(timeout)
+
+    def write(self, batch):
+        """ Writes one batch of spans as an OTLP export request """
+        body = json.dumps({"resourceSpans": [{
+            "resource": self.resource,
+            "scopeSpans": [{
+                "scope": {"name": __name__},
+                "spans": [span.serialize() for span in batch],
+            }],
+        }]}, separators=(",", ":")).encode("utf-8")
+        try:
+            with self._write_lock:
+                if self.target.startswith(("http://", "https://")):
+                    post = urllib.request.Request(self.target, data=body, method="POST",
+                                                  headers={"Content-Type": "application/json"})
+                    urllib.request.urlopen(post, timeout=5).close()
+                else:
+                    with open(self.target, "ab") as output:
+                        output.write(body + b"\n")
+        except OSError as error:
+            logger.warning("Could not export %d spans to %s: %s", len(batch), self.target, error)
+
+    def _start(self):
+        """ Starts the writer thread, in the process that exports """
+        with self._start_lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="span-exporter", daemon=True)
+                self._thread.start()
+                atexit.register(self.flush)
+
+    def _run(self):
+        while True:
+            deadline = time.monotonic() + self.interval
+            batch, flushed = [], None
+            while len(batch) < self.batch_size and flushed is None:
+                try:
+                    item = self.spans.get(timeout=max(deadline - time.monotonic(), 0))
+                except queue.Empty:
+                    break
+                if isinstance(item, threading.Event):
+                    flushed = item
+                else:
+                    batch.append(item)
+            if batch:
+                self.write(batch)
+            if flushed is not None:
+                flushed.set()
+
+
+class Tracer:
+    """ Starts the spans of sampled requests and hands finished spans to an exporter """
+
+    def __init__(self):
+        self.sample_rate = 0.0
+        self.exporter = None
+        self._current = ContextVar("span", default=None)
+
+    def configure(self, sample_rate=0.0, exporter=None):
+        """Replaces the sampling rate and exporter
+
+        Args:
+            sample_rate (float): the fraction of requests without a
+                traceparent that are traced
+            exporter (BatchExporter): where finished spans go, None turns
+                tracing off
+        """
+        self.sample_rate = sample_rate
+        self.exporter = exporter
+
+    @property
+    def current(self):
+        """ The span of the current context, None when it is not traced """
+        return self._current.get()
+
+    def activate(self, span):
+        """ Makes span current and returns the token that deactivates it """
+        return self._current.set(span)
+
+    def deactivate(self, token):
+        """ Restores the span that was current before activate() """
+        self._current.reset(token)
+
+    def export(self, span):
+        """ Hands a finished span to the exporter """
+        if self.exporter is not None:
+            self.exporter.export(span)
+
+    def start_trace(self, name, traceparent=None, **attributes):
+        """Returns the server span of a request, None when it is not sampled
+
+        The trace of a valid traceparent header is continued and sampled when
+        its sampled flag is set, other requests are sampled at sample_rate.
+        """
+        if self.exporter is None:
+            return None
+        match = TRACEPARENT.match(traceparent or "")
+        if match and match.group(1) != "0" * 32 and match.group(2) != "0" * 16:
+            if not int(match.group(3), 16) & SAMPLED_FLAG:
+                return None
+            trace_id, parent_id = match.group(1), match.group(2)
+        elif random.random() < self.sample_rate:
+            trace_id, parent_id = "%032x" % random.getrandbits(128), None
+        else:
+            return None
+        return Span(name, trace_id, parent_id, KIND_SERVER, attributes)
+
+    def span(self, name, kind=KIND_INTERNAL, **attributes):
+        """Returns a context manager timing a block as a child of the current span
+
+        Outside a sampled request it is a no-op that yields None.
+        """
+        parent = self._current.get()
+        if parent is None:
+            return NO_SPAN
+        return ActiveSpan(self, Span(name, parent.trace_id, parent.span_id, kind, attributes))
+
+
+# The tracer of the service
+tracer = Tracer()
+
+
+######################################################################
+#  D A T A B A S E   S P A N S
+######################################################################
+@event.listens_for(Engine, "before_cursor_execute")
+def start_statement(conn, _cursor, statement, _parameters, _context, _executemany):
+    """ Opens a span for a database statement run while tracing """
+    parent = tracer.current
+    if parent is None:
+        return
+    span = Span("db.query", parent.trace_id, parent.span_id, KIND_CLIENT, {
+        "db.system": "postgresql",
+        "db.statement": statement[:MAX_STATEMENT_LENGTH],
+        "net.peer.name": conn.engine.url.host or "",
+    })
+    conn.info.setdefault("spans", []).append(span)
+
+
+@event.listens_for(Engine, "after_cursor_execute")
+def end_statement(conn, cursor, _statement, _parameters, _context, _executemany):
+    """ Closes the span of a database statement """
+    spans = conn.info.get("spans")
+    if spans:
+        span = spans.pop()
+        span.set("db.rows", cursor.rowcount)
+        span.finish()
+        tracer.export(span)
+
+
+@event.listens_for(Engine, "handle_error")
+def fail_statement(context):
+    """ Closes the span of a database statement that failed """
+    spans = context.connection.info.get("spans") if context.connection is not None else None
+    if spans:
+        span = spans.pop()
+        span.finish(context.original_exception)
+        tracer.export(span)
+
+
+######################################################################
+#  R E Q U E S T   S P A N S
+######################################################################
+def start_request():
+    """ Starts the server span of a sampled request """
+    rule = request.url_rule.rule if request.url_rule is not None else request.path
+    span = tracer.start_trace("{} {}".format(request.method, rule),
+                              request.headers.get("traceparent"),
+                              **{"http.method": request.method, "http.target": request.full_path})
+    if span is not None:
+        g.trace = (span, tracer.activate(span))
+
+
+def tag_response(response):
+    """ Records the status of a traced response """
+    trace = g.get("trace")
+    if trace is not None:
+        trace[0].set("http.status_code", response.status_code)
+    return response
+
+
+def end_request(error=None):
+    """ Ends the server span of a traced request """
+    trace = g.pop("trace", None)
+    if trace is not None:
+        span, token = trace
+        tracer.deactivate(token)
+        span.finish(error)
+        tracer.export(span)
+
+
+def init_app(app):
+    """ Configures the tracer from the app config and traces the requests of app """
+    target = app.config.get("TRACE_EXPORT", "")
+    exporter = BatchExporter(target, interval=app.config.get("TRACE_EXPORT_INTERVAL", 5.0)) \
+        if target else None
+    tracer.configure(app.config.get("TRACE_SAMPLE_RATE", 0.0), exporter)
+    app.before_request(start_request)
+    app.after_request(tag_response)
+    app.teardown_request(end_request)
@@ -0,0 +1,87 @@
+"""
+Test cases for the Supplier name autocomplete index
+
+Test cases can be run with the following:
+  nosetests
+"""
+from unittest import TestCase
+from service.autocomplete import PrefixIndex, normalize
+
+
+######################################################################
+#  A U T O C O M P L E T E   T E S T   C A S E S
+######################################################################
+class TestPrefixIndex(TestCase):
+    """ Test Cases for PrefixIndex """
+
+    def setUp(self):
+        """ This runs before each test """
+        self.index = PrefixIndex(scan_limit=2)
+        self.index.build([
+            (1, "ACME Corp", 4.5),
+            (2, "Acme Parts", 3.0),
+            (3, "Ácmé  Supplies, Inc.", 4.9),
+            (4, "Perez LLC", 2.7),
+        ])
+
+    def test_normalize(self):
+        """ Fold case, accents, punctuation and whitespace """
+        self.assertEqual(normalize("  Ácmé  Supplies, Inc. "), "acme supplies inc")
+
+    def test_search_by_rating(self):
+        """ Return the matches best rated first """
+        self.assertEqual([row[0] for row in self.index.search("acm")], [3, 1, 2])
+        self.assertEqual(self.index.search("ACME c"), [(1, "ACME Corp", 4.5)])
+        self.assertEqual(self.index.search("acme", limit=1), [(3, "Ácmé  Supplies, Inc.", 4.9)])
+        self.assertEqual(self.index.search("xyz"), [])
+
+    def test_writes_update_cached_results(self):
+        """ Keep cached wide prefixes current after writes """
+        self.assertEqual([row[0] for row in self.index.search("a")], [3, 1, 2])
+        self.index.on_write("create", {"id": 5, "name": "Aardvark Ltd", "rating": 5.0})
+        self.index.on_write("update", {"id": 2, "name": "Zeta Parts", "rating": 3.0})
+        self.index.on_write("delete", {"id": 3, "name": "Ácmé  Supplies, Inc.", "rating": 4.9})
+        self.assertEqual([row[0] for row in self.index.search("a")], [5, 1])
+        self.assertEqual(len(self.index), 4)
+
+    def test_max_entries(self):
+        """ Keep only the best rated suppliers when full """
+        index = PrefixIndex(max_entries=2)
+        index.build([(1, "Acme", 4.0), (2, "Apex", 3.0), (3, "Atlas", 2.0)])
+        self.assertEqual(len(index), 2)
+        index.add(4, "Alpha", 1.0)
+        self.assertEqual([row[0] for row in index.search("a")], [1, 2])
+        index.add(5, "Astra", 5.0)
+        self.assertEqual([row[0] for row in index.search("a")], [5, 1])
+
+    def test_max_entries_after_updates(self):
+        """ Evict the lowest current rating after ratings change """
+        index = PrefixIndex(max_entries=3)
+        index.build([(1, "Acme", 4.0), (2, "Apex", 3.0), (3, "Atlas", 2.0)])
+        for rating in (1.0, 4.5, 2.5):
+            index.add(3, "Atlas", rating)
+        index.add(2, "Apex", 1.5)
+        index.add(4, "Alpha", 2.0)
+        self.assertEqual([row[0] for row in index.search("a")], [1, 3, 4])
+
+    def test_refresh_replays_writes(self):
+        """ Keep the writes made while the index is rebuilt """
+        rows = [(1, "ACME Corp", 4.5), (2, "Acme Parts", 3.0)]
+        self.assertTrue(self.index.begin_refresh())
+        self.assertFalse(self.index.begin_refresh())
+        self.index.on_write("create", {"id": 5, "name": "Acme Tools", "rating": 5.0})
+        self.index.on_write("delete", {"id": 2, "name": "Acme Parts", "rating": 3.0})
+        self.assertEqual([row[0] for row in self.index.search("acme")], [5, 3, 1])
+        self.index.build(rows)
+        self.assertEqual([row[0] for row in self.index.search("acme")], [5, 1])
+        self.assertTrue(self.index.begin_refresh())
+        self.index.end_refresh()
+        self.assertTrue(self.index.begin_refresh())
+
+    def test_stale(self):
+        """ Ask for a rebuild once the refresh interval has passed """
+        self.assertTrue(PrefixIndex().stale)
+        self.assertFalse(self.index.stale)
+        self.index.refresh = 1
+        self.index.built_at -= 2
+        self.assertTrue(self.index.stale)
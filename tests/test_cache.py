@@ -0,0 +1,135 @@
+"""
+Test cases for the in-process caches
+
+Test cases can be run with the following:
+  nosetests
+"""
+import os
+import tempfile
+import multiprocessing
+from unittest import TestCase
+from unittest.mock import patch
+from service.cache import ResponseCache, SharedCounter, TTLCache
+
+
+def bump(path, times):
+    """ Bumps a counter from another process """
+    counter = SharedCounter(path)
+    for _ in range(times):
+        counter.bump()
+
+
+######################################################################
+#  C A C H E   T E S T   C A S E S
+######################################################################
+class TestTTLCache(TestCase):
+    """ Test Cases for TTLCache """
+
+    def test_get_and_set(self):
+        """ Store and read back a value """
+        cache = TTLCache(10)
+        self.assertIsNone(cache.get("key"))
+        cache.set("key", "value")
+        self.assertEqual(cache.get("key"), "value")
+
+    def test_expiry(self):
+        """ Drop values older than the ttl """
+        cache = TTLCache(10)
+        with patch("service.cache.time.monotonic", return_value=100):
+            cache.set("key", "value")
+        with patch("service.cache.time.monotonic", return_value=111):
+            self.assertIsNone(cache.get("key"))
+        self.assertEqual(len(cache), 0)
+
+    def test_size_limit(self):
+        """ Evict the least recently used value when full """
+        cache = TTLCache(10, maxsize=2)
+        cache.set("a", 1)
+        cache.set("b", 2)
+        cache.get("a")
+        cache.set("c", 3)
+        self.assertEqual(cache.get("a"), 1)
+        self.assertIsNone(cache.get("b"))
+        self.assertEqual(cache.get("c"), 3)
+
+    def test_delete(self):
+        """ Remove a single value """
+        cache = TTLCache(10)
+        cache.set("a", 1)
+        cache.set("b", 2)
+        cache.delete("a")
+        cache.delete("missing")
+        self.assertIsNone(cache.get("a"))
+        self.assertEqual(cache.get("b"), 2)
+
+    def test_disabled(self):
+        """ Store nothing when the ttl is 0 """
+        cache = TTLCache(0)
+        cache.set("key", "value")
+        self.assertIsNone(cache.get("key"))
+
+
+######################################################################
+#  R E S P O N S E   C A C H E   T E S T   C A S E S
+######################################################################
+class TestResponseCache(TestCase):
+    """ Test Cases for SharedCounter and ResponseCache """
+
+    def setUp(self):
+        self.path = tempfile.mktemp(prefix="generation-")
+        self.generation = SharedCounter(self.path)
+
+    def tearDown(self):
+        self.generation.configure()
+        os.unlink(self.path)
+
+    def test_shared_counter(self):
+        """ Count the bumps of every process """
+        self.assertEqual(self.generation.value, 0)
+        self.assertEqual(self.generation.bump(), 1)
+        child = multiprocessing.get_context("fork").Process(target=bump, args=(self.path, 5))
+        child.start()
+        child.join()
+        self.assertEqual(self.generation.value, 6)
+
+    def test_generation(self):
+        """ Serve entries only while the generation they were computed at is current """
+        cache = ResponseCache(self.generation, 1000)
+        cache.set("a", 0, b"[]", "application/json", {"X-Total": "0"})
+        self.assertEqual(cache.get("a"), (b"[]", "application/json", {"X-Total": "0"}))
+        self.generation.bump()
+        self.assertIsNone(cache.get("a"))
+        self.assertEqual((len(cache), cache.size), (0, 0))
+        # results computed before the write are not stored
+        cache.set("a", 0, b"[]", "application/json")
+        self.assertIsNone(cache.get("a"))
+        self.assertEqual((cache.hits, cache.misses), (1, 2))
+
+    def test_size_limit(self):
+        """ Evict the least recently used bodies past the byte limit """
+        cache = ResponseCache(self.generation, 10, max_entry_bytes=6)
+        cache.set("a", 0, b"aaaa", "text/plain")
+        cache.set("b", 0, b"bbbb", "text/plain")
+        cache.get("a")
+        cache.set("c", 0, b"cccc", "text/plain")
+        cache.set("d", 0, b"ddddddd", "text/plain")
+        self.assertIsNotNone(cache.get("a"))
+        self.assertIsNone(cache.get("b"))
+        self.assertIsNotNone(cache.get("c"))
+        self.assertIsNone(cache.get("d"))
+        self.assertEqual(cache.size, 8)
+
+    def test_ttl(self):
+        """ Drop entries older than the ttl """
+        cache = ResponseCache(self.generation, 1000, ttl=10)
+        with patch("service.cache.time.monotonic", return_value=100):
+            cache.set("a", 0, b"[]", "application/json")
+        with patch("service.cache.time.monotonic", return_value=111):
+            self.assertIsNone(cache.get("a"))
+
+    def test_disabled(self):
+        """ Store nothing without a byte limit """
+        cache = ResponseCache(self.generation, 0)
+        self.assertFalse(cache.enabled)
+        cache.set("a", 0, b"[]", "application/json")
+        self.assertIsNone(cache.get("a"))
@@ -5,12 +5,16 @@ Test cases can be run with the following:
   nosetests
 """
 
+import time
 import logging
+import threading
 import unittest
 import os
 from werkzeug.exceptions import NotFound
+from sqlalchemy import func, select
 from service import app
-from service.models import Supplier, DataValidationError, db
+from service.models import Supplier, ProductRollup, SupplierChange, SupplierProduct, \
+    DataValidationError, db, normalize_phone
 from .factories import SupplierFactory
 
 DATABASE_URI = os.getenv(
@@ -212,3 +216,425 @@ class TestSupplierModel(unittest.TestCase):
         suppliers = Supplier.find_by_greater_rating(3.5)
         supplier_list = [supplier for supplier in suppliers]
         self.assertEqual(len(supplier_list), 2)
+
+    def test_find_rows(self):
+        """Test listing suppliers as read-only tuples"""
+        suppliers = SupplierFactory.create_batch(3)
+        for supplier in suppliers:
+            supplier.create()
+        expected = (suppliers[0].id, suppliers[0].name, suppliers[0].phone,
+                    suppliers[0].address, suppliers[0].available,
+                    suppliers[0].product_list, suppliers[0].rating,
+                    suppliers[0].created_at, suppliers[0].updated_at)
+        db.session.expunge_all()
+        rows = Supplier.find_rows()
+        self.assertEqual(len(rows), 3)
+        self.assertEqual(len(db.session.identity_map), 0)
+        self.assertIn(expected, rows)
+
+    def test_find_rows_with_filters(self):
+        """Test combining filters on the row query"""
+        Supplier(name="Graves, Thompson and Pena", phone="620-179-7652", \
+            address="5312 Danielle Spurs Apt. 017\nNorth James, SD 47183", \
+                available=True, product_list=[1,2,4,5], rating=3.5).create()
+        Supplier(name="Rogers, Cabrera and Lee", phone="011-526-6218", \
+            address="59869 Padilla Stream Apt. 194\nWest Tanyafort, KY 73107", \
+                available=False, product_list=[1,2,3,5], rating=4.8).create()
+        Supplier(name="Perez LLC", phone="6574-477-5210", \
+            address="41570 Ashley Manors\nNorth Kevinchester, FL 68266", \
+                available=True, product_list=[1,2,3], rating=2.7).create()
+
+        rows = Supplier.find_rows(fields=("name",), available=True, product_id=2, rating=3.0)
+        self.assertEqual(rows, [("Graves, Thompson and Pena",)])
+        self.assertEqual(Supplier.find_rows(product_id=9), [])
+
+    def test_find_rows_sorted_and_limited(self):
+        """Test sorting and paging the row query"""
+        for rating in (3.5, 4.8, 2.7, 4.1):
+            Supplier(name="Supplier {}".format(rating), phone="620-179-7652",
+                     address="5312 Danielle Spurs", available=rating > 3,
+                     product_list=[1, 2], rating=rating).create()
+        rows = Supplier.find_rows(("rating",), sort="rating", descending=True, limit=2)
+        self.assertEqual(rows, [(4.8,), (4.1,)])
+        rows = Supplier.find_rows(("rating",), sort="rating", limit=2, offset=1)
+        self.assertEqual(rows, [(3.5,), (4.1,)])
+        rows = Supplier.find_rows(("name",), sort="name", descending=True,
+                                  available=True, product_id=2, limit=1)
+        self.assertEqual(rows, [("Supplier 4.8",)])
+        # pages of unsorted listings are ordered by id, as when sharded
+        ids = [row[0] for row in Supplier.find_rows(("id",))]
+        rows = Supplier.find_rows(("id",), limit=2) + Supplier.find_rows(("id",), limit=2, offset=2)
+        self.assertEqual([row[0] for row in rows], sorted(ids))
+        self.assertIn("ORDER BY", str(Supplier.select_rows(offset=2)))
+        self.assertNotIn("ORDER BY", str(Supplier.select_rows()))
+
+    def test_find_rows_unrated_last(self):
+        """Sort unrated Suppliers last in both orders"""
+        for rating in (None, 2.5, None, 4.9):
+            Supplier(name="Supplier {}".format(rating), phone="800-555-0100",
+                     address="5312 Danielle Spurs", available=True,
+                     product_list=[1], rating=rating).create()
+        rows = Supplier.find_rows(("rating",), sort="rating", descending=True, limit=2)
+        self.assertEqual(rows, [(4.9,), (2.5,)])
+        rows = Supplier.find_rows(("rating",), sort="rating")
+        self.assertEqual(rows, [(2.5,), (4.9,), (None,), (None,)])
+
+    def test_top_k_uses_index(self):
+        """Test that top-k listings are served by an index scan"""
+        plan = self._explain(Supplier.select_rows(sort="rating", descending=True, limit=10))
+        self.assertIn("ix_supplier_rating_desc_id", plan)
+        self.assertNotIn("Sort", plan)
+        plan = self._explain(Supplier.select_rows(sort="rating", descending=True,
+                                                  available=True, limit=10))
+        self.assertIn("ix_supplier_available_rating_desc_id", plan)
+        self.assertNotIn("Sort", plan)
+
+    def test_search_uses_index(self):
+        """Test that search is served by the full text index"""
+        plan = self._explain(Supplier.select_rows(q="acme corp"))
+        self.assertIn("ix_supplier_search", plan)
+        self.assertNotIn("Seq Scan", plan)
+
+    def test_search_matches_prefixes(self):
+        """Test searching suppliers by words and word prefixes"""
+        Supplier(name="ACME Corp", phone="620-179-7652", address="12 Main Street",
+                 available=True, product_list=[1], rating=3.5).create()
+        Supplier(name="Perez LLC", phone="6574-477-5210", address="41570 Ashley Manors",
+                 available=True, product_list=[1], rating=2.7).create()
+        self.assertEqual(Supplier.find_rows(("name",), q="acme"), [("ACME Corp",)])
+        self.assertEqual(Supplier.find_rows(("name",), q="Ashl"), [("Perez LLC",)])
+        self.assertEqual(Supplier.find_rows(("name",), q="main perez"), [])
+
+    def test_normalize_phone(self):
+        """Test the canonical form of phone numbers"""
+        self.assertEqual(normalize_phone("(620) 179-7652"), "+16201797652")
+        self.assertEqual(normalize_phone("+1 620.179.7652"), "+16201797652")
+        self.assertEqual(normalize_phone("1-620-179-7652"), "+16201797652")
+        self.assertEqual(normalize_phone("001-620-179-7652x914"), "+16201797652x914")
+        self.assertEqual(normalize_phone("620-179-7652 ext. 12"), "+16201797652x12")
+        self.assertEqual(normalize_phone("+44 20 7946 0958"), "+442079460958")
+        self.assertIsNone(normalize_phone("n/a"))
+        self.assertIsNone(normalize_phone(None))
+
+    def test_find_by_phone_in_any_format(self):
+        """Test finding suppliers by phone written differently"""
+        supplier = Supplier(name="Perez LLC", phone="(620) 179-7652", address="41570 Ashley Manors",
+                            available=True, product_list=[1], rating=2.7)
+        supplier.create()
+        self.assertEqual(supplier.phone_normalized, "+16201797652")
+        found = Supplier.find_by_phone("+1 620 179 7652").all()
+        self.assertEqual([s.id for s in found], [supplier.id])
+        self.assertEqual(Supplier.find_rows(("phone",), phone="620.179.7652"), [("(620) 179-7652",)])
+
+    def test_backfill_phones(self):
+        """Test normalizing the phones of existing suppliers in batches"""
+        suppliers = SupplierFactory.create_batch(5)
+        for supplier in suppliers:
+            supplier.create()
+        db.session.execute(Supplier.__table__.update().values(phone_normalized=None))
+        db.session.commit()
+        self.assertEqual(Supplier.backfill_phones(batch_size=2), 5)
+        self.assertEqual(Supplier.backfill_phones(batch_size=2), 0)
+        for supplier in suppliers:
+            self.assertEqual(Supplier.find(supplier.id).phone_normalized,
+                             normalize_phone(supplier.phone))
+
+    def test_longest_phones(self):
+        """Test storing the normalized form of the longest phones"""
+        for phone in ("9" * 63, "+" + "9" * 50 + " x" + "9" * 10, "1" * 40):
+            supplier = Supplier(name="Perez LLC", phone=phone, address="41570 Ashley Manors",
+                                available=True, product_list=[1], rating=2.7)
+            supplier.create()
+            self.assertEqual(Supplier.find(supplier.id).phone_normalized, normalize_phone(phone))
+        self.assertEqual(len(normalize_phone("9" * 63)), 64)
+
+    def test_upgrade_widens_phone_normalized(self):
+        """Test that tables of older releases get a wide enough phone_normalized"""
+        db.session.execute("ALTER TABLE supplier ALTER COLUMN phone_normalized TYPE VARCHAR(32)")
+        db.session.commit()
+        Supplier.upgrade_schema()
+        length = db.session.execute(
+            "SELECT character_maximum_length FROM information_schema.columns "
+            "WHERE table_name = 'supplier' AND column_name = 'phone_normalized'").scalar()
+        self.assertEqual(length, 64)
+
+    def test_phone_lookup_uses_index(self):
+        """Test that phone lookups probe the normalized phone index"""
+        plan = self._explain(Supplier.select_rows(phone="(620) 179-7652"))
+        self.assertIn("ix_supplier_phone_normalized", plan)
+
+    def test_find_by_name_insensitive(self):
+        """Test finding suppliers by name and address ignoring case and whitespace"""
+        supplier = Supplier(name="Graves, Thompson and Pena", phone="620-179-7652",
+                            address="5312 Danielle Spurs Apt. 017\nNorth James, SD 47183",
+                            available=True, product_list=[1], rating=3.5)
+        supplier.create()
+        self.assertEqual(Supplier.find_by_name("GRAVES, thompson  and pena ").count(), 0)
+        found = Supplier.find_by_name("GRAVES, thompson  and pena ", insensitive=True).all()
+        self.assertEqual([s.id for s in found], [supplier.id])
+        found = Supplier.find_by_address("5312 danielle spurs apt. 017 north james, sd 47183",
+                                         insensitive=True).all()
+        self.assertEqual([s.id for s in found], [supplier.id])
+        rows = Supplier.find_rows(("id",), name=" graves, THOMPSON and pena", match="insensitive")
+        self.assertEqual(rows, [(supplier.id,)])
+
+    def test_insensitive_lookups_use_index(self):
+        """Test that insensitive lookups never fall back to sequential scans"""
+        plan = self._explain(Supplier.select_rows(name=" ACME  Corp", match="insensitive"))
+        self.assertIn("ix_supplier_name_folded", plan)
+        self.assertNotIn("Seq Scan", plan)
+        plan = self._explain(Supplier.select_rows(address="12 MAIN st", match="insensitive"))
+        self.assertIn("ix_supplier_address_folded", plan)
+        self.assertNotIn("Seq Scan", plan)
+
+    def test_rollups_follow_writes(self):
+        """Test that product rollups follow create, update and delete"""
+        first = Supplier(name="Perez LLC", phone="6574-477-5210", address="41570 Ashley Manors",
+                         available=True, product_list=[1, 2], rating=3.0)
+        first.create()
+        second = Supplier(name="Rogers, Cabrera and Lee", phone="011-526-6218",
+                          address="59869 Padilla Stream", available=False,
+                          product_list=[2, 3], rating=4.0)
+        second.create()
+        self.assertEqual(ProductRollup.find(2).serialize(), {
+            "product_id": 2, "supplier_count": 2, "available_count": 1,
+            "rating_sum": 7.0, "average_rating": 3.5})
+
+        second = Supplier.find(second.id)
+        second.deserialize({"name": second.name, "phone": second.phone,
+                            "address": second.address, "available": True,
+                            "product_list": [3, 4], "rating": 2.0})
+        second.update()
+        self.assertEqual(ProductRollup.find(2).supplier_count, 1)
+        self.assertEqual(ProductRollup.find(3).available_count, 1)
+        self.assertEqual(ProductRollup.find(4).rating_sum, 2.0)
+
+        first.delete()
+        self.assertEqual(ProductRollup.find(1).supplier_count, 0)
+        self.assertEqual([rollup.product_id for rollup in ProductRollup.all()], [3, 4])
+        self.assertEqual(ProductRollup.drift(), [])
+
+    def test_rollups_follow_stale_writes(self):
+        """Test that rollups start from the committed values, not stale loaded ones"""
+        supplier = Supplier(name="Perez LLC", phone="6574-477-5210", address="41570 Ashley Manors",
+                            available=True, product_list=[1, 2], rating=3.0)
+        supplier.create()
+        stale = Supplier.find(supplier.id)
+        db.session.expunge(stale)
+        fresh = Supplier.find(supplier.id)
+        fresh.product_list = [2, 3]
+        fresh.rating = 5.0
+        fresh.update()
+        db.session.expunge(fresh)
+        # a concurrent write loaded before the one above committed
+        stale = db.session.merge(stale, load=False)
+        stale.available = False
+        stale.update()
+        self.assertEqual(ProductRollup.drift(), [])
+        self.assertEqual(ProductRollup.find(1).supplier_count, 0)
+        self.assertEqual(ProductRollup.find(2).available_count, 0)
+
+    def test_rollups_rebuild(self):
+        """Test detecting and repairing rollup drift"""
+        suppliers = SupplierFactory.create_batch(4)
+        for supplier in suppliers:
+            supplier.create()
+        self.assertEqual(ProductRollup.drift(), [])
+        rollup = ProductRollup.find(suppliers[0].product_list[0])
+        rollup.supplier_count += 5
+        db.session.commit()
+        drifted = ProductRollup.drift()
+        self.assertEqual([product_id for product_id, _, _ in drifted], [rollup.product_id])
+        ProductRollup.rebuild()
+        self.assertEqual(ProductRollup.drift(), [])
+
+    def test_timestamps(self):
+        """Test that created_at and updated_at follow the writes"""
+        supplier = SupplierFactory()
+        supplier.create()
+        supplier_id = supplier.id
+        self.assertIsNotNone(supplier.created_at)
+        self.assertEqual(supplier.updated_at, supplier.created_at)
+        created_at = supplier.created_at
+
+        supplier.name = "Renamed"
+        supplier.update()
+        self.assertGreater(supplier.updated_at, created_at)
+        self.assertEqual(supplier.created_at, created_at)
+        record = SupplierChange.since()[-1]["supplier"]
+        self.assertEqual(record["updated_at"], supplier.updated_at.isoformat())
+
+        # writes made outside the service are stamped by the trigger too
+        updated_at = supplier.updated_at
+        db.session.execute(Supplier.__table__.update().values(rating=1.0))
+        db.session.commit()
+        self.assertGreater(Supplier.find(supplier_id).updated_at, updated_at)
+
+    def test_find_rows_updated_since(self):
+        """Test listing the suppliers written since a time"""
+        suppliers = SupplierFactory.create_batch(3)
+        for supplier in suppliers:
+            supplier.create()
+        since = db.session.execute(select([func.clock_timestamp()])).scalar()
+        db.session.commit()
+        for supplier in suppliers[1:]:
+            supplier.available = not supplier.available
+            supplier.update()
+        ids = [suppliers[2].id, suppliers[1].id]
+        rows = Supplier.find_rows(("id",), updated_since=since, sort="updated_at", descending=True)
+        self.assertEqual(rows, [(supplier_id,) for supplier_id in ids])
+        rows = Supplier.find_rows(("id",), updated_since=since, sort="updated_at", limit=1, offset=1)
+        self.assertEqual(rows, [(ids[0],)])
+        self.assertEqual(Supplier.changed_since(since), set(ids))
+        plan = self._explain(Supplier.select_rows(("id",), sort="updated_at", limit=10))
+        self.assertIn("ix_supplier_updated_at_id", plan)
+
+    def test_rollups_reconcile_since(self):
+        """Test checking only the rollups of products touched since a time"""
+        untouched = Supplier(name="ACME Corp", phone="620-179-7652", address="12 Main Street",
+                             available=True, product_list=[1, 2], rating=3.5)
+        changed = Supplier(name="Perez LLC", phone="6574-477-5210", address="41570 Ashley Manors",
+                           available=True, product_list=[3, 4], rating=2.7)
+        for supplier in (untouched, changed):
+            supplier.create()
+        since = db.session.execute(select([func.clock_timestamp()])).scalar()
+        db.session.commit()
+        changed.product_list = [4, 5]
+        changed.update()
+        self.assertEqual(ProductRollup.touched(since), {3, 4, 5})
+
+        table = ProductRollup.__table__
+        db.session.execute(table.update().values(supplier_count=table.c.supplier_count + 1))
+        db.session.commit()
+        drifted = ProductRollup.drift(product_ids=ProductRollup.touched(since))
+        self.assertEqual([product_id for product_id, _, _ in drifted], [3, 4, 5])
+        ProductRollup.rebuild([3, 4, 5])
+        self.assertEqual([product_id for product_id, _, _ in ProductRollup.drift()], [1, 2])
+        self.assertEqual(ProductRollup.drift(product_ids=[]), [])
+
+    def test_find_offers(self):
+        """Test finding the suppliers of many products with one query"""
+        first = SupplierFactory(product_list=[1, 2, 2])
+        second = SupplierFactory(product_list=[2, 3])
+        for supplier in (first, second):
+            supplier.create()
+        offers = [(1, first.id), (2, first.id), (2, second.id), (3, second.id)]
+        self.assertEqual(Supplier.find_offers([3, 2, 1, 42]), offers)
+        self.assertEqual(Supplier.find_offers([1, 2, 3], limit=2, offset=1), offers[1:3])
+        self.assertEqual(Supplier.find_rows_by_ids([second.id, 0, first.id], ("id",)),
+                         [(first.id,), (second.id,)])
+        Supplier.product_storage = "table"
+        try:
+            SupplierProduct.migrate()
+            self.assertEqual(Supplier.find_offers([3, 2, 1, 42]), offers)
+        finally:
+            Supplier.product_storage = "array"
+
+    def test_change_log(self):
+        """Test the change log written by every supplier write"""
+        supplier = SupplierFactory(rating=3.0)
+        supplier.create()
+        supplier_id = supplier.id
+        supplier.name = "Renamed"
+        supplier.update()
+        supplier.penalize()
+        self.assertEqual(supplier.rating, 2.0)
+        supplier.delete()
+
+        changes = SupplierChange.since()
+        self.assertEqual([c["action"] for c in changes], ["create", "update", "penalize", "delete"])
+        self.assertEqual({c["supplier_id"] for c in changes}, {supplier_id})
+        self.assertEqual(changes[1]["supplier"]["name"], "Renamed")
+        self.assertEqual(changes[2]["supplier"]["rating"], 2.0)
+        self.assertIsNone(changes[3]["supplier"])
+
+        self.assertEqual(SupplierChange.since(changes[1]["cursor"], limit=1), changes[2:3])
+        self.assertEqual(SupplierChange.since(changes[3]["cursor"]), [])
+        self.assertRaises(DataValidationError, SupplierChange.since, "nonsense")
+
+    def test_change_log_waits(self):
+        """Test waiting for the next change"""
+        start = time.monotonic()
+        self.assertEqual(SupplierChange.wait(timeout=1), [])
+        self.assertGreaterEqual(time.monotonic() - start, 1)
+
+        engine = db.engine
+
+        def write():
+            time.sleep(0.2)
+            with engine.begin() as connection:
+                connection.execute(SupplierChange.__table__.insert().values(
+                    supplier_id=1, action="delete"))
+                connection.execute("NOTIFY supplier_changes")
+
+        writer = threading.Thread(target=write)
+        writer.start()
+        changes = SupplierChange.wait(timeout=10)
+        writer.join()
+        self.assertEqual([c["action"] for c in changes], ["delete"])
+        self.assertLess(time.monotonic() - start, 5)
+
+    def test_table_product_storage(self):
+        """Test keeping products in the supplier_products table"""
+        Supplier.product_storage = "table"
+        try:
+            supplier = Supplier(name="Perez LLC", phone="6574-477-5210",
+                                address="41570 Ashley Manors", available=True,
+                                product_list=[3, 1, 2], rating=2.7)
+            supplier.create()
+            self.assertEqual(supplier.product_list, [1, 2, 3])
+            self.assertEqual(SupplierProduct.product_ids(supplier.id), [1, 2, 3])
+            stored = db.session.execute(
+                select([Supplier.__table__.c.product_list]).where(Supplier.id == supplier.id)
+            ).scalar()
+            self.assertIsNone(stored)
+
+            supplier = Supplier.find(supplier.id)
+            self.assertEqual(supplier.product_list, [1, 2, 3])
+            supplier.product_list = [2, 3, 4]
+            supplier.update()
+            self.assertEqual(SupplierProduct.product_ids(supplier.id), [2, 3, 4])
+            self.assertEqual(Supplier.find_rows_by_ids([supplier.id], ("product_list",)), [([2, 3, 4],)])
+            self.assertEqual(Supplier.find_rows(("id",), product_id=4), [(supplier.id,)])
+            self.assertEqual([s.id for s in Supplier.find_by_product(1)], [])
+            counts = {p["product_id"]: p["supplier_count"] for p in Supplier.stats()["products"]}
+            self.assertEqual(counts, {2: 1, 3: 1, 4: 1})
+            self.assertEqual(ProductRollup.drift(), [])
+
+            supplier.delete()
+            self.assertEqual(SupplierProduct.product_ids(supplier.id), [])
+        finally:
+            Supplier.product_storage = "array"
+
+    def test_dual_product_storage_migration(self):
+        """Test migrating products from arrays to the supplier_products table"""
+        suppliers = SupplierFactory.create_batch(3)
+        for supplier in suppliers:
+            supplier.create()
+        self.assertEqual(SupplierProduct.query.count(), 0)
+        Supplier.product_storage = "dual"
+        try:
+            self.assertEqual(SupplierProduct.migrate(batch_size=2), 3)
+            supplier = Supplier.find(suppliers[0].id)
+            supplier.product_list = [7, 8]
+            supplier.update()
+            self.assertEqual(SupplierProduct.product_ids(supplier.id), [7, 8])
+            self.assertEqual(Supplier.find(supplier.id).product_list, [7, 8])
+            for other in suppliers[1:]:
+                self.assertEqual(SupplierProduct.product_ids(other.id), sorted(other.product_list))
+        finally:
+            Supplier.product_storage = "array"
+
+    ######################################################################
+    #  H E L P E R S
+    ######################################################################
+
+    @staticmethod
+    def _explain(stmt):
+        """Returns the query plan of a statement with sequential scans disabled"""
+        sql = str(stmt.compile(dialect=db.engine.dialect, compile_kwargs={"literal_binds": True}))
+        db.session.execute("SET LOCAL enable_seqscan = off")
+        plan = "\n".join(row[0] for row in db.session.execute("EXPLAIN " + sql))
+        db.session.rollback()
+        return plan
+
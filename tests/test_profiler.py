@@ -0,0 +1,135 @@
+"""
+Test cases for the worker profiler
+
+Test cases can be run with the following:
+  nosetests
+"""
+import re
+import logging
+import threading
+from unittest import TestCase
+from service import status, profiler
+from service.profiler import ProfilerBusy, Sampler, active_routes
+from service.routes import app
+
+LINE = re.compile(r"^\S.* \d+$")
+
+
+def spin(stop):
+    """ Keeps a thread busy until stop is set """
+    while not stop.is_set():
+        sum(range(1000))
+
+
+######################################################################
+#  S A M P L E R   T E S T   C A S E S
+######################################################################
+class TestSampler(TestCase):
+    """ Test Cases for the Sampler """
+
+    def test_collapsed_stacks(self):
+        """ Count the stacks of a busy thread under its route """
+        stop = threading.Event()
+        worker = threading.Thread(target=spin, args=(stop,))
+        worker.start()
+        active_routes[worker.ident] = "GET /api/suppliers"
+        try:
+            sampler = Sampler(interval=0.005).run(0.2)
+        finally:
+            stop.set()
+            worker.join()
+            active_routes.pop(worker.ident, None)
+        self.assertGreater(sampler.samples, 10)
+        lines = sampler.collapsed().splitlines()
+        for line in lines:
+            self.assertRegex(line, LINE)
+        busy = [line for line in lines if line.startswith("GET /api/suppliers;")]
+        self.assertTrue(busy)
+        self.assertTrue(all("tests/test_profiler.py:spin" in line for line in busy))
+        self.assertEqual(sum(int(line.rsplit(" ", 1)[1]) for line in busy), sampler.samples)
+        self.assertFalse(any("test_collapsed_stacks" in line for line in lines))
+
+    def test_background_profile(self):
+        """ Sample the calling thread from a background thread """
+        active_routes[threading.get_ident()] = "GET /api/suppliers"
+        try:
+            sampler = Sampler(interval=0.005).start(0.2)
+            self.assertRaises(ProfilerBusy, Sampler().start, 1)
+            self.assertGreater(sampler.remaining, 0)
+            spin(sampler.finished)
+        finally:
+            active_routes.pop(threading.get_ident(), None)
+        self.assertIs(Sampler.latest, sampler)
+        self.assertEqual(sampler.remaining, 0)
+        lines = sampler.collapsed().splitlines()
+        self.assertTrue(any(line.startswith("GET /api/suppliers;") and "test_profiler.py:spin" in line
+                            for line in lines))
+        self.assertFalse(any("_sample_until_deadline" in line for line in lines))
+
+    def test_one_profile_at_a_time(self):
+        """ Refuse to run two profiles in one process """
+        with Sampler.running:
+            self.assertRaises(ProfilerBusy, Sampler().run, 0.01)
+            self.assertRaises(ProfilerBusy, Sampler().start, 0.01)
+
+    def test_route_attribution(self):
+        """ Record the route each thread is serving """
+        with app.test_request_context("/api/suppliers/7", method="PUT"):
+            app.preprocess_request()
+            self.assertEqual(active_routes[threading.get_ident()], "PUT /api/suppliers/<supplier_id>")
+            profiler.end_request()
+        self.assertNotIn(threading.get_ident(), active_routes)
+
+
+######################################################################
+#  E N D P O I N T   T E S T   C A S E S
+######################################################################
+class TestProfileEndpoint(TestCase):
+    """ Test Cases for the profile endpoint """
+
+    @classmethod
+    def setUpClass(cls):
+        """ This runs once before the entire test suite """
+        app.config["TESTING"] = True
+        app.logger.setLevel(logging.CRITICAL)
+
+    def setUp(self):
+        self.app = app.test_client()
+        self.headers = {"X-Api-Key": app.config["API_KEY"]}
+
+    def test_profile(self):
+        """ Profile the worker while it keeps serving requests """
+        Sampler.latest = None
+        resp = self.app.get("/api/admin/profile", headers=self.headers)
+        self.assertEqual(resp.status_code, status.HTTP_404_NOT_FOUND)
+        resp = self.app.post("/api/admin/profile", query_string={"seconds": 1, "interval": 20},
+                             headers=self.headers)
+        self.assertEqual(resp.status_code, status.HTTP_202_ACCEPTED)
+        self.assertTrue(resp.headers["Location"].endswith("/api/admin/profile"))
+        self.assertEqual(resp.headers["Retry-After"], "1")
+        resp = self.app.post("/api/admin/profile", query_string={"seconds": 1}, headers=self.headers)
+        self.assertEqual(resp.status_code, status.HTTP_409_CONFLICT)
+        resp = self.app.get("/api/admin/profile", headers=self.headers)
+        self.assertEqual(resp.status_code, status.HTTP_202_ACCEPTED)
+        self.assertIn("Retry-After", resp.headers)
+        while not Sampler.latest.finished.is_set():
+            self.assertEqual(self.app.get("/").status_code, status.HTTP_200_OK)
+        resp = self.app.get("/api/admin/profile", headers=self.headers)
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual(resp.mimetype, "text/plain")
+        self.assertGreater(int(resp.headers["X-Profile-Samples"]), 10)
+        lines = resp.get_data(as_text=True).splitlines()
+        self.assertTrue(any(line.startswith("thread:MainThread;") or line.startswith("GET /;")
+                            for line in lines))
+
+    def test_profile_needs_key(self):
+        """ Only profile for clients with an API key """
+        resp = self.app.post("/api/admin/profile", query_string={"seconds": 1})
+        self.assertEqual(resp.status_code, status.HTTP_401_UNAUTHORIZED)
+        resp = self.app.get("/api/admin/profile")
+        self.assertEqual(resp.status_code, status.HTTP_401_UNAUTHORIZED)
+
+    def test_profile_bad_duration(self):
+        """ Reject durations out of range """
+        resp = self.app.post("/api/admin/profile", query_string={"seconds": 0}, headers=self.headers)
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
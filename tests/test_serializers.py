@@ -0,0 +1,57 @@
+"""
+Test cases for Supplier serializers
+
+Test cases can be run with the following:
+  nosetests
+"""
+import json
+from unittest import TestCase
+from datetime import datetime, timezone
+from service.serializers import SUPPLIER_FIELDS, row_serializer, serialize_rows, dumps, packb, unpackb
+from .factories import SupplierFactory
+
+
+######################################################################
+#  S E R I A L I Z E R   T E S T   C A S E S
+######################################################################
+class TestSerializers(TestCase):
+    """ Test Cases for the row serializers """
+
+    def test_serialize_rows_matches_model(self):
+        """ Serialize row tuples the same way as Supplier.serialize() """
+        suppliers = SupplierFactory.create_batch(3)
+        rows = [tuple(getattr(s, field) for field in SUPPLIER_FIELDS) for s in suppliers]
+        data = serialize_rows(rows)
+        self.assertEqual(data, [supplier.serialize() for supplier in suppliers])
+
+    def test_row_serializer_is_cached(self):
+        """ Build each field layout's serializer only once """
+        fields = ("id", "name")
+        self.assertIs(row_serializer(fields), row_serializer(fields))
+        self.assertEqual(row_serializer(fields)((1, "Acme")), {"id": 1, "name": "Acme"})
+
+    def test_row_serializer_timestamps(self):
+        """ Return timestamps as ISO 8601 strings, keeping missing ones None """
+        stamp = datetime(2021, 6, 1, 12, 30, tzinfo=timezone.utc)
+        serialize = row_serializer(("id", "created_at", "updated_at"))
+        self.assertEqual(serialize((1, stamp, None)),
+                         {"id": 1, "created_at": "2021-06-01T12:30:00+00:00", "updated_at": None})
+
+    def test_row_serializer_unknown_field(self):
+        """ Reject fields that are not supplier columns """
+        self.assertRaises(ValueError, row_serializer, ("id", "__class__"))
+
+    def test_dumps(self):
+        """ Encode data to JSON bytes """
+        data = {"id": 1, "product_list": [1, 2], "rating": 3.5, "available": True}
+        self.assertEqual(json.loads(dumps(data)), data)
+
+    def test_msgpack(self):
+        """ Encode and decode MessagePack, datetimes as ISO 8601 strings """
+        data = {"id": 1, "product_list": [1, 2], "rating": 3.5, "available": True}
+        self.assertEqual(unpackb(packb(data)), data)
+        when = datetime(2021, 6, 1, 12, 30, tzinfo=timezone.utc)
+        self.assertEqual(unpackb(packb({"at": when})), {"at": "2021-06-01T12:30:00+00:00"})
+        self.assertRaises(TypeError, packb, {"id": object()})
+        self.assertRaises(ValueError, unpackb, b"")
+        self.assertRaises(ValueError, unpackb, packb(1) + packb(2))